@@ -0,0 +1,237 @@
+import math
+import os
+import threading
+import time
+
+import metrics
+
+# admission control for one worker process. every controlled request costs some units
+# of a fixed capacity: point requests cost one, list, query and bulk requests cost one
+# per ROWS_PER_UNIT rows they're estimated to return or touch, or per BYTES_PER_UNIT of
+# request body. a request that doesn't fit waits in a short bounded queue for its
+# endpoint class, and is shed (503 with Retry-After) when the queue is full or the wait
+# times out. part of the capacity is held back for point reads, and part of the rest
+# for point writes, so a burst of expensive requests can't starve either of them. a
+# list, query or bulk request is charged at most what's left after both reserves, so
+# one large enough to need all of that runs alone among them, while point requests
+# keep going
+
+enabled = os.getenv('ADMISSION_CONTROL', '0') == '1'
+
+POINT_READ = 'point_read'
+POINT_WRITE = 'point_write'
+LIST = 'list'
+QUERY = 'query'
+BULK_WRITE = 'bulk_write'
+BULK_DELETE = 'bulk_delete'
+
+# concurrent requests allowed per endpoint class, on top of the shared capacity.
+# point reads are only bounded by the capacity
+DEFAULT_LIMITS = {
+    POINT_WRITE: 16,
+    LIST: 4,
+    QUERY: 8,
+    BULK_WRITE: 2,
+    BULK_DELETE: 2
+}
+
+# rough fraction of rows a single condition keeps. and-ed fractions multiply, or-ed
+# fractions add up
+_selectivity = {
+    'isnull': 0.05,
+    'not isnull': 1.0,
+    'eq': 0.05,
+    'ne': 1.0,
+    'lt': 0.33,
+    'gt': 0.33,
+    'le': 0.33,
+    'ge': 0.33,
+    'like': 0.25,
+    'not like': 1.0,
+    'between': 0.25,
+    'not between': 1.0
+}
+
+
+def _setting(value, env_name, default, cast):
+    return cast(os.getenv(env_name, default)) if value is None else value
+
+
+def parse_limits(limits_str):
+    # 'list=4,query=8' -> {'list': 4, 'query': 8}
+    limits = {}
+    for item in limits_str.split(','):
+        if item.strip():
+            endpoint_class, limit = item.split('=')
+            limits[endpoint_class.strip()] = int(limit)
+    return limits
+
+
+def estimate_cond_spec_rows(cond_spec, row_count):
+    # cond_spec can also be a query spec, whose limit caps the estimate
+    limit = None
+    if isinstance(cond_spec, dict):
+        limit = cond_spec.get('limit')
+        cond_spec = cond_spec.get('where', [])
+        if isinstance(cond_spec, dict):
+            cond_spec = [cond_spec]
+    fraction = _all_fraction(cond_spec, row_count)
+    # rounded first so that float error can't turn one row into two
+    rows = int(math.ceil(round(row_count * fraction, 6)))
+    return rows if limit is None else min(rows, limit)
+
+
+def _all_fraction(conds, row_count):
+    fraction = 1.0
+    for cond in conds:
+        fraction *= _fraction(cond, row_count)
+    return fraction
+
+
+def _fraction(cond, row_count):
+    # an eq on name matches at most one row, and a like with a literal name prefix
+    # is narrower than one starting with a wildcard. a not keeps a little even of
+    # a condition that keeps everything
+    if 'predicate' not in cond:
+        if 'all' in cond:
+            return _all_fraction(cond['all'], row_count)
+        if 'any' in cond:
+            return min(1.0, sum(_fraction(operand, row_count) for operand in cond['any']))
+        if 'not' in cond:
+            return max(1.0 - _fraction(cond['not'], row_count), _selectivity['eq'])
+    predicate = cond.get('predicate')
+    constants = cond.get('constants') or []
+    if cond.get('variable') == 'name':
+        if predicate == 'eq':
+            return min(1.0, 1.0 / row_count) if row_count else 0.0
+        if predicate == 'isnull':
+            return 0.0
+        if predicate == 'like' and constants and isinstance(constants[0], str) \
+                and not constants[0].startswith(('%', '_')):
+            return 0.01
+    return _selectivity.get(predicate, 1.0)
+
+
+class AdmissionController:
+
+    def __init__(self, capacity=None, point_read_reserve=None, limits=None, queue_size=None,
+                 queue_timeout_ms=None, retry_after_s=None, rows_per_unit=None, bytes_per_unit=None,
+                 row_count_ttl_s=None, point_write_reserve=None):
+        capacity = _setting(capacity, 'ADMISSION_CAPACITY', '32', int)
+        point_read_reserve = _setting(point_read_reserve, 'ADMISSION_POINT_READ_RESERVE', '8', int)
+        point_write_reserve = _setting(point_write_reserve, 'ADMISSION_POINT_WRITE_RESERVE', '4', int)
+        if limits is None:
+            limits = dict(DEFAULT_LIMITS, **parse_limits(os.getenv('ADMISSION_LIMITS', '')))
+        queue_size = _setting(queue_size, 'ADMISSION_QUEUE_SIZE', '16', int)
+        queue_timeout_ms = _setting(queue_timeout_ms, 'ADMISSION_QUEUE_TIMEOUT_MS', '250', float)
+        retry_after_s = _setting(retry_after_s, 'ADMISSION_RETRY_AFTER_S', '1', int)
+        rows_per_unit = _setting(rows_per_unit, 'ADMISSION_ROWS_PER_UNIT', '1000', int)
+        bytes_per_unit = _setting(bytes_per_unit, 'ADMISSION_BYTES_PER_UNIT', str(256 * 1024), int)
+        row_count_ttl_s = _setting(row_count_ttl_s, 'ADMISSION_ROW_COUNT_TTL_S', '5', float)
+        if point_read_reserve < 0 or point_write_reserve < 0 or point_read_reserve + point_write_reserve >= capacity:
+            raise ValueError('the point read and write reserves have to leave some of the capacity for other requests')
+        self.capacity = capacity
+        self.point_read_reserve = point_read_reserve
+        self.point_write_reserve = point_write_reserve
+        self.limits = limits
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout_ms / 1000
+        self.retry_after_s = retry_after_s
+        self.rows_per_unit = rows_per_unit
+        self.bytes_per_unit = bytes_per_unit
+        self.row_count_ttl = row_count_ttl_s
+        self._cond = threading.Condition()
+        self._units_in_use = 0
+        self._point_read_units_in_use = 0
+        self._point_write_units_in_use = 0
+        self._in_flight = {}  # endpoint class -> admitted requests
+        self._waiting = {}  # endpoint class -> queued requests
+        self._row_count = None
+        self._row_count_time = 0.0
+
+    def row_count(self, refresh):
+        # refresh() is only called once the cached estimate is older than the ttl
+        now = time.monotonic()
+        if self._row_count is None or now - self._row_count_time >= self.row_count_ttl:
+            self._row_count = refresh()
+            self._row_count_time = now
+        return self._row_count
+
+    def rows_cost(self, rows):
+        return int(math.ceil(rows / self.rows_per_unit))
+
+    def bytes_cost(self, byte_count):
+        return int(math.ceil(byte_count / self.bytes_per_unit))
+
+    def admit(self, endpoint_class, cost):
+        # returns a ticket to hand back to release, or None when the request is shed.
+        # a request costing more than its class could ever get is charged the most it
+        # can get, so it still runs, just alone
+        cost = min(max(cost, 1), self._budget(endpoint_class))
+        limit = self.limits.get(endpoint_class, None)
+        with self._cond:
+            if not self._fits(endpoint_class, cost, limit):
+                waiting = self._waiting.get(endpoint_class, 0)
+                if waiting >= self.queue_size:
+                    metrics.ADMISSION_SHED.inc(1, endpoint_class, 'queue full')
+                    return None
+                self._waiting[endpoint_class] = waiting + 1
+                try:
+                    admitted = self._cond.wait_for(
+                        lambda: self._fits(endpoint_class, cost, limit),
+                        self.queue_timeout
+                    )
+                finally:
+                    self._waiting[endpoint_class] -= 1
+                if not admitted:
+                    metrics.ADMISSION_SHED.inc(1, endpoint_class, 'queue timeout')
+                    return None
+            self._units_in_use += cost
+            if endpoint_class == POINT_READ:
+                self._point_read_units_in_use += cost
+            elif endpoint_class == POINT_WRITE:
+                self._point_write_units_in_use += cost
+            self._in_flight[endpoint_class] = self._in_flight.get(endpoint_class, 0) + 1
+        return endpoint_class, cost
+
+    def release(self, ticket):
+        endpoint_class, cost = ticket
+        with self._cond:
+            self._units_in_use -= cost
+            if endpoint_class == POINT_READ:
+                self._point_read_units_in_use -= cost
+            elif endpoint_class == POINT_WRITE:
+                self._point_write_units_in_use -= cost
+            self._in_flight[endpoint_class] -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            samples = [(('units_in_use', 'all'), self._units_in_use), (('capacity', 'all'), self.capacity)]
+            samples.extend((('in_flight', c), n) for c, n in sorted(self._in_flight.items()))
+            samples.extend((('waiting', c), n) for c, n in sorted(self._waiting.items()))
+        return samples
+
+    def _budget(self, endpoint_class):
+        if endpoint_class == POINT_READ:
+            return self.capacity
+        if endpoint_class == POINT_WRITE:
+            return self.capacity - self.point_read_reserve
+        return self.capacity - self.point_read_reserve - self.point_write_reserve
+
+    def _fits(self, endpoint_class, cost, limit):
+        # the reserves nest: everything shares the capacity less both reserves, point
+        # writes can also use the point write reserve, and point reads can use it all
+        if limit is not None and self._in_flight.get(endpoint_class, 0) >= limit:
+            return False
+        if self._units_in_use + cost > self.capacity:
+            return False
+        if endpoint_class == POINT_READ:
+            return True
+        units_in_use_by_writes = self._units_in_use - self._point_read_units_in_use
+        if units_in_use_by_writes + cost > self.capacity - self.point_read_reserve:
+            return False
+        if endpoint_class == POINT_WRITE:
+            return True
+        units_in_use_by_others = units_in_use_by_writes - self._point_write_units_in_use
+        return units_in_use_by_others + cost <= self._budget(endpoint_class)
@@ -0,0 +1,582 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import parse_qs
+
+import jsonschema
+
+from widgets import WidgetStore
+from widgets import Widget
+from widgets import VersionMismatchError
+from widgets import StoreUnavailableError
+from widgets import write_version
+from shards import ShardedWidgetStore
+from shards import sharded_write_version
+from groupcommit import GroupCommitWriter
+from connpool import ReadWriteSplit
+import admission
+import bulkingest
+import metrics
+import querycache
+
+# any asgi server can host this, e.g.
+#   uvicorn asgiapp:app
+# routes, status codes and error bodies mirror flaskapp. widget store calls, widget
+# validation and row decoding all run on a bounded thread pool, so the event loop only
+# ever parks idle or slow connections, and list results are streamed out in chunks.
+# ADMISSION_CONTROL=1 sheds load the same way flaskapp does
+
+if os.getenv('CONNECT_STR', None) is None and os.getenv('SHARD_CONNECT_STRS', None) is None:
+    print('must define CONNECT_STR or SHARD_CONNECT_STRS env variable before starting server')
+    sys.exit()
+
+STREAM_CHUNK_SIZE = 500
+
+logger = logging.getLogger(__name__)
+
+
+class _Request:
+
+    def __init__(self, method, path, query_string, headers, body):
+        self.method = method
+        self.path = path
+        self.args = parse_qs(query_string.decode('latin-1'))
+        self.headers = headers
+        self.body = body
+
+    def arg_int(self, name, default=None):
+        try:
+            return int(self.args[name][0])
+        except (KeyError, ValueError):
+            return default
+
+    @property
+    def is_json(self):
+        mimetype = self.headers.get('content-type', '').split(';')[0].strip().lower()
+        return mimetype == 'application/json' or (mimetype.startswith('application/') and mimetype.endswith('+json'))
+
+    def get_json(self):
+        if not self.is_json:
+            return None
+        return json.loads(self.body)
+
+
+class _Response:
+
+    def __init__(self, status, json_obj=None, json_items=None, headers=None, body=None):
+        self.status = status
+        self.json_obj = json_obj
+        self.json_items = json_items  # a list, streamed as a json array
+        self.headers = list(headers or [])
+        self.body = body  # already serialised json
+
+
+def _error(status, error_class, request=None, cause=None):
+    body = {"error class": error_class}
+    if request is not None:
+        body["uri"] = request.path
+    if cause is not None:
+        body["cause"] = cause
+    return _Response(status, json_obj=body)
+
+
+def _write_count_headers(written, widget_json_objs):
+    return [('x-widgets-written', str(written)), ('x-widgets-skipped', str(len(widget_json_objs) - written))]
+
+
+def _set_stored_dates(widget_json_objs, stored_dates):
+    # same as flaskapp.set_stored_dates
+    for widget_json_obj in widget_json_objs:
+        created_date, updated_date = stored_dates[widget_json_obj['name']]
+        widget_json_obj.update({
+            "created_date": created_date,
+            "updated_date": updated_date
+        })
+
+
+def _page_args_error(request):
+    # same as flaskapp.check_page_args
+    limit = request.arg_int('limit')
+    if (limit is not None and limit < 0) or request.arg_int('offset', 0) < 0:
+        return _error(400, "invalid paging", request, "limit and offset must not be negative")
+    return None
+
+
+def _store_unavailable_error(request, ex):
+    # same as flaskapp.store_unavailable_error
+    response = _error(503, "server overloaded", request, str(ex))
+    response.headers.append(('retry-after', os.getenv('ADMISSION_RETRY_AFTER_S', '1')))
+    return response
+
+
+def _version_etag(version):
+    return '"%s"' % version
+
+
+def _if_match_version(request):
+    # same rules as flaskapp.get_if_match_version: '*' adds no condition, and anything
+    # but a single strong ETag gets version 0, which no row ever has
+    if_match = request.headers.get('if-match', '').strip()
+    if not if_match or if_match == '*':
+        return None
+    etags = [etag.strip() for etag in if_match.split(',')]
+    if len(etags) != 1 or not etags[0].startswith('"') or not etags[0].endswith('"'):
+        return 0
+    etag = etags[0][1:-1]
+    return int(etag) if etag.isdigit() else 0
+
+
+def _log_unexpected_exception():
+    # same as flaskapp.log_unexpected_exception
+    ex = sys.exc_info()[1]
+    if isinstance(ex, sqlite3.OperationalError) and ('locked' in str(ex) or 'busy' in str(ex)):
+        metrics.SQLITE_BUSY_ERRORS.inc()
+    logger.exception('Unexpected exception')
+
+
+def _encode_json(json_obj):
+    return json.dumps(json_obj).encode('utf-8')
+
+
+def _encode_chunk(widgets, start, leading_comma):
+    chunk = ','.join(w.to_json_str() for w in widgets[start:start + STREAM_CHUNK_SIZE])
+    return (',' + chunk if leading_comma else chunk).encode('utf-8')
+
+
+def _today():
+    return datetime.today().strftime("%Y-%m-%d")
+
+
+class WidgetsASGIApp:
+
+    def __init__(self, max_workers=None):
+        if max_workers is None:
+            max_workers = int(os.getenv('ASGI_STORE_WORKERS', '8'))
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='widget-store')
+        self._local = threading.local()
+        self._process_stores_lock = threading.Lock()
+        self._read_write_split = None
+        self._group_commit_writer = None
+        self.query_cache = querycache.QueryResultCache() if querycache.enabled else None
+        self.admission_controller = admission.AdmissionController() if admission.enabled else None
+        # (method, path pattern, handler, admission control endpoint class)
+        self._routes = [
+            ('GET', re.compile(r'^/widgets$'), self.get_widgets, admission.LIST),
+            ('PUT', re.compile(r'^/widgets$'), self.put_widgets, admission.BULK_WRITE),
+            ('DELETE', re.compile(r'^/widgets$'), self.delete_widgets, admission.BULK_DELETE),
+            ('POST', re.compile(r'^/widgets/query$'), self.query_widgets, admission.QUERY),
+            ('POST', re.compile(r'^/widgets/add$'), self.add_widgets, admission.BULK_WRITE),
+            ('POST', re.compile(r'^/widgets/delete$'), self.bulk_delete_widgets, admission.BULK_DELETE),
+            ('GET', re.compile(r'^/widgets/(?P<widget_name>[^/]+)$'), self.get_widget, admission.POINT_READ),
+            ('PUT', re.compile(r'^/widgets/(?P<widget_name>[^/]+)$'), self.put_widget, admission.POINT_WRITE),
+            ('PATCH', re.compile(r'^/widgets/(?P<widget_name>[^/]+)$'), self.patch_widget, admission.POINT_WRITE),
+            ('DELETE', re.compile(r'^/widgets/(?P<widget_name>[^/]+)$'), self.delete_widget, admission.POINT_WRITE),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            request = _Request(
+                scope['method'],
+                scope['path'],
+                scope.get('query_string', b''),
+                dict((k.decode('latin-1').lower(), v.decode('latin-1')) for k, v in scope.get('headers', [])),
+                await self._read_body(receive)
+            )
+            await self._send_response(send, await self.dispatch(request))
+
+    async def dispatch(self, request):
+        path_matched = False
+        for method, pattern, handler, endpoint_class in self._routes:
+            match = pattern.match(request.path)
+            if match is None:
+                continue
+            path_matched = True
+            if method == request.method:
+                # the server has already percent-decoded the path, so the match is the name
+                ticket = None
+                try:
+                    if self.admission_controller is not None:
+                        ticket = await self._admit(request, endpoint_class)
+                        if ticket is None:
+                            return self._overloaded(request, endpoint_class)
+                    return await handler(request, **match.groupdict())
+                except StoreUnavailableError as ex:
+                    return _store_unavailable_error(request, ex)
+                except Exception:
+                    _log_unexpected_exception()
+                    return _error(500, "internal server error")
+                finally:
+                    if ticket is not None:
+                        self.admission_controller.release(ticket)
+        if path_matched:
+            return _error(405, "method not allowed", request)
+        return _error(404, "not found", request)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self._read_write_split is not None:
+            self._read_write_split.close()
+        if self._group_commit_writer is not None:
+            self._group_commit_writer.close()
+
+    # routes
+
+    async def get_widgets(self, request):
+        page_args_error = _page_args_error(request)
+        if page_args_error is not None:
+            return page_args_error
+        widgets = await self._run(
+            lambda store: store.get_all_widgets(
+                limit=request.arg_int('limit'),
+                offset=request.arg_int('offset', 0)
+            ),
+            read=True
+        )
+        return _Response(200, json_items=widgets)
+
+    async def put_widgets(self, request):
+        def work(store):
+            new_widget_json_objs = request.get_json()
+            for new_widget_json_obj in new_widget_json_objs:
+                new_widget_json_obj.update({
+                    "updated_date": _today(),
+                    "created_date": _today()
+                })
+            rows = bulkingest.encode_widget_rows(new_widget_json_objs)
+            stored_dates = {}
+            written = store.replace_all_widget_rows(rows, stored_dates)
+            _set_stored_dates(new_widget_json_objs, stored_dates)
+            return new_widget_json_objs, written
+        try:
+            new_widget_json_objs, written = await self._run(work)
+            return _Response(
+                200, json_obj=new_widget_json_objs, headers=_write_count_headers(written, new_widget_json_objs)
+            )
+        except jsonschema.exceptions.ValidationError as ve:
+            return _error(400, "invalid widget representation", request, ve.message)
+
+    async def delete_widgets(self, request):
+        await self._run(lambda store: store.delete_all_widgets())
+        return _Response(204)
+
+    async def query_widgets(self, request):
+        page_args_error = _page_args_error(request)
+        if page_args_error is not None:
+            return page_args_error
+        try:
+            if self.query_cache is not None:
+                body = await self._offload(self._cached_query, request)
+                return _Response(200, body=body)
+            widgets = await self._run(
+                lambda store: store.get_widgets_by_cond_spec(
+                    request.get_json(),
+                    limit=request.arg_int('limit'),
+                    offset=request.arg_int('offset', 0)
+                ),
+                read=True
+            )
+            return _Response(200, json_items=widgets)
+        except jsonschema.exceptions.ValidationError as ve:
+            return _error(400, "invalid conditions specifications", request, ve.message)
+
+    async def add_widgets(self, request):
+        def work(store):
+            new_widget_json_objs = request.get_json()
+            for new_widget_json_obj in new_widget_json_objs:
+                new_widget_json_obj.update({
+                    "updated_date": _today(),
+                    "created_date": _today()
+                })
+            rows = bulkingest.encode_widget_rows(new_widget_json_objs)
+            stored_dates = {}
+            written = store.put_widget_rows(rows, stored_dates)
+            _set_stored_dates(new_widget_json_objs, stored_dates)
+            return new_widget_json_objs, written
+        try:
+            new_widget_json_objs, written = await self._run(work)
+            return _Response(
+                200, json_obj=new_widget_json_objs, headers=_write_count_headers(written, new_widget_json_objs)
+            )
+        except jsonschema.exceptions.ValidationError as ve:
+            return _error(400, "invalid widget representation", request, ve.message)
+
+    async def bulk_delete_widgets(self, request):
+        try:
+            await self._run(lambda store: store.delete_widgets_by_cond_spec(request.get_json()))
+            return _Response(204)
+        except jsonschema.exceptions.ValidationError as ve:
+            return _error(400, "invalid conditions specifications", request, ve.message)
+
+    async def get_widget(self, request, widget_name):
+        try:
+            widget = await self._run(lambda store: store.get_widget_by_name(widget_name), read=True)
+            return _Response(200, json_obj=widget.to_json_obj(), headers=[('etag', _version_etag(widget.version))])
+        except LookupError:
+            return _error(404, "widget does not exist", request)
+
+    async def put_widget(self, request, widget_name):
+        if_version = _if_match_version(request)
+        try:
+            try:  # if this succeeds, the widget already exists and is getting updated
+                if not request.is_json:
+                    raise ValueError('request body was not parseable json')
+                old_widget = await self._run(lambda store: store.get_widget_by_name(widget_name), read=True)
+                new_widget_json_obj = request.get_json()
+                new_widget_json_obj.update({
+                    "updated_date": _today(),
+                    "created_date": old_widget["created_date"]
+                })
+                new_widget = await self._offload(Widget.from_json_obj, new_widget_json_obj)
+                version = await self._point_write('put_widget', '_write_widget', new_widget, if_version)
+                return _Response(200, json_obj=new_widget_json_obj, headers=[('etag', _version_etag(version))])
+            except LookupError:  # if we're here, a new widget is getting created
+                new_widget_json_obj = request.get_json()
+                new_widget_json_obj.update({
+                    "created_date": _today(),
+                    "updated_date": _today()
+                })
+                new_widget = await self._offload(Widget.from_json_obj, new_widget_json_obj)
+                version = await self._point_write('put_widget', '_write_widget', new_widget, if_version)
+                return _Response(201, json_obj=new_widget_json_obj, headers=[('etag', _version_etag(version))])
+        except jsonschema.exceptions.ValidationError as ve:
+            return _error(400, "invalid widget representation", request, ve.message)
+        except VersionMismatchError:
+            return _error(412, "widget version does not match If-Match", request)
+
+    async def patch_widget(self, request, widget_name):
+        patch = request.get_json()
+        if not isinstance(patch, dict):
+            return _error(
+                400, "invalid widget representation", request, "request body must be a json merge patch object"
+            )
+        patch.pop("created_date", None)
+        patch["updated_date"] = _today()
+        if_version = _if_match_version(request)
+        # the patch is validated before it's queued, so with group commit on this ties up
+        # a pool thread for the write too
+        group_commit_writer = self._get_group_commit_writer()
+        try:
+            widget = await self._run(
+                lambda store: (group_commit_writer or store).patch_widget(widget_name, patch, if_version)
+            )
+            return _Response(200, json_obj=widget.to_json_obj(), headers=[('etag', _version_etag(widget.version))])
+        except jsonschema.exceptions.ValidationError as ve:
+            return _error(400, "invalid widget representation", request, ve.message)
+        except ValueError as ve:
+            return _error(400, "invalid widget representation", request, str(ve))
+        except VersionMismatchError:
+            return _error(412, "widget version does not match If-Match", request)
+        except LookupError:
+            return _error(404, "widget does not exist", request)
+
+    async def delete_widget(self, request, widget_name):
+        try:
+            await self._point_write(
+                'delete_widget_by_name', '_erase_widget_by_name', widget_name, _if_match_version(request)
+            )
+            return _Response(204)
+        except VersionMismatchError:
+            return _error(412, "widget version does not match If-Match", request)
+        except LookupError:
+            return _error(404, "widget does not exist", request)
+
+    # admission control
+
+    async def _admit(self, request, endpoint_class):
+        if endpoint_class in (admission.POINT_READ, admission.POINT_WRITE):
+            cost = 1
+        else:
+            cost = await self._offload(self._estimate_request_cost, request, endpoint_class)
+        # a request that doesn't fit blocks in admit for up to the queue timeout, so it
+        # waits on the loop's default executor rather than the event loop or a thread
+        # the admitted requests' store calls need
+        admitted = asyncio.get_running_loop().run_in_executor(
+            None, self.admission_controller.admit, endpoint_class, cost
+        )
+        try:
+            return await asyncio.shield(admitted)
+        except asyncio.CancelledError:
+            # the request went away while it waited, so a ticket granted since goes back
+            admitted.add_done_callback(self._release_abandoned_ticket)
+            raise
+
+    def _release_abandoned_ticket(self, admitted):
+        if not admitted.cancelled() and admitted.exception() is None and admitted.result() is not None:
+            self.admission_controller.release(admitted.result())
+
+    def _estimate_request_cost(self, request, endpoint_class):
+        # same as flaskapp.estimate_request_cost
+        row_count = self.admission_controller.row_count(
+            lambda: self._call_with_store(lambda store: store.estimate_row_count(), True)
+        )
+        limit = request.arg_int('limit')
+        if request.method == 'POST' and endpoint_class in (admission.QUERY, admission.BULK_DELETE):
+            try:
+                rows = admission.estimate_cond_spec_rows(request.get_json(), row_count)
+            except (AttributeError, KeyError, TypeError, ValueError, RecursionError):
+                return 1  # left for the handler to reject
+        elif request.method == 'POST':  # /widgets/add only writes what it was sent
+            rows = 0
+        else:  # GET, PUT and DELETE /widgets read, replace or drop every row
+            rows = row_count
+        if limit is not None and request.method != 'PUT':
+            rows = min(limit, rows)
+        cost = self.admission_controller.rows_cost(rows)
+        if endpoint_class == admission.BULK_WRITE:
+            cost += self.admission_controller.bytes_cost(len(request.body))
+        return cost
+
+    def _overloaded(self, request, endpoint_class):
+        response = _error(
+            503,
+            "server overloaded",
+            request,
+            "too many %s requests in progress, retry later" % endpoint_class.replace('_', ' ')
+        )
+        response.headers.append(('retry-after', str(self.admission_controller.retry_after_s)))
+        return response
+
+    # plumbing
+
+    async def _offload(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def _run(self, fn, read=False):
+        return await self._offload(self._call_with_store, fn, read)
+
+    async def _point_write(self, store_method_name, group_commit_method_name, *args):
+        group_commit_writer = self._get_group_commit_writer()
+        if group_commit_writer is None:
+            return await self._run(lambda store: getattr(store, store_method_name)(*args))
+        # the writer thread does the work, so there is no pool thread to tie up waiting on
+        # it. the wait is shielded so that giving up on it leaves the queued write alone
+        written = asyncio.wrap_future(group_commit_writer.submit(group_commit_method_name, *args))
+        try:
+            return await asyncio.wait_for(asyncio.shield(written), group_commit_writer.result_timeout)
+        except asyncio.TimeoutError:
+            raise StoreUnavailableError(
+                'the group commit writer did not get to the write within %ss' % group_commit_writer.result_timeout
+            )
+
+    def _cached_query(self, request):
+        # same as flaskapp: the version is read before the query, and a hit needs no store
+        cond_spec = request.get_json()
+        limit = request.arg_int('limit')
+        offset = request.arg_int('offset', 0)
+        WidgetStore._validate_query_spec(cond_spec)
+        cache_key = querycache.cache_key(cond_spec, limit, offset)
+        version = self._write_version()
+        body = self.query_cache.get(cache_key, version)
+        if body is None:
+            widgets = self._call_with_store(
+                lambda store: store.get_widgets_by_cond_spec(cond_spec, limit=limit, offset=offset),
+                True
+            )
+            body = ('[' + ','.join(widget.to_json_str() for widget in widgets) + ']').encode('utf-8')
+            self.query_cache.put(cache_key, version, body)
+        return body
+
+    def _write_version(self):
+        if os.getenv('SHARD_CONNECT_STRS', None) is not None:
+            return sharded_write_version()
+        return write_version(os.getenv('CONNECT_STR'))
+
+    def _call_with_store(self, fn, read):
+        read_write_split = self._get_read_write_split()
+        if read_write_split is None:
+            return fn(self._thread_widget_store())
+        if read:
+            with read_write_split.readers.reader() as reader_store:
+                return fn(reader_store)
+        return fn(read_write_split.writer)
+
+    def _thread_widget_store(self):
+        widget_store = getattr(self._local, 'widget_store', None)
+        if widget_store is None:
+            if os.getenv('SHARD_CONNECT_STRS', None) is not None:
+                widget_store = self._local.widget_store = ShardedWidgetStore()
+            else:
+                widget_store = self._local.widget_store = WidgetStore()
+        return widget_store
+
+    def _get_read_write_split(self):
+        if os.getenv('READ_WRITE_SPLIT', '0') != '1' or os.getenv('SHARD_CONNECT_STRS', None) is not None:
+            return None
+        if self._read_write_split is None:
+            with self._process_stores_lock:
+                if self._read_write_split is None:
+                    self._read_write_split = ReadWriteSplit()
+        return self._read_write_split
+
+    def _get_group_commit_writer(self):
+        if os.getenv('GROUP_COMMIT', '0') != '1' or os.getenv('SHARD_CONNECT_STRS', None) is not None:
+            return None
+        if self._group_commit_writer is None:
+            with self._process_stores_lock:
+                if self._group_commit_writer is None:
+                    self._group_commit_writer = GroupCommitWriter()
+        return self._group_commit_writer
+
+    async def _read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        return b''.join(chunks)
+
+    async def _send_response(self, send, response):
+        headers = [(k.encode('latin-1'), v.encode('latin-1')) for k, v in response.headers]
+        if response.status == 204:
+            await send({'type': 'http.response.start', 'status': 204, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        headers.append((b'content-type', b'application/json'))
+        await send({'type': 'http.response.start', 'status': response.status, 'headers': headers})
+        if response.body is not None:
+            await send({'type': 'http.response.body', 'body': response.body})
+            return
+        if response.json_items is None:
+            # a bulk write echoes every widget it was sent, which is too much to encode
+            # on the event loop. a single widget or error body isn't worth the hop
+            if isinstance(response.json_obj, list):
+                body = await self._offload(_encode_json, response.json_obj)
+            else:
+                body = _encode_json(response.json_obj)
+            await send({'type': 'http.response.body', 'body': body})
+            return
+        # awaiting each send is the backpressure: a slow client holds a parked coroutine
+        # and one chunk of encoded output, never a thread. chunks are encoded on the pool,
+        # as a send to a fast client doesn't yield and the loop would be held for the
+        # whole list
+        items = response.json_items
+        await send({'type': 'http.response.body', 'body': b'[', 'more_body': True})
+        for start in range(0, len(items), STREAM_CHUNK_SIZE):
+            chunk = await self._offload(_encode_chunk, items, start, start > 0)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b']'})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+app = WidgetsASGIApp()
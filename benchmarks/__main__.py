@@ -0,0 +1,61 @@
+import argparse
+import json
+import sys
+
+from benchmarks.suite import BenchmarkSuite
+from benchmarks.suite import compare
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='benchmark Widget, WidgetStore and the http endpoints on seeded synthetic data'
+    )
+    parser.add_argument('--rows', type=int, default=1000, help='widgets seeded into the store (default 1000)')
+    parser.add_argument('--flex-width', type=int, default=4, help='flex properties per widget (default 4)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5, help='timings per benchmark, the median is reported')
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimum seconds per timing')
+    parser.add_argument('--filter', default=None, help='only run benchmarks whose name contains this')
+    parser.add_argument('--out', default=None, help='write results as json to this file')
+    parser.add_argument('--baseline', default=None, help='compare against results json from an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='slowdown versus baseline that counts as a regression (default 0.10, i.e. 10%%)')
+    args = parser.parse_args(argv)
+
+    results = BenchmarkSuite(
+        rows=args.rows,
+        flex_width=args.flex_width,
+        seed=args.seed,
+        repeat=args.repeat,
+        min_time=args.min_time,
+        name_filter=args.filter
+    ).run()
+    if args.out is not None:
+        with open(args.out, 'w') as out_file:
+            json.dump(results, out_file, indent=2, sort_keys=True)
+    if args.baseline is None:
+        return 0
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline['meta']['rows'] != args.rows or baseline['meta']['flex_width'] != args.flex_width:
+        print('warning: baseline was recorded with rows=%s flex_width=%s' % (
+            baseline['meta']['rows'], baseline['meta']['flex_width']
+        ))
+    rows, regressions = compare(results, baseline, args.threshold)
+    print()
+    print('%-60s %12s %12s %8s' % ('benchmark', 'baseline us', 'current us', 'ratio'))
+    for name, baseline_s, current_s, ratio in rows:
+        flag = '  REGRESSION' if ratio > 1 + args.threshold else ''
+        if 'error' in results['results'][name]:
+            flag = '  ERROR %s' % results['results'][name]['error']
+        print('%-60s %12.2f %12.2f %8.2f%s' % (name, baseline_s * 1e6, current_s * 1e6, ratio, flag))
+    if regressions:
+        print('%s benchmark(s) regressed by more than %.0f%%' % (len(regressions), args.threshold * 100))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
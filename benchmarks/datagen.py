@@ -0,0 +1,55 @@
+import random
+from datetime import date
+from datetime import timedelta
+
+from widgets import Widget
+
+_EPOCH = date(2015, 1, 1)
+_WORDS = ['spam', 'eggs', 'ham', 'bacon', 'cheese', 'sausage', 'beans', 'toast']
+
+
+def widget_name(i):
+    return 'widget-%08d' % i
+
+
+def _flex_value(rng, k):
+    kind = k % 4
+    if kind == 0:
+        return rng.randrange(0, 1000000)
+    if kind == 1:
+        return ' '.join(rng.choice(_WORDS) for _ in range(rng.randrange(1, 6)))
+    if kind == 2:
+        return [rng.random() for _ in range(rng.randrange(0, 8))]
+    return {'nested': rng.choice(_WORDS), 'weight': rng.random()}
+
+
+def widget_json_objs(count, flex_width=4, seed=0, start=0):
+    # each widget is drawn from its own seeded generator, so widget i comes out the same
+    # no matter how the rows are batched or where generation starts
+    for i in range(start, start + count):
+        rng = random.Random('%s:%s' % (seed, i))
+        created_date = _EPOCH + timedelta(days=rng.randrange(0, 2000))
+        json_obj = {
+            'name': widget_name(i),
+            'num_of_parts': rng.randrange(0, 10000),
+            'created_date': created_date.isoformat(),
+            'updated_date': (created_date + timedelta(days=rng.randrange(0, 400))).isoformat()
+        }
+        for k in range(flex_width):
+            json_obj['prop_%s' % k] = _flex_value(rng, k)
+        yield json_obj
+
+
+def widgets(count, flex_width=4, seed=0, start=0):
+    for json_obj in widget_json_objs(count, flex_width=flex_width, seed=seed, start=start):
+        yield Widget(**json_obj)
+
+
+def seed_store(widget_store, count, flex_width=4, seed=0, batch_size=10000):
+    for start in range(0, count, batch_size):
+        widget_store.put_widgets(list(widgets(
+            min(batch_size, count - start),
+            flex_width=flex_width,
+            seed=seed,
+            start=start
+        )))
@@ -0,0 +1,370 @@
+import argparse
+import http.client
+import json
+import os
+import queue
+import random
+import shutil
+import socket
+import statistics
+import subprocess  # nosec, only ever launches this interpreter or gunicorn with fixed args
+import sys
+import tempfile
+import threading
+import time
+
+from widgets import WidgetStore
+from benchmarks import datagen
+
+# starts N app worker processes against one CONNECT_STR db and drives an open loop of
+# mixed traffic at them. the app reads its settings (READ_WRITE_SPLIT, GROUP_COMMIT,
+# SQLITE_BUSY_TIMEOUT_MS, ...) from the environment, so export the deployment's
+# settings before running this. latencies are measured from each request's scheduled
+# start, so time spent queued behind a stalled server is counted rather than hidden
+
+OPS = ('read', 'write', 'query', 'bulk', 'delete')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve(port):
+    from werkzeug.serving import WSGIRequestHandler
+    from werkzeug.serving import make_server
+    import logging
+    import flaskapp
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+    make_server('127.0.0.1', port, flaskapp.app, threaded=True).serve_forever()
+
+
+class WorkerProcesses:
+
+    # each worker is a process on its own port, and the drivers spread requests over
+    # them round robin. with gunicorn installed, every worker is a single worker
+    # gunicorn, so requests go through the server production runs. one gunicorn with
+    # N workers on one port would spread them the way production does, but a scrape
+    # of /metrics there only reaches whichever worker accepts it, and the server's
+    # 'database is locked' count has to be summed over every worker
+
+    def __init__(self, workers, connect_str, use_gunicorn=None):
+        self.workers = workers
+        self.env = dict(os.environ, CONNECT_STR=connect_str)
+        if use_gunicorn is None:
+            use_gunicorn = shutil.which('gunicorn') is not None
+        self.use_gunicorn = use_gunicorn
+        self.ports = []
+        self.processes = []
+
+    def start(self):
+        cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        for _ in range(self.workers):
+            port = free_port()
+            self.ports.append(port)
+            if self.use_gunicorn:
+                args = ['gunicorn', '-w', '1', '-b', '127.0.0.1:%s' % port, 'flaskapp:app']
+            else:
+                args = [sys.executable, '-m', 'benchmarks.load', '--serve', str(port)]
+            self.processes.append(subprocess.Popen(args, env=self.env, cwd=cwd))  # nosec
+        for port in self.ports:
+            self._wait_until_up(port)
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+
+    def scrape_counter(self, metric_name):
+        # metrics are per process, so this sums every worker's
+        total = 0
+        for port in self.ports:
+            status, body = request(port, 'GET', '/metrics')
+            for line in body.decode('utf-8').splitlines():
+                if line.startswith(metric_name + ' ') or line.startswith(metric_name + '{'):
+                    total += float(line.rsplit(' ', 1)[1])
+        return total
+
+    def _wait_until_up(self, port, timeout=15):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                request(port, 'GET', '/metrics')
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError('worker on port %s did not come up' % port)
+
+
+def request(port, method, path, json_body=None, timeout=30):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        headers = {}
+        body = None
+        if json_body is not None:
+            body = json.dumps(json_body)
+            headers['Content-Type'] = 'application/json'
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+class LoadGenerator:
+
+    def __init__(self, ports, rows, mix, rate, duration, concurrency, retries, flex_width, seed):
+        self.ports = ports
+        self.rows = rows
+        self.ops = [op for op in OPS if mix.get(op, 0) > 0]
+        self.weights = [mix[op] for op in self.ops]
+        self.rate = rate
+        self.duration = duration
+        self.concurrency = concurrency
+        self.retries = retries
+        self.flex_width = flex_width
+        self.seed = seed
+        self.results = dict((op, {'latencies': [], 'errors': 0, 'statuses': {}}) for op in self.ops)
+        self.client_retries = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._scheduled = queue.Queue(maxsize=concurrency * 4)
+
+    def run(self):
+        drivers = [threading.Thread(target=self._drive, args=(i,), daemon=True) for i in range(self.concurrency)]
+        for driver in drivers:
+            driver.start()
+        rng = random.Random(self.seed)
+        start = time.monotonic()
+        i = 0
+        while True:
+            scheduled_at = start + i / self.rate
+            if scheduled_at - start >= self.duration:
+                break
+            delay = scheduled_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            op = rng.choices(self.ops, self.weights)[0]
+            try:
+                self._scheduled.put_nowait((op, scheduled_at, rng.randrange(1 << 30)))
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1  # the drivers are saturated, the target rate is not being met
+            i += 1
+        for _ in drivers:
+            self._scheduled.put(None)
+        for driver in drivers:
+            driver.join()
+        return time.monotonic() - start
+
+    def _drive(self, driver_index):
+        while True:
+            item = self._scheduled.get()
+            if item is None:
+                return
+            op, scheduled_at, op_seed = item
+            port = self.ports[op_seed % len(self.ports)]
+            method, path, json_body = self._build(op, random.Random(op_seed))
+            status = None
+            for attempt in range(self.retries + 1):
+                if attempt > 0:
+                    with self._lock:
+                        self.client_retries += 1
+                    time.sleep(0.01 * 2 ** attempt)
+                try:
+                    status, _ = request(port, method, path, json_body)
+                except OSError:
+                    status = 'connection error'
+                    continue
+                if status not in (500, 503):
+                    break
+            latency = time.monotonic() - scheduled_at
+            with self._lock:
+                result = self.results[op]
+                result['latencies'].append(latency)
+                result['statuses'][str(status)] = result['statuses'].get(str(status), 0) + 1
+                if status == 'connection error' or status >= 500:
+                    result['errors'] += 1
+
+    def _build(self, op, rng):
+        name = datagen.widget_name(rng.randrange(0, max(self.rows, 1)))
+        if op == 'read':
+            return 'GET', '/widgets/' + name, None
+        if op == 'write':
+            return 'PUT', '/widgets/' + name, {'name': name, 'num_of_parts': rng.randrange(0, 10000)}
+        if op == 'query':
+            low = rng.randrange(0, 9900)
+            return 'POST', '/widgets/query', [
+                {'predicate': 'between', 'variable': 'num_of_parts', 'constants': [low, low + 100]}
+            ]
+        if op == 'bulk':
+            start = rng.randrange(0, max(self.rows - 100, 1))
+            batch = list(datagen.widget_json_objs(100, flex_width=self.flex_width, seed=self.seed, start=start))
+            for json_obj in batch:
+                del json_obj['created_date'], json_obj['updated_date']
+            return 'POST', '/widgets/add', batch
+        return 'DELETE', '/widgets/' + name, None
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * p), len(sorted_values) - 1)]
+
+
+def summarise(load_generator, elapsed, wal_samples, server_busy_errors):
+    ops = {}
+    total = 0
+    for op, result in load_generator.results.items():
+        latencies = sorted(result['latencies'])
+        total += len(latencies)
+        ops[op] = {
+            'count': len(latencies),
+            'errors': result['errors'],
+            'statuses': result['statuses'],
+            'throughput_per_s': len(latencies) / elapsed,
+            'p50_ms': None if not latencies else percentile(latencies, 0.50) * 1000,
+            'p90_ms': None if not latencies else percentile(latencies, 0.90) * 1000,
+            'p99_ms': None if not latencies else percentile(latencies, 0.99) * 1000,
+            'max_ms': None if not latencies else latencies[-1] * 1000,
+            'mean_ms': None if not latencies else statistics.mean(latencies) * 1000
+        }
+    return {
+        'elapsed_s': elapsed,
+        'target_rate_per_s': load_generator.rate,
+        'achieved_rate_per_s': total / elapsed,
+        'dropped_for_saturation': load_generator.dropped,
+        'client_retries': load_generator.client_retries,
+        'server_sqlite_busy_errors': server_busy_errors,
+        'ops': ops,
+        'wal_bytes': wal_samples
+    }
+
+
+def print_summary(summary):
+    print('target %.1f req/s, achieved %.1f req/s over %.1fs, %s requests dropped with every driver busy' % (
+        summary['target_rate_per_s'],
+        summary['achieved_rate_per_s'],
+        summary['elapsed_s'],
+        summary['dropped_for_saturation']
+    ))
+    print('database is locked / busy errors: %s on the server, %s client retries' % (
+        int(summary['server_sqlite_busy_errors']),
+        summary['client_retries']
+    ))
+    print('%-8s %8s %8s %10s %10s %10s %10s %10s' % (
+        'op', 'count', 'errors', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'
+    ))
+    for op, stats in summary['ops'].items():
+        if stats['count'] == 0:
+            continue
+        print('%-8s %8s %8s %10.1f %10.2f %10.2f %10.2f %10.2f' % (
+            op, stats['count'], stats['errors'], stats['throughput_per_s'],
+            stats['p50_ms'], stats['p90_ms'], stats['p99_ms'], stats['max_ms']
+        ))
+    print('wal size over time (s, bytes): %s' % ', '.join('%.0f:%s' % sample for sample in summary['wal_bytes']))
+
+
+def parse_mix(mix_str):
+    mix = {}
+    for part in mix_str.split(','):
+        op, _, weight = part.partition('=')
+        if op.strip() not in OPS:
+            raise argparse.ArgumentTypeError('%s is not one of %s' % (op, ', '.join(OPS)))
+        mix[op.strip()] = float(weight)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.load',
+        description='drive mixed traffic at several app worker processes sharing one db'
+    )
+    parser.add_argument('--serve', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    parser.add_argument('--workers', type=int, default=4, help='app worker processes (default 4)')
+    parser.add_argument('--connect-str', default=None, help='db file to load (default: a fresh temporary db)')
+    parser.add_argument('--rows', type=int, default=10000, help='widgets to seed first (default 10000)')
+    parser.add_argument('--flex-width', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rate', type=float, default=200, help='target requests per second (default 200)')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of traffic (default 30)')
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent client connections (default 32)')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('read=60,write=20,query=15,bulk=5'),
+                        help='op weights, from %s (default read=60,write=20,query=15,bulk=5)' % ', '.join(OPS))
+    parser.add_argument('--retries', type=int, default=0, help='client retries of 500/503 responses (default 0)')
+    parser.add_argument('--gunicorn', dest='use_gunicorn', action='store_true', default=None)
+    parser.add_argument('--no-gunicorn', dest='use_gunicorn', action='store_false')
+    parser.add_argument('--out', default=None, help='write the summary as json to this file')
+    args = parser.parse_args(argv)
+
+    if args.serve is not None:
+        serve(args.serve)
+        return 0
+
+    tmp_dir = None
+    connect_str = args.connect_str
+    if connect_str is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        connect_str = os.path.join(tmp_dir.name, 'load.db')
+    try:
+        seed_if_empty(connect_str, args.rows, args.flex_width, args.seed)
+        summary = run_load(args, connect_str)
+    finally:
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+    print_summary(summary)
+    if args.out is not None:
+        with open(args.out, 'w') as out_file:
+            json.dump(summary, out_file, indent=2, sort_keys=True)
+    return 0
+
+
+def seed_if_empty(connect_str, rows, flex_width, seed):
+    widget_store = WidgetStore(connect_str)
+    try:
+        if rows > 0 and len(widget_store.get_all_widgets(limit=1)) == 0:
+            print('seeding %s widgets' % rows)
+            datagen.seed_store(widget_store, rows, flex_width=flex_width, seed=seed)
+    finally:
+        widget_store.close()
+
+
+def run_load(args, connect_str):
+    workers = WorkerProcesses(args.workers, connect_str, use_gunicorn=args.use_gunicorn)
+    workers.start()
+    busy_errors_before = workers.scrape_counter('widgets_sqlite_busy_errors_total')
+    wal_samples = []
+    sampling = threading.Event()
+
+    def sample_wal():
+        start = time.monotonic()
+        while not sampling.wait(1):
+            try:
+                wal_samples.append((time.monotonic() - start, os.path.getsize(connect_str + '-wal')))
+            except OSError:
+                wal_samples.append((time.monotonic() - start, 0))
+
+    sampler = threading.Thread(target=sample_wal, daemon=True)
+    sampler.start()
+    try:
+        load_generator = LoadGenerator(
+            workers.ports, args.rows, args.mix, args.rate, args.duration,
+            args.concurrency, args.retries, args.flex_width, args.seed
+        )
+        print('driving %s req/s at %s %s workers for %ss' % (
+            args.rate, args.workers, 'gunicorn' if workers.use_gunicorn else 'werkzeug', args.duration
+        ))
+        elapsed = load_generator.run()
+        server_busy_errors = workers.scrape_counter('widgets_sqlite_busy_errors_total') - busy_errors_before
+    finally:
+        sampling.set()
+        sampler.join()
+        workers.stop()
+    return summarise(load_generator, elapsed, wal_samples, server_busy_errors)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,222 @@
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+import bulkingest
+import metrics
+import widgets
+from widgets import Widget
+from widgets import WidgetStore
+from benchmarks import datagen
+
+# (predicate, variable, constants, limit) for every cond_spec predicate. the seeded
+# num_of_parts values are uniform over 0..9999, so the range predicates below select
+# about 1% of the rows. predicates that match nearly every row are benchmarked as a
+# top 100 by name instead, so the result size stays fixed as rows grow
+COND_SPEC_CASES = [
+    ('isnull', 'name', [], None),
+    ('not isnull', 'num_of_parts', [], 100),
+    ('eq', 'name', [datagen.widget_name(7)], None),
+    ('ne', 'name', [datagen.widget_name(7)], 100),
+    ('lt', 'num_of_parts', [100], None),
+    ('gt', 'num_of_parts', [9899], None),
+    ('le', 'num_of_parts', [99], None),
+    ('ge', 'num_of_parts', [9900], None),
+    ('like', 'name', ['widget-000001%'], None),
+    ('not like', 'name', ['widget-000001%'], 100),
+    ('between', 'num_of_parts', [5000, 5099], None),
+    ('not between', 'num_of_parts', [100, 9899], None),
+]
+
+
+def measure(fn, repeat=5, min_time=0.2):
+    # doubles the number of calls per timing until one timing takes min_time
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        if time.perf_counter() - start >= min_time:
+            break
+        number *= 2
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        timings.append((time.perf_counter() - start) / number)
+    return {
+        'median_s': statistics.median(timings),
+        'min_s': min(timings),
+        'number': number,
+        'repeat': repeat
+    }
+
+
+class BenchmarkSuite:
+
+    def __init__(self, rows=1000, flex_width=4, seed=0, repeat=5, min_time=0.2, name_filter=None):
+        self.rows = rows
+        self.flex_width = flex_width
+        self.seed = seed
+        self.repeat = repeat
+        self.min_time = min_time
+        self.name_filter = name_filter
+        self.rng = random.Random(seed)
+
+    def run(self, log=print):
+        saved_connect_str = os.environ.get('CONNECT_STR')
+        try:
+            return self._run(log)
+        finally:
+            if saved_connect_str is None:
+                os.environ.pop('CONNECT_STR', None)
+            else:
+                os.environ['CONNECT_STR'] = saved_connect_str
+
+    def _run(self, log):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            connect_str = os.path.join(tmp_dir, 'bench.db')
+            widget_store = WidgetStore(connect_str)
+            log('seeding %s widgets (flex width %s, seed %s)' % (self.rows, self.flex_width, self.seed))
+            datagen.seed_store(widget_store, self.rows, flex_width=self.flex_width, seed=self.seed)
+            results = {}
+            for name, fn in self._benchmarks(widget_store, connect_str):
+                if self.name_filter is not None and self.name_filter not in name:
+                    continue
+                try:
+                    results[name] = measure(fn, repeat=self.repeat, min_time=self.min_time)
+                    log('%-60s %12.2f us' % (name, results[name]['median_s'] * 1e6))
+                except Exception as ex:
+                    results[name] = {'error': '%s: %s' % (type(ex).__name__, ex)}
+                    log('%-60s %s' % (name, results[name]['error']))
+            widget_store.close()
+        return {
+            'meta': {
+                'rows': self.rows,
+                'flex_width': self.flex_width,
+                'seed': self.seed,
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S')
+            },
+            'results': results
+        }
+
+    def _benchmarks(self, widget_store, connect_str):
+        yield from self._micro_benchmarks(widget_store)
+        yield from self._store_benchmarks(widget_store)
+        yield from self._endpoint_benchmarks(connect_str)
+
+    def _sample_json_obj(self):
+        return next(datagen.widget_json_objs(1, flex_width=self.flex_width, seed=self.seed, start=self.rows // 2))
+
+    def _random_name(self):
+        return datagen.widget_name(self.rng.randrange(0, max(self.rows, 1)))
+
+    def _micro_benchmarks(self, widget_store):
+        json_obj = self._sample_json_obj()
+        widget = Widget.from_json_obj(json_obj)
+        row = widget_store._widget_to_row(widget) + (1,)  # a stored row also has its version
+        cond_spec = [{'predicate': p, 'variable': v, 'constants': c} for p, v, c, _ in COND_SPEC_CASES]
+        yield 'micro.Widget.from_json_obj', lambda: Widget.from_json_obj(json_obj)
+        yield 'micro.Widget.to_json_obj', widget.to_json_obj
+        yield 'micro.WidgetStore._row_to_widget', lambda: widget_store._row_to_widget(row)
+        yield 'micro.WidgetStore._widget_to_row', lambda: widget_store._widget_to_row(widget)
+        # the validators the store uses, which check their schema once when they're built
+        yield 'micro.widgets._validate_widget_schema', lambda: widgets._validate_widget_schema(json_obj)
+        yield 'micro.widgets._validate_cond_spec_schema', lambda: widgets._validate_cond_spec_schema(cond_spec)
+        ingest_batch = list(datagen.widget_json_objs(1000, flex_width=self.flex_width, seed=self.seed + 3))
+        yield 'micro.bulkingest.encode_widget_rows[1000]', lambda: bulkingest.encode_widget_rows(ingest_batch)
+
+    def _store_benchmarks(self, widget_store):
+        # the same 100 widgets are rewritten on every call after the first, which is
+        # the steady state of a client that re-sends its widgets
+        batch = list(datagen.widgets(100, flex_width=self.flex_width, seed=self.seed + 1, start=self.rows))
+        yield 'store.put_widgets[100]', lambda: widget_store.put_widgets(batch)
+        yield 'store.get_widget_by_name', lambda: widget_store.get_widget_by_name(self._random_name())
+        for predicate, variable, constants, limit in COND_SPEC_CASES:
+            cond_spec = [{'predicate': predicate, 'variable': variable, 'constants': constants}]
+            yield (
+                'store.get_widgets_by_cond_spec[%s %s%s]' % (
+                    variable, predicate, '' if limit is None else ', limit %s' % limit
+                ),
+                lambda cond_spec=cond_spec, limit=limit: widget_store.get_widgets_by_cond_spec(cond_spec, limit=limit)
+            )
+        top_parts = {
+            'where': {
+                'any': [
+                    {'predicate': 'like', 'variable': 'name', 'constants': ['widget-000001%']},
+                    {'predicate': 'lt', 'variable': 'num_of_parts', 'constants': [100]}
+                ]
+            },
+            'order_by': [{'variable': 'num_of_parts', 'direction': 'desc'}],
+            'limit': 10
+        }
+        yield (
+            'store.get_widgets_by_cond_spec[any(name like, num_of_parts lt), order by num_of_parts desc, limit 10]',
+            lambda: widget_store.get_widgets_by_cond_spec(top_parts)
+        )
+
+    def _endpoint_benchmarks(self, connect_str):
+        os.environ['CONNECT_STR'] = connect_str
+        import flaskapp  # reads CONNECT_STR at import
+        client = flaskapp.app.test_client()
+        add_batch = list(datagen.widget_json_objs(10, flex_width=self.flex_width, seed=self.seed + 2, start=self.rows))
+        put_json_obj = self._sample_json_obj()
+        query = [{'predicate': 'lt', 'variable': 'num_of_parts', 'constants': [100]}]
+        patch = {'num_of_parts': 1}
+        requests = [
+            ('GET /widgets?limit=100', lambda: client.get('/widgets?limit=100')),
+            ('GET /widgets/<name>', lambda: client.get('/widgets/' + self._random_name())),
+            ('POST /widgets/query', lambda: client.post('/widgets/query', json=query)),
+            ('POST /widgets/add[10]', lambda: client.post('/widgets/add', json=add_batch)),
+            ('PUT /widgets/<name>', lambda: client.put('/widgets/' + put_json_obj['name'], json=put_json_obj)),
+            ('PATCH /widgets/<name>', lambda: client.patch('/widgets/' + put_json_obj['name'], json=patch)),
+        ]
+        for name, send in requests:
+            yield 'http.' + name, self._checked(send)
+        # the same reads again with the metrics timers off, to keep an eye on their overhead
+        for name, send in requests[:3]:
+            yield 'http.' + name + '[metrics off]', self._without_metrics(self._checked(send))
+
+    def _checked(self, send):
+        def checked_send():
+            response = send()
+            if response.status_code >= 400:
+                raise RuntimeError('status %s' % response.status_code)
+        return checked_send
+
+    def _without_metrics(self, fn):
+        def fn_without_metrics():
+            was_enabled = metrics.enabled
+            metrics.enabled = False
+            try:
+                fn()
+            finally:
+                metrics.enabled = was_enabled
+        return fn_without_metrics
+
+
+def compare(current, baseline, threshold):
+    # returns (rows, regressions), each row is (name, baseline s, current s, ratio). a
+    # benchmark that ran in the baseline but errors now is a regression, with an infinite
+    # current time. one missing from the current run, e.g. filtered out, is skipped
+    rows = []
+    regressions = []
+    for name, baseline_result in sorted(baseline['results'].items()):
+        current_result = current['results'].get(name)
+        if current_result is None or 'median_s' not in baseline_result:
+            continue
+        current_s = current_result.get('median_s', float('inf'))
+        ratio = current_s / baseline_result['median_s']
+        row = (name, baseline_result['median_s'], current_s, ratio)
+        rows.append(row)
+        if ratio > 1 + threshold:
+            regressions.append(row)
+    return rows, regressions
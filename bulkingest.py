@@ -0,0 +1,117 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from widgets import Widget
+from widgets import WidgetStore
+
+# bulk writes validate every widget and encode it into the row it's stored as. a large
+# payload is split into chunks that a pool of worker processes validates and encodes,
+# so several cores work on it, and the store writes the encoded chunks in input order,
+# in one transaction, as they come back. a payload of fewer than BULK_INGEST_MIN_ITEMS
+# widgets, or any payload when the pool would have fewer than two workers, is encoded
+# inline. so is whatever is left of a payload when a worker dies, and the broken pool
+# is dropped so that the next large payload starts a new one
+
+_ingest_executor = None
+_ingest_executor_lock = threading.Lock()
+
+# without BULK_INGEST_WORKERS, at most this many per app process
+DEFAULT_MAX_WORKERS = 4
+
+
+def default_workers():
+    # every app process gets its own pool, so the cores are shared out between the
+    # WEB_CONCURRENCY app processes (gunicorn's own setting for how many it runs). a
+    # larger pool has to be asked for with BULK_INGEST_WORKERS
+    web_workers = max(int(os.getenv('WEB_CONCURRENCY', '1')), 1)
+    return min((os.cpu_count() or 1) // web_workers, DEFAULT_MAX_WORKERS)
+
+
+def get_ingest_executor():
+    # None with fewer than two workers, when chunks would only queue up for one core
+    global _ingest_executor
+    workers = int(os.getenv('BULK_INGEST_WORKERS', str(default_workers())))
+    if workers < 2:
+        return None
+    with _ingest_executor_lock:
+        if _ingest_executor is None:
+            # spawned rather than forked, since forking a process with threads running
+            # can copy a lock some thread holds into a child that never gets it back
+            _ingest_executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+    return _ingest_executor
+
+
+def _discard_broken_executor(executor):
+    global _ingest_executor
+    with _ingest_executor_lock:
+        if _ingest_executor is executor:
+            _ingest_executor = None
+    executor.shutdown(wait=False)
+
+
+def encode_widget_rows(json_objs, min_items=None, chunk_size=None, executor=None):
+    # rows for WidgetStore.put_widget_rows and replace_all_widget_rows, in input order.
+    # the first invalid widget in input order raises the exception Widget.from_json_obj
+    # raises for it, exactly as inline encoding would. inline, that's before anything is
+    # written. otherwise it's while the rows are consumed, which rolls the write back
+    if min_items is None:
+        min_items = int(os.getenv('BULK_INGEST_MIN_ITEMS', '10000'))
+    if chunk_size is None:
+        chunk_size = int(os.getenv('BULK_INGEST_CHUNK_SIZE', '2000'))
+    if len(json_objs) >= min_items and executor is None:
+        executor = get_ingest_executor()
+    if len(json_objs) < min_items or executor is None:
+        return [_encode(json_obj) for json_obj in json_objs]
+    try:
+        futures = [
+            executor.submit(_encode_chunk, json_objs[start:start + chunk_size])
+            for start in range(0, len(json_objs), chunk_size)
+        ]
+    except BrokenProcessPool:
+        _discard_broken_executor(executor)
+        return [_encode(json_obj) for json_obj in json_objs]
+    return _rows_in_order(json_objs, futures, chunk_size, executor)
+
+
+def _rows_in_order(json_objs, futures, chunk_size, executor):
+    try:
+        for chunk_index, future in enumerate(futures):
+            try:
+                rows, failed_index = future.result()
+            except BrokenProcessPool:
+                _discard_broken_executor(executor)
+                for json_obj in json_objs[chunk_index * chunk_size:]:
+                    yield _encode(json_obj)
+                return
+            yield from rows
+            if failed_index is not None:
+                # exceptions like jsonschema's ValidationError can't be pickled back
+                # from the worker, so the widget is encoded again here to raise it
+                index = chunk_index * chunk_size + failed_index
+                _encode(json_objs[index])
+                raise RuntimeError('widget %s only failed to encode in a worker process' % index)
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def _encode_chunk(json_objs):
+    # runs in a worker process. -> (the rows up to the first invalid widget, its index
+    # in the chunk or None)
+    rows = []
+    for index, json_obj in enumerate(json_objs):
+        try:
+            rows.append(_encode(json_obj))
+        except Exception:
+            return rows, index
+    return rows, None
+
+
+def _encode(json_obj):
+    return WidgetStore._encode_widget(Widget.from_json_obj(json_obj))
@@ -0,0 +1,201 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+from widgets import WidgetStore
+from widgets import StoreUnavailableError
+
+
+class ReaderPool:
+
+    def __init__(self, connect_str, size=None, acquire_timeout_s=None):
+        if size is None:
+            size = int(os.getenv('READER_POOL_SIZE', '4'))
+        if acquire_timeout_s is None:
+            acquire_timeout_s = float(os.getenv('READER_POOL_TIMEOUT_S', '5'))
+        if size < 1:
+            raise ValueError('reader pool size must be at least 1, not %s' % size)
+        self.connect_str = connect_str
+        self.size = size
+        self.acquire_timeout = acquire_timeout_s
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                return WidgetStore(connect_str=self.connect_str, check_same_thread=False, read_only=True)
+        # every reader is out, so this waits for one to be released, but only so long:
+        # a pool that's exhausted for good, e.g. by a leak, mustn't hang every request
+        try:
+            return self._idle.get(timeout=self.acquire_timeout)
+        except queue.Empty:
+            raise StoreUnavailableError(
+                'no reader connection was released within %ss' % self.acquire_timeout
+            )
+
+    def release(self, widget_store):
+        if widget_store.conn.in_transaction:
+            widget_store.conn.rollback()
+        if self._closed:
+            widget_store.close()
+        else:
+            self._idle.put(widget_store)
+
+    @contextmanager
+    def reader(self):
+        widget_store = self.acquire()
+        try:
+            yield widget_store
+        finally:
+            self.release(widget_store)
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'opened': self._opened,
+            'idle': self._idle.qsize()
+        }
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class SerializedWriter:
+
+    # the one read-write connection of the process. calls are serialised here rather
+    # than left to contend on sqlite's write lock
+
+    def __init__(self, connect_str):
+        self._widget_store = WidgetStore(connect_str=connect_str, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._widget_store.conn.execute('PRAGMA journal_mode=WAL')
+            self._widget_store.conn.execute('PRAGMA synchronous=NORMAL')
+
+    def get_widget_by_name(self, name):
+        with self._lock:
+            return self._widget_store.get_widget_by_name(name)
+
+    def put_widget(self, widget, if_version=None):
+        with self._lock:
+            return self._widget_store.put_widget(widget, if_version)
+
+    def patch_widget(self, name, patch, if_version=None):
+        with self._lock:
+            return self._widget_store.patch_widget(name, patch, if_version)
+
+    def put_widgets(self, widgets):
+        with self._lock:
+            return self._widget_store.put_widgets(widgets)
+
+    def replace_all_widgets(self, widgets):
+        with self._lock:
+            return self._widget_store.replace_all_widgets(widgets)
+
+    def put_widget_rows(self, rows, stored_dates=None):
+        with self._lock:
+            return self._widget_store.put_widget_rows(rows, stored_dates)
+
+    def replace_all_widget_rows(self, rows, stored_dates=None):
+        with self._lock:
+            return self._widget_store.replace_all_widget_rows(rows, stored_dates)
+
+    def delete_widget_by_name(self, name, if_version=None):
+        with self._lock:
+            self._widget_store.delete_widget_by_name(name, if_version)
+
+    def delete_all_widgets(self):
+        with self._lock:
+            self._widget_store.delete_all_widgets()
+
+    def delete_widgets_by_cond_spec(self, cond_spec):
+        with self._lock:
+            self._widget_store.delete_widgets_by_cond_spec(cond_spec)
+
+    def checkpoint(self, mode='PASSIVE'):
+        if mode not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+            raise ValueError('%s is not a wal checkpoint mode' % mode)
+        with self._lock:
+            return self._widget_store.conn.execute('PRAGMA wal_checkpoint(%s)' % mode).fetchone()
+
+    def close(self):
+        with self._lock:
+            self._widget_store.close()
+
+
+class CheckpointManager:
+
+    # the automatic checkpoint only ever runs PASSIVE, which a steady stream of readers
+    # can starve. past the size limit, escalate to TRUNCATE: it waits out the current
+    # readers (bounded by the busy timeout) and then resets the wal file
+
+    def __init__(self, writer, wal_path, interval_s=None, size_limit_bytes=None):
+        if interval_s is None:
+            interval_s = float(os.getenv('WAL_CHECKPOINT_INTERVAL_S', '5'))
+        if size_limit_bytes is None:
+            size_limit_bytes = int(os.getenv('WAL_SIZE_LIMIT_BYTES', str(64 * 1024 * 1024)))
+        self.writer = writer
+        self.wal_path = wal_path
+        self.interval_s = interval_s
+        self.size_limit_bytes = size_limit_bytes
+        self.last_result = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='wal-checkpointer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def wal_size(self):
+        try:
+            return os.path.getsize(self.wal_path)
+        except OSError:
+            return 0
+
+    def checkpoint_once(self):
+        mode = 'TRUNCATE' if self.wal_size() > self.size_limit_bytes else 'PASSIVE'
+        self.last_result = (mode,) + tuple(self.writer.checkpoint(mode))
+        return self.last_result
+
+    def _run(self):
+        while not self._stopped.wait(self.interval_s):
+            try:
+                self.checkpoint_once()
+            except Exception:  # nosec, a failed checkpoint is retried on the next tick
+                pass
+
+
+class ReadWriteSplit:
+
+    def __init__(self, connect_str=None, reader_pool_size=None):
+        connect_str = connect_str if connect_str is not None else os.getenv('CONNECT_STR')
+        if connect_str == ':memory:' or connect_str.startswith('file:'):
+            raise ValueError('read/write split needs a plain db file path, not %s' % connect_str)
+        self.connect_str = connect_str
+        # the writer goes first, it creates the table and switches the db over to wal
+        self.writer = SerializedWriter(connect_str)
+        self.readers = ReaderPool(connect_str, size=reader_pool_size)
+        self.checkpointer = CheckpointManager(self.writer, connect_str + '-wal')
+        self.checkpointer.start()
+
+    def close(self):
+        self.checkpointer.stop()
+        self.readers.close()
+        self.writer.close()
@@ -1,5 +1,8 @@
+import hmac
 import os
+import sqlite3
 import sys
+import threading
 from datetime import datetime
 
 from flask import Flask
@@ -12,54 +15,372 @@ import jsonschema
 
 from widgets import WidgetStore
 from widgets import Widget
+from widgets import VersionMismatchError
+from widgets import StoreUnavailableError
+from widgets import write_version
+from shards import ShardedWidgetStore
+from shards import sharded_write_version
+from groupcommit import GroupCommitWriter
+from connpool import ReadWriteSplit
+import admission
+import bulkingest
+import metrics
+import slowlog
+import profiling
+import querycache
 
-if os.getenv('CONNECT_STR', None) is None:
-    print('must define CONNECT_STR env variable before starting server')
+if os.getenv('CONNECT_STR', None) is None and os.getenv('SHARD_CONNECT_STRS', None) is None:
+    print('must define CONNECT_STR or SHARD_CONNECT_STRS env variable before starting server')
     sys.exit()
 
 app = Flask(__name__)
 
 
+def get_metrics_route(environ):
+    # the url rule flask matched, read off its request as the response starts (flask
+    # unsets it once the request is torn down), so no hook has to run on every request
+    url_rule = getattr(environ.get('werkzeug.request'), 'url_rule', None)
+    return None if url_rule is None else url_rule.rule
+
+
+app.wsgi_app = metrics.RequestMetricsMiddleware(app.wsgi_app, route_of=get_metrics_route)
+
+_group_commit_writer = None
+_read_write_split = None
+_admission_controller = admission.AdmissionController() if admission.enabled else None
+_query_cache = querycache.QueryResultCache() if querycache.enabled else None
+_process_stores_lock = threading.Lock()
+
+
+def get_read_write_split():
+    # with READ_WRITE_SPLIT=1 the process keeps one wal mode writer connection and a
+    # pool of read only connections, instead of one read-write connection per request
+    global _read_write_split
+    if os.getenv('READ_WRITE_SPLIT', '0') != '1' or os.getenv('SHARD_CONNECT_STRS', None) is not None:
+        return None
+    if _read_write_split is None:
+        with _process_stores_lock:
+            if _read_write_split is None:
+                _read_write_split = ReadWriteSplit()
+    return _read_write_split
+
+
 def get_widget_store():
+    read_write_split = get_read_write_split()
+    if read_write_split is not None:
+        return read_write_split.writer
     widget_store = getattr(g, '_widget_store', None)
     if widget_store is None:
-        widget_store = g._database = WidgetStore()
+        if os.getenv('SHARD_CONNECT_STRS', None) is not None:
+            widget_store = g._widget_store = ShardedWidgetStore()
+        else:
+            widget_store = g._widget_store = WidgetStore()
     return widget_store
 
 
+def get_reader_store():
+    read_write_split = get_read_write_split()
+    if read_write_split is None:
+        return get_widget_store()
+    reader_store = getattr(g, '_reader_store', None)
+    if reader_store is None:
+        reader_store = g._reader_store = read_write_split.readers.acquire()
+    return reader_store
+
+
+def get_write_version():
+    # read without the request's store, so a query cache hit doesn't open one
+    if os.getenv('SHARD_CONNECT_STRS', None) is not None:
+        return sharded_write_version()
+    return write_version(os.getenv('CONNECT_STR'))
+
+
+def get_point_writer():
+    # single widget PUT/DELETE can be group committed, everything else writes through
+    # the request's own store
+    global _group_commit_writer
+    if os.getenv('GROUP_COMMIT', '0') != '1' or os.getenv('SHARD_CONNECT_STRS', None) is not None:
+        return get_widget_store()
+    if _group_commit_writer is None:
+        with _process_stores_lock:
+            if _group_commit_writer is None:
+                _group_commit_writer = GroupCommitWriter()
+    return _group_commit_writer
+
+
+def log_unexpected_exception():
+    ex = sys.exc_info()[1]
+    if isinstance(ex, sqlite3.OperationalError) and ('locked' in str(ex) or 'busy' in str(ex)):
+        metrics.SQLITE_BUSY_ERRORS.inc()
+    app.logger.exception('Unexpected exception')
+
+
+def get_json_body():
+    with metrics.phase('json_parse'):
+        return request.get_json()
+
+
+def set_write_count_headers(res, written, total):
+    # bulk writes skip widgets that are unchanged apart from their dates
+    res.headers['X-Widgets-Written'] = str(written)
+    res.headers['X-Widgets-Skipped'] = str(total - written)
+
+
+def set_stored_dates(widget_json_objs, stored_dates):
+    # a bulk write keeps the stored dates of the widgets it skips, and the created date
+    # of the ones it changes, so the response echoes the dates the store kept
+    for widget_json_obj in widget_json_objs:
+        created_date, updated_date = stored_dates[widget_json_obj['name']]
+        widget_json_obj.update({
+            "created_date": created_date,
+            "updated_date": updated_date
+        })
+
+
+def version_etag(version):
+    return '"%s"' % version
+
+
+def get_if_match_version():
+    # If-Match holds the ETag of the version the client last read, and the write is
+    # folded into a statement that only matches that version. '*' matches any version,
+    # so it adds no condition. only a single strong ETag can be matched, anything else
+    # gets version 0, which no row ever has
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+    etags = if_match.as_set()
+    if len(etags) != 1 or len(if_match.as_set(include_weak=True)) != 1:
+        return 0
+    etag = etags.pop()
+    return int(etag) if etag.isdigit() else 0
+
+
+def version_mismatch_error():
+    return (
+        jsonify({
+            "error class": "widget version does not match If-Match",
+            "uri": request.path
+        }),
+        412
+    )
+
+
+def store_unavailable_error(ex):
+    # shaped like an admission control 503, which it's a late form of
+    res = jsonify({
+        "error class": "server overloaded",
+        "uri": request.path,
+        "cause": str(ex)
+    })
+    res.status_code = 503
+    res.headers['Retry-After'] = os.getenv('ADMISSION_RETRY_AFTER_S', '1')
+    return res
+
+
+def has_valid_admin_token():
+    admin_token = os.getenv('ADMIN_TOKEN', None)
+    # compared as bytes, since compare_digest only takes ascii strs
+    return admin_token is not None and hmac.compare_digest(
+        request.headers.get('X-Admin-Token', '').encode('utf-8'),
+        admin_token.encode('utf-8')
+    )
+
+
+def admin_token_error():
+    # admin endpoints only exist when ADMIN_TOKEN is set, and then require it in X-Admin-Token
+    if os.getenv('ADMIN_TOKEN', None) is None:
+        abort(404)
+    if not has_valid_admin_token():
+        return (
+            jsonify({
+                "error class": "admin token missing or invalid",
+                "uri": request.path
+            }),
+            403
+        )
+    return None
+
+
+def collect_pool_stats():
+    samples = []
+    if _read_write_split is not None:
+        for stat, value in _read_write_split.readers.stats().items():
+            samples.append((('reader_pool', stat), value))
+    if _group_commit_writer is not None:
+        samples.append((('group_commit_writer', 'queue_depth'), _group_commit_writer.queue_depth()))
+    return samples
+
+
+metrics.REGISTRY.register(metrics.Gauge(
+    'widgets_pool_stats',
+    'connection pool and writer queue stats of this process',
+    ('pool', 'stat'),
+    collect_pool_stats
+))
+
+if _admission_controller is not None:
+    metrics.REGISTRY.register(metrics.Gauge(
+        'widgets_admission',
+        'admission control capacity, units in use, and admitted and queued requests per endpoint class',
+        ('stat', 'endpoint_class'),
+        _admission_controller.stats
+    ))
+
+if _query_cache is not None:
+    metrics.REGISTRY.register(metrics.Gauge(
+        'widgets_query_cache',
+        'query result cache hits, misses, hit ratio, size and evictions',
+        ('stat',),
+        _query_cache.stats
+    ))
+
+# (method, url rule) -> admission control endpoint class. anything not listed, like
+# /metrics and the admin endpoints, is never shed
+ADMISSION_CLASSES = {
+    ('GET', '/widgets'): admission.LIST,
+    ('PUT', '/widgets'): admission.BULK_WRITE,
+    ('DELETE', '/widgets'): admission.BULK_DELETE,
+    ('POST', '/widgets/query'): admission.QUERY,
+    ('POST', '/widgets/add'): admission.BULK_WRITE,
+    ('POST', '/widgets/delete'): admission.BULK_DELETE,
+    ('GET', '/widgets/<widget_name>'): admission.POINT_READ,
+    ('PUT', '/widgets/<widget_name>'): admission.POINT_WRITE,
+    ('PATCH', '/widgets/<widget_name>'): admission.POINT_WRITE,
+    ('DELETE', '/widgets/<widget_name>'): admission.POINT_WRITE
+}
+
+
+def estimate_request_cost(endpoint_class):
+    # costs are estimates made before the request runs: rows from the cached row count
+    # estimate and the cond_spec, bytes from the request's content length
+    if endpoint_class in (admission.POINT_READ, admission.POINT_WRITE):
+        return 1
+    row_count = _admission_controller.row_count(lambda: get_reader_store().estimate_row_count())
+    limit = request.args.get('limit', type=int)
+    if request.url_rule.rule in ('/widgets/query', '/widgets/delete'):
+        try:
+            rows = admission.estimate_cond_spec_rows(request.get_json(silent=True), row_count)
+        except (AttributeError, KeyError, TypeError, RecursionError):
+            return 1  # left for the handler to reject
+    elif request.method == 'POST':  # /widgets/add only writes what it was sent
+        rows = 0
+    else:  # GET, PUT and DELETE /widgets read, replace or drop every row
+        rows = row_count
+    if limit is not None and request.method != 'PUT':
+        rows = min(limit, rows)
+    cost = _admission_controller.rows_cost(rows)
+    if endpoint_class == admission.BULK_WRITE:
+        cost += _admission_controller.bytes_cost(request.content_length or 0)
+    return cost
+
+
+PAGED_ROUTES = (('GET', '/widgets'), ('POST', '/widgets/query'))
+
+
+@app.before_request
+def check_page_args():
+    # a single store would read a negative limit or offset the way sqlite does, as no
+    # limit or no offset, but the sharded merge can't page that way, so every
+    # deployment turns them away
+    if request.url_rule is None or (request.method, request.url_rule.rule) not in PAGED_ROUTES:
+        return None
+    limit = request.args.get('limit', type=int)
+    if (limit is not None and limit < 0) or request.args.get('offset', 0, type=int) < 0:
+        return (
+            jsonify({
+                "error class": "invalid paging",
+                "uri": request.path,
+                "cause": "limit and offset must not be negative"
+            }),
+            400
+        )
+    return None
+
+
+@app.before_request
+def admit_request():
+    if _admission_controller is None or request.url_rule is None:
+        return None
+    endpoint_class = ADMISSION_CLASSES.get((request.method, request.url_rule.rule), None)
+    if endpoint_class is None:
+        return None
+    try:
+        cost = estimate_request_cost(endpoint_class)
+    except StoreUnavailableError as ex:
+        return store_unavailable_error(ex)
+    ticket = _admission_controller.admit(endpoint_class, cost)
+    if ticket is None:
+        res = jsonify({
+            "error class": "server overloaded",
+            "uri": request.path,
+            "cause": "too many %s requests in progress, retry later" % endpoint_class.replace('_', ' ')
+        })
+        res.status_code = 503
+        res.headers['Retry-After'] = str(_admission_controller.retry_after_s)
+        return res
+    g._admission_ticket = ticket
+    return None
+
+
+@app.teardown_request
+def release_admission(exception):
+    ticket = getattr(g, '_admission_ticket', None)
+    if ticket is not None:
+        g._admission_ticket = None
+        _admission_controller.release(ticket)
+
+
+if profiling.enabled and os.getenv('ADMIN_TOKEN', None) is not None:
+    profiling.install(app, has_valid_admin_token)
+
+
 @app.teardown_appcontext
 def teardown_widget_store(exception):
     widget_store = getattr(g, '_widget_store', None)
     if widget_store is not None:
         widget_store.close()
+    reader_store = getattr(g, '_reader_store', None)
+    if reader_store is not None:
+        get_read_write_split().readers.release(reader_store)
 
 
 @app.route('/widgets', methods=['GET'])
 def get_widgets():
     try:
-        widgets = get_widget_store().get_all_widgets()
-        return jsonify([
-            widget.to_json_obj()
-            for widget in widgets
-        ])
+        widgets = get_reader_store().get_all_widgets(
+            limit=request.args.get('limit', type=int),
+            offset=request.args.get('offset', 0, type=int)
+        )
+        with metrics.phase('jsonify'):
+            return jsonify([
+                widget.to_json_obj()
+                for widget in widgets
+            ])
+    except StoreUnavailableError as ex:
+        return store_unavailable_error(ex)
     except Exception:
-        app.logger.exception('Unexpected exception')
+        log_unexpected_exception()
         abort(500)
 
 
 @app.route('/widgets', methods=['PUT'])
 def put_widgets():
     try:
-        new_widget_json_objs = request.get_json()
+        new_widget_json_objs = get_json_body()
         for new_widget_json_obj in new_widget_json_objs:
             new_widget_json_obj.update({
                 "updated_date": datetime.today().strftime("%Y-%m-%d"),
                 "created_date": datetime.today().strftime("%Y-%m-%d")
             })
-        new_widgets = [Widget.from_json_obj(w) for w in new_widget_json_objs]
-        get_widget_store().delete_all_widgets()
-        get_widget_store().put_widgets(new_widgets)
-        return jsonify(new_widget_json_objs), 200
+        rows = bulkingest.encode_widget_rows(new_widget_json_objs)
+        stored_dates = {}
+        written = get_widget_store().replace_all_widget_rows(rows, stored_dates)
+        set_stored_dates(new_widget_json_objs, stored_dates)
+        with metrics.phase('jsonify'):
+            res = jsonify(new_widget_json_objs)
+        set_write_count_headers(res, written, len(new_widget_json_objs))
+        return res, 200
     except jsonschema.exceptions.ValidationError as ve:
         return (
             jsonify({
@@ -70,7 +391,7 @@ def put_widgets():
             400
         )
     except Exception:
-        app.logger.exception('Unexpected exception')
+        log_unexpected_exception()
         abort(500)
 
 
@@ -82,19 +403,36 @@ def delete_widgets():
         del res.headers['Content-Type']
         return res
     except Exception:
-        app.logger.exception('Unexpected exception')
+        log_unexpected_exception()
         abort(500)
 
 
 @app.route('/widgets/query', methods=['POST'])
 def query_widgets():
     try:
-        cond_spec = request.get_json()
-        widgets = get_widget_store().get_widgets_by_cond_spec(cond_spec)
-        return jsonify([
-            widget.to_json_obj()
-            for widget in widgets
-        ])
+        cond_spec = get_json_body()
+        limit = request.args.get('limit', type=int)
+        offset = request.args.get('offset', 0, type=int)
+        if _query_cache is not None:
+            # the spec is validated before its cache key is built, which walks it
+            # recursively, so a spec nested too deep gets its 400 rather than a
+            # RecursionError. the version is read before the query runs, so a write that
+            # lands in between can only make the cached body look older than it is
+            WidgetStore._validate_query_spec(cond_spec)
+            cache_key = querycache.cache_key(cond_spec, limit, offset)
+            version = get_write_version()
+            body = _query_cache.get(cache_key, version)
+            if body is not None:
+                return Response(body, mimetype='application/json')
+        widgets = get_reader_store().get_widgets_by_cond_spec(cond_spec, limit=limit, offset=offset)
+        with metrics.phase('jsonify'):
+            res = jsonify([
+                widget.to_json_obj()
+                for widget in widgets
+            ])
+        if _query_cache is not None:
+            _query_cache.put(cache_key, version, res.get_data())
+        return res
     except jsonschema.exceptions.ValidationError as ve:
         return (
             jsonify({
@@ -104,23 +442,30 @@ def query_widgets():
             }),
             400
         )
+    except StoreUnavailableError as ex:
+        return store_unavailable_error(ex)
     except Exception:
-        app.logger.exception('Unexpected exception')
+        log_unexpected_exception()
         abort(500)
 
 
 @app.route('/widgets/add', methods=['POST'])
 def add_widgets():
     try:
-        new_widget_json_objs = request.get_json()
+        new_widget_json_objs = get_json_body()
         for new_widget_json_obj in new_widget_json_objs:
             new_widget_json_obj.update({
                 "updated_date": datetime.today().strftime("%Y-%m-%d"),
                 "created_date": datetime.today().strftime("%Y-%m-%d")
             })
-        new_widgets = [Widget.from_json_obj(w) for w in new_widget_json_objs]
-        get_widget_store().put_widgets(new_widgets)
-        return jsonify(new_widget_json_objs), 200
+        rows = bulkingest.encode_widget_rows(new_widget_json_objs)
+        stored_dates = {}
+        written = get_widget_store().put_widget_rows(rows, stored_dates)
+        set_stored_dates(new_widget_json_objs, stored_dates)
+        with metrics.phase('jsonify'):
+            res = jsonify(new_widget_json_objs)
+        set_write_count_headers(res, written, len(new_widget_json_objs))
+        return res, 200
     except jsonschema.exceptions.ValidationError as ve:
         return (
             jsonify({
@@ -131,14 +476,14 @@ def add_widgets():
             400
         )
     except Exception:
-        app.logger.exception('Unexpected exception')
+        log_unexpected_exception()
         abort(500)
 
 
 @app.route('/widgets/delete', methods=['POST'])
 def bulk_delete_widgets():
     try:
-        cond_spec = request.get_json()
+        cond_spec = get_json_body()
         get_widget_store().delete_widgets_by_cond_spec(cond_spec)
         res = Response(status=204)
         del res.headers['Content-Type']
@@ -153,15 +498,18 @@ def bulk_delete_widgets():
             400
         )
     except Exception:
-        app.logger.exception('Unexpected exception')
+        log_unexpected_exception()
         abort(500)
 
 
 @app.route('/widgets/<widget_name>', methods=['GET'])
 def get_widget(widget_name):
     try:
-        widget = get_widget_store().get_widget_by_name(widget_name)
-        return jsonify(widget.to_json_obj())
+        widget = get_reader_store().get_widget_by_name(widget_name)
+        with metrics.phase('jsonify'):
+            res = jsonify(widget.to_json_obj())
+        res.headers['ETag'] = version_etag(widget.version)
+        return res
     except LookupError:
         return (
             jsonify({
@@ -170,35 +518,44 @@ def get_widget(widget_name):
             }),
             404
         )
+    except StoreUnavailableError as ex:
+        return store_unavailable_error(ex)
     except Exception:
-        app.logger.exception('Unexpected exception')
+        log_unexpected_exception()
         abort(500)
 
 
 @app.route('/widgets/<widget_name>', methods=['PUT'])
 def put_widget(widget_name):
     try:
+        if_version = get_if_match_version()
         try:  # if this succeeds, the widget already exists and is getting updated
             if not request.is_json:
                 raise ValueError('request body was not parseable json')
-            old_widget = get_widget_store().get_widget_by_name(widget_name)
-            new_widget_json_obj = request.get_json()
+            old_widget = get_reader_store().get_widget_by_name(widget_name)
+            new_widget_json_obj = get_json_body()
             new_widget_json_obj.update({
                 "updated_date": datetime.today().strftime("%Y-%m-%d"),
-                "created_date": old_widget["Created date"]
+                "created_date": old_widget["created_date"]
             })
             new_widget = Widget.from_json_obj(new_widget_json_obj)
-            get_widget_store().put_widget(new_widget)
-            return jsonify(new_widget_json_obj), 200
+            version = get_point_writer().put_widget(new_widget, if_version)
+            with metrics.phase('jsonify'):
+                res = jsonify(new_widget_json_obj)
+            res.headers['ETag'] = version_etag(version)
+            return res, 200
         except LookupError:  # if we're here, a new widget is getting created
-            new_widget_json_obj = request.get_json()
+            new_widget_json_obj = get_json_body()
             new_widget_json_obj.update({
                 "created_date": datetime.today().strftime("%Y-%m-%d"),
                 "updated_date": datetime.today().strftime("%Y-%m-%d")
             })
             new_widget = Widget.from_json_obj(new_widget_json_obj)
-            get_widget_store().put_widget(new_widget)
-            return jsonify(new_widget_json_obj), 201
+            version = get_point_writer().put_widget(new_widget, if_version)
+            with metrics.phase('jsonify'):
+                res = jsonify(new_widget_json_obj)
+            res.headers['ETag'] = version_etag(version)
+            return res, 201
     except jsonschema.exceptions.ValidationError as ve:
         return (
             jsonify({
@@ -208,18 +565,81 @@ def put_widget(widget_name):
             }),
             400
         )
+    except VersionMismatchError:
+        return version_mismatch_error()
+    except StoreUnavailableError as ex:
+        return store_unavailable_error(ex)
     except Exception:
-        app.logger.exception('Unexpected exception')
+        log_unexpected_exception()
+        abort(500)
+
+
+@app.route('/widgets/<widget_name>', methods=['PATCH'])
+def patch_widget(widget_name):
+    try:
+        patch = get_json_body() if request.is_json else None
+        if not isinstance(patch, dict):
+            return (
+                jsonify({
+                    "error class": "invalid widget representation",
+                    "uri": request.path,
+                    "cause": "request body must be a json merge patch object"
+                }),
+                400
+            )
+        patch.pop("created_date", None)
+        patch["updated_date"] = datetime.today().strftime("%Y-%m-%d")
+        widget = get_point_writer().patch_widget(widget_name, patch, get_if_match_version())
+        with metrics.phase('jsonify'):
+            res = jsonify(widget.to_json_obj())
+        res.headers['ETag'] = version_etag(widget.version)
+        return res, 200
+    except jsonschema.exceptions.ValidationError as ve:
+        return (
+            jsonify({
+                "error class": "invalid widget representation",
+                "uri": request.path,
+                "cause": ve.message
+            }),
+            400
+        )
+    except ValueError as ve:
+        return (
+            jsonify({
+                "error class": "invalid widget representation",
+                "uri": request.path,
+                "cause": str(ve)
+            }),
+            400
+        )
+    except VersionMismatchError:
+        return version_mismatch_error()
+    except StoreUnavailableError as ex:
+        return store_unavailable_error(ex)
+    except LookupError:
+        return (
+            jsonify({
+                "error class": "widget does not exist",
+                "uri": request.path
+            }),
+            404
+        )
+    except Exception:
+        log_unexpected_exception()
         abort(500)
 
 
 @app.route('/widgets/<widget_name>', methods=['DELETE'])
 def delete_widget(widget_name):
     try:
-        get_widget_store().delete_widget_by_name(widget_name)
+        get_point_writer().delete_widget_by_name(widget_name, get_if_match_version())
         res = Response(status=204)
         del res.headers['Content-Type']
         return res
+    except VersionMismatchError:
+        return version_mismatch_error()
+    except StoreUnavailableError as ex:
+        return store_unavailable_error(ex)
     except LookupError:
         return (
             jsonify({
@@ -229,10 +649,23 @@ def delete_widget(widget_name):
             404
         )
     except Exception:
-        app.logger.exception('Unexpected exception')
+        log_unexpected_exception()
         abort(500)
 
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/admin/slow-queries', methods=['GET'])
+def get_slow_queries():
+    error = admin_token_error()
+    if error is not None:
+        return error
+    return jsonify(slowlog.get_recorder().top_shapes(limit=request.args.get('limit', 20, type=int)))
+
+
 @app.errorhandler(500)
 def handle_internal_server_errors(e):
     return jsonify({"error class": "internal server error"}), 500
@@ -0,0 +1,134 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError
+
+from widgets import Widget
+from widgets import WidgetStore
+from widgets import StoreUnavailableError
+import metrics
+
+_STOP = object()
+
+
+class GroupCommitWriter:
+
+    # one writer thread per process. each batch is committed under BEGIN IMMEDIATE, so
+    # sqlite's own reserved lock is what serialises the writers of different processes
+
+    def __init__(self, connect_str=None, max_batch_delay_ms=None, max_batch_size=None, result_timeout_s=None):
+        self.connect_str = connect_str
+        if max_batch_delay_ms is None:
+            max_batch_delay_ms = float(os.getenv('GROUP_COMMIT_MAX_DELAY_MS', '5'))
+        if max_batch_size is None:
+            max_batch_size = int(os.getenv('GROUP_COMMIT_MAX_BATCH_SIZE', '64'))
+        if max_batch_delay_ms < 0:
+            raise ValueError('max_batch_delay_ms must not be negative, not %s' % max_batch_delay_ms)
+        if result_timeout_s is None:
+            result_timeout_s = float(os.getenv('GROUP_COMMIT_RESULT_TIMEOUT_S', '30'))
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be at least 1, not %s' % max_batch_size)
+        self.max_batch_delay = max_batch_delay_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.result_timeout = result_timeout_s
+        self._pending = queue.Queue()
+        self._store = WidgetStore(connect_str=connect_str, check_same_thread=False)
+        self._store.conn.isolation_level = None  # transactions are managed explicitly below
+        self._thread = threading.Thread(target=self._run, name='group-commit-writer', daemon=True)
+        self._thread.start()
+
+    def put_widget(self, widget, if_version=None):
+        return self._result(self.submit('_write_widget', widget, if_version))
+
+    def patch_widget(self, name, patch, if_version=None):
+        Widget._validate_patch_json_obj(patch)  # here, rather than on the writer thread
+        return self._store._row_to_widget(self._result(self.submit('_patch_widget', name, patch, if_version)))
+
+    def delete_widget_by_name(self, name, if_version=None):
+        return self._result(self.submit('_erase_widget_by_name', name, if_version))
+
+    def submit(self, store_method_name, *args):
+        future = Future()
+        self._pending.put((store_method_name, args, future))
+        return future
+
+    def _result(self, future):
+        # the write may still be committed after this gives up on it
+        try:
+            return future.result(timeout=self.result_timeout)
+        except TimeoutError:
+            raise StoreUnavailableError(
+                'the group commit writer did not get to the write within %ss' % self.result_timeout
+            )
+
+    def queue_depth(self):
+        return self._pending.qsize()
+
+    def close(self):
+        self._pending.put(_STOP)
+        self._thread.join()
+        self._store.close()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            op = self._pending.get()
+            if op is _STOP:
+                break
+            batch, stopping = self._collect_batch(op)
+            try:
+                if metrics.enabled:
+                    metrics.GROUP_COMMIT_BATCH_SIZE.observe(len(batch))
+                self._commit_batch(batch)
+            except Exception as ex:
+                # the thread has to outlive whatever a batch throws, or every later
+                # write would queue up behind a writer that's gone
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(ex)
+
+    def _collect_batch(self, op):
+        # -> (the batch that starts with op, whether close was called meanwhile)
+        batch = [op]
+        deadline = time.monotonic() + self.max_batch_delay
+        while len(batch) < self.max_batch_size:
+            try:
+                op = self._pending.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if op is _STOP:
+                return batch, True
+            batch.append(op)
+        return batch, False
+
+    def _commit_batch(self, batch):
+        conn = self._store.conn
+        outcomes = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for store_method_name, args, future in batch:
+                # a savepoint per op, so one failing op is rolled back without taking
+                # the rest of the batch down with it
+                conn.execute('SAVEPOINT group_commit_op')
+                try:
+                    outcomes.append((False, getattr(self._store, store_method_name)(*args)))
+                except Exception as ex:
+                    conn.execute('ROLLBACK TO group_commit_op')
+                    outcomes.append((True, ex))
+                conn.execute('RELEASE group_commit_op')
+            conn.execute('COMMIT')
+        except Exception as ex:
+            try:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+            finally:
+                for _, _, future in batch:
+                    future.set_exception(ex)
+            return
+        for (_, _, future), (failed, outcome) in zip(batch, outcomes):
+            if failed:
+                future.set_exception(outcome)
+            else:
+                future.set_result(outcome)
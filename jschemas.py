@@ -25,115 +25,204 @@ widget_schema = {
     ]
 }
 
-cond_spec_schema = {
-        "type": "array",
-        "items": {
-            "oneOf": [
-                {  # universal unary predicates (just use variable. no constant)
-                    "type": "object",
-                    "properties": {
-                        "predicate": {
-                            "enum": [
-                                "isnull",
-                                "not isnull"
-                            ]
-                        },
-                        "variable": {
-                            "enum": [
-                                'name',
-                                'num_of_parts',
-                                'created_date',
-                                'updated_date'
-                            ]
-                        },
-                        "constants": {
-                            "type": "array",
-                            "minItems": 0,
-                            "maxItems": 0
-                        }
+# a json merge patch (rfc 7396) for one widget. the core properties can be changed but
+# not removed, so they can't be null, and any other property is a flex property
+widget_patch_schema = {
+    "type": "object",
+    "properties": {
+        "name": {
+            "type": "string",
+            "maxLength": 64,
+        },
+        "num_of_parts": {
+            "type": "integer"
+        },
+        "created_date": {
+            "type": "string",
+            "format": "date"
+        },
+        "updated_date": {
+            "type": "string",
+            "format": "date"
+        }
+    }
+}
+
+_variable_schema = {
+    "enum": [
+        'name',
+        'num_of_parts',
+        'created_date',
+        'updated_date'
+    ]
+}
+
+
+def _group_schema(operator, operand_schema):
+    return {
+        "type": "object",
+        "properties": {
+            operator: operand_schema
+        },
+        "required": [operator],
+        "additionalProperties": False
+    }
+
+
+# a condition is a predicate on one variable, or an all (and), any (or) or not group of
+# conditions. groups nest, up to the depth and condition count checked by the store
+_condition_schemas = {
+    "condition": {
+        "oneOf": [
+            {  # universal unary predicates (just use variable. no constant)
+                "type": "object",
+                "properties": {
+                    "predicate": {
+                        "enum": [
+                            "isnull",
+                            "not isnull"
+                        ]
                     },
-                    "required": [
-                        "predicate",
-                        "variable",
-                        "constants"
-                    ]
+                    "variable": _variable_schema,
+                    "constants": {
+                        "type": "array",
+                        "minItems": 0,
+                        "maxItems": 0
+                    }
                 },
-                {  # universal binary predicates (left arg will be variable, right a constant)
-                    "type": "object",
-                    "properties": {
-                        "predicate": {
-                            "enum": [
-                                "eq",
-                                "ne",
-                                "lt",
-                                "gt",
-                                "ge",
-                                "le",
-                                "like",
-                                "not like"
-                            ]
-                        },
-                        "variable": {
-                            "enum": [
-                                'name',
-                                'num_of_parts',
-                                'created_date',
-                                'updated_date'
-                            ]
-                        },
-                        "constants": {
-                            "type": "array",
-                            "minItems": 1,
-                            "maxItems": 1
-                        }
+                "required": [
+                    "predicate",
+                    "variable",
+                    "constants"
+                ],
+                "additionalProperties": False
+            },
+            {  # universal binary predicates (left arg will be variable, right a constant)
+                "type": "object",
+                "properties": {
+                    "predicate": {
+                        "enum": [
+                            "eq",
+                            "ne",
+                            "lt",
+                            "gt",
+                            "ge",
+                            "le",
+                            "like",
+                            "not like"
+                        ]
                     },
-                    "required": [
-                        "predicate",
-                        "variable",
-                        "constants"
+                    "variable": _variable_schema,
+                    "constants": {
+                        "type": "array",
+                        "minItems": 1,
+                        "maxItems": 1
+                    }
+                },
+                "required": [
+                    "predicate",
+                    "variable",
+                    "constants"
+                ],
+                "additionalProperties": False
+            },
+            {  # universal ternary predicates (leftmost arg is variable, others are constants)
+                "type": "object",
+                "properties": {
+                    "predicate": {
+                        "enum": [
+                            "between",
+                            "not between"
+                        ]
+                    },
+                    "variable": _variable_schema,
+                    "constants": {
+                        "oneOf": [
+                            {
+                                "type": "array",
+                                "items": {"type": "string"},
+                                "minItems": 2,
+                                "maxItems": 2
+                            },
+                            {
+                                "type": "array",
+                                "items": {"type": "number"},
+                                "minItems": 2,
+                                "maxItems": 2
+                            }
+                        ]
+                    },
+                },
+                "required": [
+                    "predicate",
+                    "variable",
+                    "constants"
+                ],
+                "additionalProperties": False
+            },
+            _group_schema("all", {"$ref": "#/definitions/conditions"}),
+            _group_schema("any", {"$ref": "#/definitions/conditions"}),
+            _group_schema("not", {"$ref": "#/definitions/condition"})
+        ]
+    },
+    "conditions": {
+        "type": "array",
+        "items": {"$ref": "#/definitions/condition"},
+        "minItems": 1,
+        "maxItems": 15
+    },
+    "cond_spec": {  # a list of conditions that all have to hold
+        "type": "array",
+        "items": {"$ref": "#/definitions/condition"},
+        "maxItems": 15
+    }
+}
+
+# what bulk delete takes
+cond_spec_schema = {
+    "definitions": _condition_schemas,
+    "$ref": "#/definitions/cond_spec"
+}
+
+# what a query takes: a cond_spec, or an object with the conditions under where (one
+# condition or a cond_spec), the core variables to sort by and the most rows to return
+query_spec_schema = {
+    "definitions": _condition_schemas,
+    "oneOf": [
+        {"$ref": "#/definitions/cond_spec"},
+        {
+            "type": "object",
+            "properties": {
+                "where": {
+                    "oneOf": [
+                        {"$ref": "#/definitions/condition"},
+                        {"$ref": "#/definitions/cond_spec"}
                     ]
                 },
-                {  # universal ternary predicates (leftmost arg is variable, others are constants)
-                    "type": "object",
-                    "properties": {
-                        "predicate": {
-                            "enum": [
-                                "between",
-                                "not between"
-                            ]
-                        },
-                        "variable": {
-                            "enum": [
-                                'name',
-                                'num_of_parts',
-                                'created_date',
-                                'updated_date'
-                            ]
-                        },
-                        "constants": {
-                            "oneOf": [
-                                {
-                                    "type": "array",
-                                    "items": {"type": "string"},
-                                    "minItems": 2,
-                                    "maxItems": 2
-                                },
-                                {
-                                    "type": "array",
-                                    "items": {"type": "number"},
-                                    "minItems": 2,
-                                    "maxItems": 2
-                                }
-                            ]
+                "order_by": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "variable": _variable_schema,
+                            "direction": {
+                                "enum": [
+                                    "asc",
+                                    "desc"
+                                ]
+                            }
                         },
+                        "required": ["variable"],
+                        "additionalProperties": False
                     },
-                    "required": [
-                        "predicate",
-                        "variable",
-                        "constants"
-                    ]
+                    "maxItems": 4
+                },
+                "limit": {
+                    "type": "integer",
+                    "minimum": 0
                 }
-            ]
-        },
-        "maxItems": 15
-    }
+            },
+            "additionalProperties": False
+        }
+    ]
+}
@@ -0,0 +1,379 @@
+import itertools
+import os
+import threading
+import time
+from bisect import bisect_left
+
+# in-process metrics, rendered in the prometheus text exposition format. each worker
+# process keeps its own registry, so scrape every worker (or sum across them). every
+# request is timed, but only one in METRICS_SAMPLE_EVERY gets its phases timed and its
+# body sizes and store rows counted, which is what keeps a point read within its 2% budget
+
+enabled = os.getenv('METRICS_ENABLED', '1') == '1'
+SAMPLE_EVERY = max(int(os.getenv('METRICS_SAMPLE_EVERY', '16')), 1)
+
+LATENCY_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(label_names, label_values, extra=''):
+    pairs = ['%s="%s"' % (n, _escape_label_value(v)) for n, v in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s counter' % self.name]
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            lines.append('%s%s %s' % (self.name, _format_labels(self.label_names, label_values), _format_value(value)))
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [per bucket counts (+Inf last), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def observe_all(self, observations):
+        # (value, label values) pairs, all recorded under one acquisition of the lock
+        with self._lock:
+            for value, label_values in observations:
+                series = self._series.get(label_values)
+                if series is None:
+                    series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0, 0]
+                series[0][bisect_left(self.buckets, value)] += 1
+                series[1] += value
+                series[2] += 1
+
+    def count(self, *label_values):
+        series = self._series.get(label_values)
+        return 0 if series is None else series[2]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            all_series = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self._series.items())
+        for label_values, (bucket_counts, total, count) in all_series:
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets + (float('inf'),), bucket_counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %s' % (
+                    self.name,
+                    _format_labels(self.label_names, label_values, 'le="%s"' % _format_value(upper_bound)),
+                    cumulative
+                ))
+            labels = _format_labels(self.label_names, label_values)
+            lines.append('%s_sum%s %s' % (self.name, labels, _format_value(total)))
+            lines.append('%s_count%s %s' % (self.name, labels, count))
+        return lines
+
+
+class Gauge:
+
+    # sampled at scrape time: collect returns a list of (label values tuple, value)
+
+    def __init__(self, name, help_text, label_names, collect):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.collect = collect
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s gauge' % self.name]
+        for label_values, value in self.collect():
+            lines.append('%s%s %s' % (self.name, _format_labels(self.label_names, label_values), _format_value(value)))
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError('metric %s is already registered' % metric.name)
+            self._metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def render(self):
+        flush()  # so a scrape sees every request that has finished
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'widgets_http_request_duration_seconds',
+    'time spent handling a request, by route',
+    ('method', 'route', 'status')
+))
+PHASE_SECONDS = REGISTRY.register(Histogram(
+    'widgets_phase_duration_seconds',
+    'time spent in one phase of request handling, by route',
+    ('route', 'phase')
+))
+STORE_ROWS = REGISTRY.register(Histogram(
+    'widgets_store_rows',
+    'rows read or written by one widget store operation',
+    ('operation',),
+    buckets=ROW_BUCKETS
+))
+REQUEST_BYTES = REGISTRY.register(Histogram(
+    'widgets_http_request_size_bytes',
+    'request body size, by route',
+    ('route',),
+    buckets=BYTE_BUCKETS
+))
+RESPONSE_BYTES = REGISTRY.register(Histogram(
+    'widgets_http_response_size_bytes',
+    'response body size, by route',
+    ('route',),
+    buckets=BYTE_BUCKETS
+))
+GROUP_COMMIT_BATCH_SIZE = REGISTRY.register(Histogram(
+    'widgets_group_commit_batch_size',
+    'writes committed together by the group commit writer',
+    buckets=BATCH_BUCKETS
+))
+
+SQLITE_BUSY_ERRORS = REGISTRY.register(Counter(
+    'widgets_sqlite_busy_errors_total',
+    'requests that failed because sqlite stayed locked or busy past the busy timeout'
+))
+ADMISSION_SHED = REGISTRY.register(Counter(
+    'widgets_admission_shed_total',
+    'requests turned away with a 503 by admission control',
+    ('endpoint_class', 'reason')
+))
+
+
+class _Context(threading.local):
+
+    def __init__(self):
+        self.route = 'none'
+        self.phase_starts = []  # a stack, since phases can nest
+        self.phase_timings = None  # (phase, seconds) pairs of the request in progress
+        self.sampled = True  # False while a request that isn't sampled is in progress
+
+
+_context = _Context()
+
+
+def set_route(route):
+    _context.route = route
+
+
+def current_route():
+    return _context.route
+
+
+class _PhaseTimer:
+
+    # one shared timer per phase name, with the start times kept per thread. inside a
+    # request, the timing is only appended to the request's list, which is labelled
+    # with the route and recorded along with the rest of the request's metrics
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        _context.phase_starts.append(time.perf_counter())
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        context = _context
+        elapsed = time.perf_counter() - context.phase_starts.pop()
+        if context.phase_timings is None:  # outside a request, e.g. on the group commit writer's thread
+            PHASE_SECONDS.observe(elapsed, context.route, self.name)
+        else:
+            context.phase_timings.append((self.name, elapsed))
+
+
+class _NoopTimer:
+
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_noop_timer = _NoopTimer()
+_phase_timers = {}
+
+
+def phase(name):
+    if not enabled or not _context.sampled:
+        return _noop_timer
+    timer = _phase_timers.get(name)
+    if timer is None:
+        timer = _phase_timers.setdefault(name, _PhaseTimer(name))
+    return timer
+
+
+def observe_rows(operation, row_count):
+    if enabled and _context.sampled:
+        STORE_ROWS.observe(row_count, operation)
+
+
+# finished requests are queued here, along with the sizes and phase timings of the
+# sampled ones, and folded into the histograms PENDING_BATCH_SIZE at a time. recording
+# a request into four histograms as it finishes costs several times what the same
+# updates cost done back to back for a batch, when the histograms are still in cache
+PENDING_BATCH_SIZE = 256
+_pending_requests = []
+_flush_lock = threading.Lock()
+
+
+def flush():
+    with _flush_lock:
+        batch = _pending_requests[:]
+        del _pending_requests[:len(batch)]  # requests queued since the copy stay queued
+    if not batch:
+        return
+    REQUEST_SECONDS.observe_all(
+        (elapsed, (method, route, status[:3])) for method, route, status, elapsed, _ in batch
+    )
+    samples = [(route, sample) for _, route, _, _, sample in batch if sample is not None]
+    PHASE_SECONDS.observe_all(
+        (phase_elapsed, (route, name))
+        for route, (_, _, timings) in samples
+        for name, phase_elapsed in timings
+    )
+    REQUEST_BYTES.observe_all(
+        (content_length, (route,)) for route, (content_length, _, _) in samples if content_length is not None
+    )
+    RESPONSE_BYTES.observe_all(
+        (int(header_value), (route,))
+        for route, (_, headers, _) in samples
+        for header_name, header_value in headers
+        if header_name.lower() == 'content-length'
+    )
+
+
+_request_counter = itertools.count()
+
+
+def _content_length(environ):
+    # None for a missing or malformed header, which the request size histogram skips
+    content_length = environ.get('CONTENT_LENGTH')
+    if not content_length:
+        return None
+    try:
+        return int(content_length)
+    except ValueError:
+        return None
+
+
+class RequestMetricsMiddleware:
+
+    # wraps a wsgi app rather than hooking before/after request, and only queues what
+    # it measured (see flush), which keeps the cost per request to a couple of list
+    # appends. the route label is route_of(environ) when the app starts its response,
+    # or else whatever the app passed to set_route while handling the request. requests
+    # that aren't sampled run with the phase timers switched off, and only their time is
+    # recorded
+
+    def __init__(self, wsgi_app, route_of=None):
+        self.wsgi_app = wsgi_app
+        self.route_of = route_of
+
+    def __call__(self, environ, start_response):
+        if not enabled:
+            return self.wsgi_app(environ, start_response)
+        start = time.perf_counter()
+        route_of = self.route_of
+        if route_of is None:
+            _context.route = 'unmatched'
+        context = _context
+        sampled = next(_request_counter) % SAMPLE_EVERY == 0
+        if sampled:
+            timings = context.phase_timings = []
+        else:
+            context.sampled = False
+        captured = []  # status, headers, route
+
+        def recording_start_response(status, headers, exc_info=None):
+            captured[:] = (status, headers, route_of(environ) if route_of is not None else _context.route)
+            return start_response(status, headers, exc_info)
+
+        try:
+            result = self.wsgi_app(environ, recording_start_response)
+        finally:
+            if sampled:
+                context.phase_timings = None
+            else:
+                context.sampled = True
+        elapsed = time.perf_counter() - start
+        status, headers, route = captured or ('', (), None)
+        _pending_requests.append((
+            environ.get('REQUEST_METHOD', ''),
+            route or 'unmatched',
+            status,
+            elapsed,
+            (_content_length(environ), headers, timings) if sampled else None
+        ))
+        if len(_pending_requests) >= PENDING_BATCH_SIZE:
+            flush()
+        return result
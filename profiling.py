@@ -0,0 +1,188 @@
+import cProfile
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+
+# opt-in per request profiling. nothing here is hooked into the app unless
+# PROFILING_ENABLED=1 and ADMIN_TOKEN are both set at startup, so when disabled a
+# request pays nothing for it
+
+enabled = os.getenv('PROFILING_ENABLED', '0') == '1'
+
+MODES = ('cprofile', 'sample')
+TOP_FRAMES = 5
+
+_one_at_a_time = threading.Lock()  # cProfile can't run two profilers at once on 3.12+
+
+
+def _is_widgets_frame(filename):
+    return os.path.basename(filename) == 'widgets.py'
+
+
+class CProfileRequestProfiler:
+
+    suffix = '.pstats'
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+
+    def save(self, path):
+        self._profile.dump_stats(path)
+
+    def top_widgets_frames(self):
+        stats = pstats.Stats(self._profile).stats
+        frames = [
+            (cumulative_time, '%s:%s' % (function_name, line_number))
+            for (filename, line_number, function_name), (_, _, _, cumulative_time, _) in stats.items()
+            if _is_widgets_frame(filename)
+        ]
+        frames.sort(reverse=True)
+        return ['%s=%.3fms' % (frame, seconds * 1000) for seconds, frame in frames[:TOP_FRAMES]]
+
+
+class SamplingRequestProfiler:
+
+    # samples the request thread's stack on a timer thread. the output is in the
+    # collapsed stack format that flamegraph.pl and speedscope read. the sampler needs
+    # the gil to take a sample, so the effective rate is capped by the interpreter's
+    # switch interval (5ms by default): meant for requests that take seconds
+
+    suffix = '.collapsed'
+
+    def __init__(self, interval_s=None):
+        if interval_s is None:
+            interval_s = float(os.getenv('PROFILE_SAMPLE_INTERVAL_MS', '1')) / 1000
+        self.interval_s = interval_s
+        self.stacks = {}
+        self._thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name='request-sampler', daemon=True)
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._sampler.join()
+
+    def save(self, path):
+        with open(path, 'w') as out_file:
+            for stack, count in sorted(self.stacks.items()):
+                out_file.write('%s %s\n' % (stack, count))
+
+    def top_widgets_frames(self):
+        # a sample counts toward the innermost widgets.py frame on its stack
+        counts = {}
+        for stack, count in self.stacks.items():
+            widgets_frames = [frame for frame in stack.split(';') if frame.startswith('widgets.py:')]
+            if widgets_frames:
+                counts[widgets_frames[-1]] = counts.get(widgets_frames[-1], 0) + count
+        top = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:TOP_FRAMES]
+        return ['%s=%s samples' % (frame[len('widgets.py:'):], count) for frame, count in top]
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval_s):
+            frame = sys._current_frames().get(self._thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if frames:
+                stack = ';'.join(reversed(frames))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+
+class ProfileSession:
+
+    def __init__(self, mode, label):
+        if mode not in MODES:
+            raise ValueError('%s is not a profiling mode, use one of %s' % (mode, ', '.join(MODES)))
+        self.label = label
+        self.profiler = CProfileRequestProfiler() if mode == 'cprofile' else SamplingRequestProfiler()
+        self.acquired = _one_at_a_time.acquire(blocking=False)
+
+    def start(self):
+        if self.acquired:
+            self.profiler.start()
+
+    def finish(self, profile_dir):
+        # returns (saved file name, top widgets.py frames), or None when another
+        # request was already being profiled
+        if not self.acquired:
+            return None
+        try:
+            self.profiler.stop()
+        finally:
+            self.acquired = False
+            _one_at_a_time.release()
+        os.makedirs(profile_dir, exist_ok=True)
+        # milliseconds and the pid, so that workers profiling the same route at the same
+        # time don't overwrite each other's files
+        now = time.time()
+        file_name = '%s%03d-%s-%s%s' % (
+            time.strftime('%Y%m%dT%H%M%S', time.localtime(now)),
+            int(now * 1000) % 1000,
+            os.getpid(),
+            self.label,
+            self.profiler.suffix
+        )
+        self.profiler.save(os.path.join(profile_dir, file_name))
+        return file_name, self.profiler.top_widgets_frames()
+
+    def abandon(self):
+        if self.acquired:
+            self.acquired = False
+            self.profiler.stop()
+            _one_at_a_time.release()
+
+
+def install(app, admin_token_ok):
+    # admin_token_ok is called in the request context and says whether the request
+    # carries a valid admin token
+    from flask import g
+    from flask import request
+
+    profile_dir = os.getenv('PROFILE_DIR', 'profiles')
+
+    @app.before_request
+    def start_profile():
+        mode = request.headers.get('X-Profile', None)
+        if mode is None or not admin_token_ok():
+            return
+        label = re.sub(r'[^A-Za-z0-9_.-]', '_', '%s%s' % (request.method, request.path))
+        try:
+            g._profile_session = ProfileSession(mode, label)
+        except ValueError:
+            return
+        g._profile_session.start()
+
+    @app.after_request
+    def finish_profile(response):
+        profile_session = getattr(g, '_profile_session', None)
+        if profile_session is None:
+            return response
+        g._profile_session = None
+        outcome = profile_session.finish(profile_dir)
+        if outcome is None:
+            response.headers['X-Profile-Top'] = 'skipped, another request is being profiled'
+        else:
+            file_name, top_frames = outcome
+            response.headers['X-Profile-File'] = file_name
+            response.headers['X-Profile-Top'] = ', '.join(top_frames) or 'no widgets.py frames'
+        return response
+
+    @app.teardown_request
+    def abandon_profile(exception):
+        profile_session = getattr(g, '_profile_session', None)
+        if profile_session is not None:
+            profile_session.abandon()
@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+# a per process cache of serialised /widgets/query response bodies, keyed by the
+# normalised spec and paging params. every entry belongs to one write version of the db
+# (see widgets.write_version), and the first lookup that sees a newer version drops them
+# all, so a hit never needs sqlite. memory is bounded by the bytes of the cached keys and
+# bodies, least recently used entries going first
+
+enabled = int(os.getenv('QUERY_CACHE_MAX_BYTES', '0')) > 0
+
+# predicates whose constants are compared as numbers against num_of_parts, so 5 and 5.0
+# select the same rows. like compares text, where they don't
+_numeric_predicates = {'eq', 'ne', 'lt', 'gt', 'le', 'ge', 'between', 'not between'}
+
+# rough bytes of bookkeeping per entry, on top of its key and body
+_entry_overhead = 200
+
+
+def cache_key(cond_spec, limit, offset):
+    return json.dumps([normalise_spec(cond_spec), limit, offset], sort_keys=True, separators=(',', ':'))
+
+
+def normalise_spec(cond_spec):
+    # an equivalent spec in one canonical form: a query spec object with and-ed and
+    # or-ed conditions sorted, explicit sort directions and integral num_of_parts
+    # constants as ints. nothing is dropped or merged, so a spec is valid exactly when
+    # its normal form is, and only valid specs ever get cached
+    if isinstance(cond_spec, list):
+        return {'where': _normalise_conds(cond_spec)}
+    if not isinstance(cond_spec, dict):
+        return cond_spec
+    spec = dict(cond_spec)
+    where = spec.get('where', [])
+    if isinstance(where, dict):
+        where = [where]
+    spec['where'] = _normalise_conds(where) if isinstance(where, list) else where
+    if isinstance(spec.get('order_by'), list):
+        spec['order_by'] = [
+            dict({'direction': 'asc'}, **term) if isinstance(term, dict) else term
+            for term in spec['order_by']
+        ]
+    return spec
+
+
+def _normalise_conds(conds):
+    return sorted(
+        (_normalise_cond(cond) for cond in conds),
+        key=lambda cond: json.dumps(cond, sort_keys=True)
+    )
+
+
+def _normalise_cond(cond):
+    if not isinstance(cond, dict):
+        return cond
+    cond = dict(cond)
+    if 'predicate' in cond:
+        return _normalise_leaf(cond)
+    for operator in ('all', 'any'):
+        if isinstance(cond.get(operator), list):
+            cond[operator] = _normalise_conds(cond[operator])
+    if 'not' in cond:
+        cond['not'] = _normalise_cond(cond['not'])
+    return cond
+
+
+def _normalise_leaf(cond):
+    if cond.get('variable') == 'num_of_parts' and cond.get('predicate') in _numeric_predicates \
+            and isinstance(cond.get('constants'), list):
+        cond['constants'] = [_normalise_number(constant) for constant in cond['constants']]
+    return cond
+
+
+def _normalise_number(value):
+    # floats past 2**53 stay floats, as ints that big can't be bound as sqlite integers
+    if isinstance(value, float) and value.is_integer() and abs(value) < 2 ** 53:
+        return int(value)
+    return value
+
+
+class QueryResultCache:
+
+    def __init__(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = int(os.getenv('QUERY_CACHE_MAX_BYTES', '0'))
+        self.max_bytes = max_bytes
+        # a body this big would push out most of the cache for one query
+        self.max_entry_bytes = max_bytes // 8
+        self._entries = OrderedDict()  # key -> body, least recently used first
+        self._bytes = 0
+        self._version = None
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def get(self, key, version):
+        # the cached body for key, or None. None for the version means the db's writes
+        # can't be tracked, so nothing is cached
+        with self._lock:
+            if version is not None and version != self._version:
+                self._invalidate(version)
+            body = self._entries.get(key) if version is not None else None
+            if body is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return body
+
+    def put(self, key, version, body):
+        # version is the one read before the query ran. once the cache has moved on to
+        # a newer version, the body may predate a write and is dropped
+        size = self._entry_size(key, body)
+        if version is None or size > self.max_entry_bytes:
+            return
+        with self._lock:
+            if version != self._version:
+                return
+            if key in self._entries:
+                self._bytes -= self._entry_size(key, self._entries.pop(key))
+            self._entries[key] = body
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                evicted_key, evicted_body = self._entries.popitem(last=False)
+                self._bytes -= self._entry_size(evicted_key, evicted_body)
+                self._evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return [
+                (('hits',), self._hits),
+                (('misses',), self._misses),
+                (('hit_ratio',), self._hits / lookups if lookups else 0.0),
+                (('entries',), len(self._entries)),
+                (('bytes',), self._bytes),
+                (('max_bytes',), self.max_bytes),
+                (('evictions',), self._evictions),
+                (('invalidations',), self._invalidations)
+            ]
+
+    def _invalidate(self, version):
+        if self._entries:
+            self._invalidations += 1
+        self._entries.clear()
+        self._bytes = 0
+        self._version = version
+
+    @staticmethod
+    def _entry_size(key, body):
+        return len(key) + len(body) + _entry_overhead
@@ -0,0 +1,62 @@
+import argparse
+
+from shards import ShardedWidgetStore
+from shards import parse_connect_strs
+from shards import shard_index
+
+
+def reshard(src_connect_strs, dst_connect_strs, batch_size=1000):
+    if set(src_connect_strs) & set(dst_connect_strs):
+        raise ValueError('source and destination shards must not overlap')
+    src_store = ShardedWidgetStore(src_connect_strs)
+    dst_store = ShardedWidgetStore(dst_connect_strs)
+    moved = 0
+    try:
+        for src_shard in src_store.shards:
+            curs = src_shard.conn.execute("""
+                SELECT *
+                FROM widgets
+            """)
+            # an upsert rather than INSERT OR REPLACE, whose delete of the old row fires
+            # no delete triggers and so leaves the name trigram index with stale rowids
+            columns = [description[0] for description in curs.description]
+            upsert_sql = 'INSERT INTO widgets (%s) VALUES (%s) ON CONFLICT (Name) DO UPDATE SET %s' % (
+                ', '.join(columns),
+                ', '.join('?' * len(columns)),
+                ', '.join('%s = excluded.%s' % (column, column) for column in columns if column != 'Name')
+            )
+            try:
+                while True:
+                    rows = curs.fetchmany(batch_size)
+                    if len(rows) == 0:
+                        break
+                    rows_by_shard = {}
+                    for row in rows:
+                        rows_by_shard.setdefault(shard_index(row[0], len(dst_store.shards)), []).append(row)
+                    for i, dst_rows in rows_by_shard.items():
+                        dst_conn = dst_store.shards[i].conn
+                        with dst_conn:
+                            dst_conn.executemany(upsert_sql, dst_rows)
+                    moved += len(rows)
+            finally:
+                curs.close()
+    finally:
+        src_store.close()
+        dst_store.close()
+    return moved
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='copy every widget from one set of shards into another, re-partitioned by name'
+    )
+    parser.add_argument('--from', dest='src', required=True, help='comma separated source connect strings')
+    parser.add_argument('--to', dest='dst', required=True, help='comma separated destination connect strings')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args(argv)
+    moved = reshard(parse_connect_strs(args.src), parse_connect_strs(args.dst), batch_size=args.batch_size)
+    print('resharded %s widgets' % moved)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+import heapq
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from widgets import WidgetStore
+from widgets import write_version
+
+_fan_out_executor = None
+
+
+def get_fan_out_executor():
+    global _fan_out_executor
+    if _fan_out_executor is None:
+        _fan_out_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv('SHARD_FAN_OUT_WORKERS', '8')),
+            thread_name_prefix='shard-fan-out'
+        )
+    return _fan_out_executor
+
+
+def parse_connect_strs(connect_strs_str):
+    return [c.strip() for c in connect_strs_str.split(',') if c.strip()]
+
+
+def sharded_write_version(connect_strs=None):
+    # changes whenever any shard has been written to
+    if connect_strs is None:
+        connect_strs = parse_connect_strs(os.getenv('SHARD_CONNECT_STRS', ''))
+    versions = tuple(write_version(connect_str) for connect_str in connect_strs)
+    return None if None in versions else versions
+
+
+def shard_index(name, shard_count):
+    # crc32 rather than hash(), since str hashes are salted per process and shard
+    # placement has to agree across every worker and every restart
+    return zlib.crc32(name.encode('utf-8')) % shard_count
+
+
+class ShardedWidgetStore:
+
+    def __init__(self, connect_strs=None):
+        if connect_strs is None:
+            connect_strs = parse_connect_strs(os.getenv('SHARD_CONNECT_STRS', ''))
+        if len(connect_strs) == 0:
+            raise ValueError('at least one shard connect string is required')
+        self.connect_strs = list(connect_strs)
+        # shard connections get handed to fan-out threads, but never to two threads at once
+        self.shards = [
+            WidgetStore(connect_str=connect_str, check_same_thread=False)
+            for connect_str in self.connect_strs
+        ]
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def shard_for(self, name):
+        return self.shards[shard_index(name, len(self.shards))]
+
+    def get_widget_by_name(self, name):
+        return self.shard_for(name).get_widget_by_name(name)
+
+    def put_widget(self, widget, if_version=None):
+        return self.shard_for(widget['name']).put_widget(widget, if_version)
+
+    def patch_widget(self, name, patch, if_version=None):
+        return self.shard_for(name).patch_widget(name, patch, if_version)
+
+    def delete_widget_by_name(self, name, if_version=None):
+        self.shard_for(name).delete_widget_by_name(name, if_version)
+
+    def put_widgets(self, widgets):
+        widgets_by_shard = self._partition(widgets)
+        return sum(self._fan_out(
+            lambda shard: shard.put_widgets(widgets_by_shard[shard]),
+            list(widgets_by_shard)
+        ))
+
+    def replace_all_widgets(self, widgets):
+        # every shard is replaced, the ones no widget maps to are emptied
+        widgets_by_shard = self._partition(widgets)
+        return sum(self._fan_out(lambda shard: shard.replace_all_widgets(widgets_by_shard.get(shard, []))))
+
+    # rows are encoded widgets that start with the name. every row is encoded before
+    # any shard is written, so an invalid widget leaves every shard untouched
+
+    def put_widget_rows(self, rows, stored_dates=None):
+        rows_by_shard = self._partition(rows, name=lambda row: row[0])
+        return sum(self._fan_out(
+            lambda shard: shard.put_widget_rows(rows_by_shard[shard], stored_dates),
+            list(rows_by_shard)
+        ))
+
+    def replace_all_widget_rows(self, rows, stored_dates=None):
+        rows_by_shard = self._partition(rows, name=lambda row: row[0])
+        return sum(self._fan_out(
+            lambda shard: shard.replace_all_widget_rows(rows_by_shard.get(shard, []), stored_dates)
+        ))
+
+    def delete_all_widgets(self):
+        self._fan_out(lambda shard: shard.delete_all_widgets())
+
+    def estimate_row_count(self):
+        return sum(self._fan_out(lambda shard: shard.estimate_row_count()))
+
+    def get_all_widgets(self, limit=None, offset=0):
+        if limit is None:
+            return self._merge(self._fan_out(lambda shard: shard.get_all_widgets()))
+        # every shard has to give up its first offset + limit rows, since any of them
+        # could land on the requested page once the shards are merged
+        return self._merge(
+            self._fan_out(lambda shard: shard.get_all_widgets(limit=offset + limit)),
+            limit=limit,
+            offset=offset
+        )
+
+    def get_widgets_by_cond_spec(self, cond_spec, limit=None, offset=0):
+        self.shards[0]._validate_query_spec(cond_spec)
+        _, order_by, spec_limit = WidgetStore._split_query_spec(cond_spec)
+        limit = WidgetStore._page_limit(spec_limit, limit, offset)
+        if limit is None and not order_by:
+            return self._merge(self._fan_out(lambda shard: shard.get_widgets_by_cond_spec(cond_spec)))
+        # every shard returns its own top rows in order, and their merge is the top overall
+        shard_limit = None if limit is None else offset + limit
+        return self._merge(
+            self._fan_out(lambda shard: shard.get_widgets_by_cond_spec(cond_spec, limit=shard_limit)),
+            limit=limit,
+            offset=offset,
+            order_by=order_by
+        )
+
+    def delete_widgets_by_cond_spec(self, cond_spec):
+        # not atomic across shards: each shard commits its own delete
+        self.shards[0]._validate_cond_spec(cond_spec)
+        self._fan_out(lambda shard: shard.delete_widgets_by_cond_spec(cond_spec))
+
+    def _partition(self, widgets, name=lambda widget: widget['name']):
+        widgets_by_shard = {}
+        for widget in widgets:
+            widgets_by_shard.setdefault(self.shard_for(name(widget)), []).append(widget)
+        return widgets_by_shard
+
+    def _fan_out(self, fn, shards=None):
+        shards = self.shards if shards is None else shards
+        if len(shards) == 1:
+            return [fn(shards[0])]
+        futures = [get_fan_out_executor().submit(fn, shard) for shard in shards]
+        return [future.result() for future in futures]
+
+    def _merge(self, results_per_shard, limit=None, offset=0, order_by=None):
+        if limit is None and not order_by:
+            return [widget for results in results_per_shard for widget in results]
+        merged = heapq.merge(*results_per_shard, key=_sort_key(WidgetStore._order_terms(order_by or [])))
+        if limit is None:
+            return list(merged)
+        return list(islice(merged, offset, offset + limit))
+
+
+def _sort_key(order_terms):
+    # a heapq.merge key for widgets sorted by order terms that may mix directions
+    variables = [variable for variable, _ in order_terms]
+    descending = [d for _, d in order_terms]
+
+    class SortKey:
+        __slots__ = ('values',)
+
+        def __init__(self, widget):
+            self.values = [widget[variable] for variable in variables]
+
+        def __lt__(self, other):
+            for value, other_value, desc in zip(self.values, other.values, descending):
+                if value != other_value:
+                    return value > other_value if desc else value < other_value
+            return False
+
+    return SortKey
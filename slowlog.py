@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+
+# every cond_spec statement is tallied by shape (the spec with its constants stripped),
+# which is what the admin endpoint ranks. statements slower than the threshold are also
+# written, with their EXPLAIN QUERY PLAN, as json lines to a rotating log file when
+# SLOW_QUERY_LOG names one. every process writes its own file, with its pid put in
+# front of the extension, since a worker that rotated a shared file would leave the
+# other workers writing to the renamed one
+
+
+def spec_shape(cond_spec):
+    # constants are dropped and the conditions sorted, so specs that only differ in
+    # values or in condition order share a shape. a query spec's order is part of its
+    # shape, its limit value isn't
+    if not isinstance(cond_spec, dict):
+        return _conditions_shape(cond_spec, ' AND ') or '*'
+    where = cond_spec.get('where', [])
+    shape = _conditions_shape(where if isinstance(where, list) else [where], ' AND ') or '*'
+    if cond_spec.get('order_by'):
+        shape += ' ORDER BY ' + ', '.join(
+            '%s %s' % (term['variable'], term.get('direction', 'asc')) for term in cond_spec['order_by']
+        )
+    if 'limit' in cond_spec:
+        shape += ' LIMIT'
+    return shape
+
+
+def _conditions_shape(conds, operator):
+    return operator.join(sorted(_condition_shape(cond) for cond in conds))
+
+
+def _condition_shape(cond):
+    if 'predicate' in cond:
+        return '%s %s' % (cond['variable'], cond['predicate'])
+    if 'all' in cond:
+        return '(%s)' % _conditions_shape(cond['all'], ' AND ')
+    if 'any' in cond:
+        return '(%s)' % _conditions_shape(cond['any'], ' OR ')
+    return 'NOT %s' % _condition_shape(cond['not'])
+
+
+def _process_log_path(log_path):
+    # slow.log -> slow.<pid>.log
+    root, ext = os.path.splitext(log_path)
+    return '%s.%s%s' % (root, os.getpid(), ext)
+
+
+class SlowQueryRecorder:
+
+    def __init__(self, threshold_ms=None, log_path=None, max_bytes=None, backup_count=None, redact=None,
+                 max_shapes=None):
+        if threshold_ms is None:
+            threshold_ms = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '500'))
+        if log_path is None:
+            log_path = os.getenv('SLOW_QUERY_LOG', None)
+        if max_bytes is None:
+            max_bytes = int(os.getenv('SLOW_QUERY_LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+        if backup_count is None:
+            backup_count = int(os.getenv('SLOW_QUERY_LOG_BACKUPS', '5'))
+        if redact is None:
+            redact = os.getenv('SLOW_QUERY_REDACT', '0') == '1'
+        if max_shapes is None:
+            max_shapes = int(os.getenv('SLOW_QUERY_MAX_SHAPES', '1000'))
+        if max_shapes < 1:
+            raise ValueError('max_shapes must be at least 1, not %s' % max_shapes)
+        self.threshold = threshold_ms / 1000
+        self.redact = redact
+        self.max_shapes = max_shapes
+        self._shapes = {}  # (operation, shape) -> [count, total seconds, max seconds, total rows]
+        self._lock = threading.Lock()
+        self.log_path = None if log_path is None else _process_log_path(log_path)
+        self._logger = None
+        if self.log_path is not None:
+            self._logger = logging.getLogger('widgets.slow_queries.%s' % id(self))
+            self._logger.setLevel(logging.INFO)
+            self._logger.propagate = False
+            self._logger.addHandler(RotatingFileHandler(self.log_path, maxBytes=max_bytes, backupCount=backup_count))
+
+    def record(self, conn, operation, cond_spec, sql, params, elapsed, row_count):
+        shape = spec_shape(cond_spec)
+        with self._lock:
+            stats = self._shapes.get((operation, shape))
+            if stats is None:
+                if len(self._shapes) >= self.max_shapes:
+                    # nested groups make the number of shapes unbounded, so once the
+                    # cap is reached a new shape takes the place of the one with the
+                    # least total time, the one top_shapes would list last
+                    del self._shapes[min(self._shapes, key=lambda key: self._shapes[key][1])]
+                stats = self._shapes[(operation, shape)] = [0, 0.0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+            stats[3] += max(row_count, 0)
+        if self._logger is not None and elapsed >= self.threshold:
+            self._logger.info(json.dumps({
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'operation': operation,
+                'shape': shape,
+                'sql': ' '.join(sql.split()),
+                'params': [type(p).__name__ for p in params] if self.redact else params,
+                'row_count': row_count,
+                'elapsed_ms': round(elapsed * 1000, 3),
+                'query_plan': self._explain(conn, sql, params)
+            }))
+
+    def top_shapes(self, limit=20):
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._shapes.items()]
+        items.sort(key=lambda item: item[1][1], reverse=True)
+        return [
+            {
+                'operation': operation,
+                'shape': shape,
+                'count': count,
+                'total_ms': round(total * 1000, 3),
+                'mean_ms': round(total / count * 1000, 3),
+                'max_ms': round(max_elapsed * 1000, 3),
+                'rows': rows
+            }
+            for (operation, shape), (count, total, max_elapsed, rows) in items[:limit]
+        ]
+
+    def close(self):
+        if self._logger is not None:
+            for handler in list(self._logger.handlers):
+                self._logger.removeHandler(handler)
+                handler.close()
+
+    def reset(self):
+        with self._lock:
+            self._shapes.clear()
+
+    def _explain(self, conn, sql, params):
+        try:
+            return [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]  # nosec, sql is prebuilt
+        except Exception as ex:
+            return ['EXPLAIN QUERY PLAN failed: %s' % ex]
+
+
+recorder = None
+_recorder_lock = threading.Lock()
+
+
+def get_recorder():
+    global recorder
+    if recorder is None:
+        with _recorder_lock:
+            if recorder is None:
+                recorder = SlowQueryRecorder()
+    return recorder
+
+
+def record(conn, operation, cond_spec, sql, params, elapsed, row_count):
+    get_recorder().record(conn, operation, cond_spec, sql, params, elapsed, row_count)
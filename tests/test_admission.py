@@ -0,0 +1,219 @@
+import unittest
+import unittest.mock
+import json
+import os
+import tempfile
+import threading
+import time
+import asyncio
+
+_tmp_dir = tempfile.TemporaryDirectory()
+os.environ.setdefault('CONNECT_STR', os.path.join(_tmp_dir.name, 'widgets.db'))
+
+import admission  # noqa: E402
+import flaskapp  # noqa: E402, reads CONNECT_STR at import
+import asgiapp  # noqa: E402
+
+
+class TestAdmissionController(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = admission.AdmissionController(
+            capacity=4,
+            point_read_reserve=1,
+            point_write_reserve=0,
+            limits={admission.LIST: 2},
+            queue_size=1,
+            queue_timeout_ms=20,
+            rows_per_unit=100
+        )
+
+    def test_point_reads_keep_their_reserve(self):
+        ticket = self.controller.admit(admission.QUERY, 10)
+        self.assertEqual(ticket, (admission.QUERY, 3))  # charged the most a query can get
+        self.assertIsNone(self.controller.admit(admission.QUERY, 1))
+        self.assertIsNotNone(self.controller.admit(admission.POINT_READ, 1))
+        self.controller.release(ticket)
+        self.assertIsNotNone(self.controller.admit(admission.QUERY, 1))
+
+    def test_point_writes_keep_their_reserve(self):
+        controller = admission.AdmissionController(
+            capacity=6, point_read_reserve=1, point_write_reserve=2, limits={}, queue_size=0
+        )
+        ticket = controller.admit(admission.LIST, 100)
+        self.assertEqual(ticket, (admission.LIST, 3))
+        self.assertIsNone(controller.admit(admission.QUERY, 1))
+        point_write_tickets = [controller.admit(admission.POINT_WRITE, 1) for _ in range(2)]
+        self.assertNotIn(None, point_write_tickets)
+        self.assertIsNone(controller.admit(admission.POINT_WRITE, 1))
+        self.assertIsNotNone(controller.admit(admission.POINT_READ, 1))
+        controller.release(ticket)
+        # the point writes in flight only use their reserve, so other requests get it all back
+        self.assertEqual(controller.admit(admission.BULK_WRITE, 100), (admission.BULK_WRITE, 3))
+        with self.assertRaises(ValueError):
+            admission.AdmissionController(capacity=4, point_read_reserve=2, point_write_reserve=2)
+
+    def test_endpoint_limit(self):
+        self.controller.admit(admission.LIST, 1)
+        self.controller.admit(admission.LIST, 1)
+        self.assertIsNone(self.controller.admit(admission.LIST, 1))
+        self.assertIsNotNone(self.controller.admit(admission.QUERY, 1))
+
+    def test_queued_request_is_admitted_on_release(self):
+        ticket = self.controller.admit(admission.BULK_WRITE, 3)
+        self.controller.queue_timeout = 5
+        releaser = threading.Timer(0.05, self.controller.release, (ticket,))
+        releaser.start()
+        start = time.monotonic()
+        self.assertIsNotNone(self.controller.admit(admission.BULK_WRITE, 3))
+        self.assertLess(time.monotonic() - start, 5)
+        releaser.join()
+
+    def test_full_queue_sheds_immediately(self):
+        ticket = self.controller.admit(admission.BULK_WRITE, 3)
+        self.controller.queue_timeout = 5
+        waiter = threading.Thread(target=self.controller.admit, args=(admission.BULK_WRITE, 1))
+        waiter.start()
+        while dict(self.controller.stats()).get(('waiting', admission.BULK_WRITE), 0) == 0:
+            time.sleep(0.001)
+        start = time.monotonic()
+        self.assertIsNone(self.controller.admit(admission.BULK_WRITE, 1))
+        self.assertLess(time.monotonic() - start, 1)
+        self.controller.release(ticket)
+        waiter.join()
+
+    def test_cond_spec_row_estimates(self):
+        self.assertEqual(admission.estimate_cond_spec_rows(
+            [{"predicate": "eq", "variable": "name", "constants": ["a"]}], 1000
+        ), 1)
+        self.assertEqual(admission.estimate_cond_spec_rows([], 1000), 1000)
+        prefix = admission.estimate_cond_spec_rows(
+            [{"predicate": "like", "variable": "name", "constants": ["w1%"]}], 1000
+        )
+        suffix = admission.estimate_cond_spec_rows(
+            [{"predicate": "like", "variable": "name", "constants": ["%1"]}], 1000
+        )
+        self.assertLess(prefix, suffix)
+        either = admission.estimate_cond_spec_rows(
+            [{"any": [{"predicate": "lt", "variable": "num_of_parts", "constants": [3]},
+                      {"predicate": "gt", "variable": "num_of_parts", "constants": [7]}]}], 1000
+        )
+        self.assertGreater(either, admission.estimate_cond_spec_rows(
+            [{"predicate": "lt", "variable": "num_of_parts", "constants": [3]}], 1000
+        ))
+        self.assertEqual(admission.estimate_cond_spec_rows({"order_by": [], "limit": 10}, 1000), 10)
+
+    def test_parse_limits(self):
+        self.assertEqual(admission.parse_limits('list=4, query=8'), {'list': 4, 'query': 8})
+        self.assertEqual(admission.parse_limits(''), {})
+
+
+class TestFlaskAppAdmission(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = admission.AdmissionController(
+            capacity=5,
+            point_read_reserve=1,
+            point_write_reserve=1,
+            queue_size=0,
+            retry_after_s=2,
+            rows_per_unit=10,
+            row_count_ttl_s=0
+        )
+        self.controller_patcher = unittest.mock.patch.object(flaskapp, '_admission_controller', self.controller)
+        self.controller_patcher.start()
+        self.client = flaskapp.app.test_client()
+        self.client.put('/widgets', json=[{"name": "w%s" % i, "num_of_parts": i} for i in range(20)])
+
+    def tearDown(self):
+        self.controller_patcher.stop()
+        self.client.delete('/widgets')
+
+    def test_shed_with_retry_after_while_point_reads_go_through(self):
+        held = self.controller.admit(admission.BULK_WRITE, 3)
+        response = self.client.get('/widgets')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '2')
+        self.assertEqual(response.get_json()['error class'], 'server overloaded')
+        self.assertEqual(self.client.get('/widgets/w1').status_code, 200)
+        self.assertEqual(self.client.patch('/widgets/w1', json={"num_of_parts": 5}).status_code, 200)
+        self.controller.release(held)
+        self.assertEqual(self.client.get('/widgets').status_code, 200)
+
+    def test_request_costs(self):
+        with flaskapp.app.test_request_context('/widgets', method='GET'):
+            self.assertEqual(flaskapp.estimate_request_cost(admission.LIST), 2)
+        with flaskapp.app.test_request_context('/widgets', method='GET', query_string={'limit': 5}):
+            self.assertEqual(flaskapp.estimate_request_cost(admission.LIST), 1)
+        with flaskapp.app.test_request_context(
+            '/widgets/query',
+            method='POST',
+            json=[{"predicate": "eq", "variable": "name", "constants": ["w1"]}]
+        ):
+            self.assertEqual(flaskapp.estimate_request_cost(admission.QUERY), 1)
+
+    def test_tickets_are_released(self):
+        for _ in range(10):
+            self.client.get('/widgets')
+            self.client.get('/widgets/w1')
+            self.client.post('/widgets/query', json='not a cond_spec')
+        self.assertEqual(dict(self.controller.stats())[('units_in_use', 'all')], 0)
+
+
+class TestASGIAppAdmission(unittest.TestCase):
+
+    def setUp(self):
+        self.asgi_app = asgiapp.WidgetsASGIApp(max_workers=2)
+        self.controller = self.asgi_app.admission_controller = admission.AdmissionController(
+            capacity=5,
+            point_read_reserve=1,
+            point_write_reserve=1,
+            queue_size=0,
+            retry_after_s=2,
+            rows_per_unit=10,
+            row_count_ttl_s=0
+        )
+        self.dispatch('PUT', '/widgets', [{"name": "w%s" % i, "num_of_parts": i} for i in range(20)])
+
+    def tearDown(self):
+        self.asgi_app.admission_controller = None
+        self.dispatch('DELETE', '/widgets')
+        self.asgi_app.close()
+
+    def dispatch(self, method, path, json_body=None):
+        body = b'' if json_body is None else json.dumps(json_body).encode('utf-8')
+        headers = {} if json_body is None else {'content-type': 'application/json'}
+        return asyncio.run(self.asgi_app.dispatch(asgiapp._Request(method, path, b'', headers, body)))
+
+    def test_shed_with_retry_after_while_point_requests_go_through(self):
+        held = self.controller.admit(admission.BULK_WRITE, 3)
+        response = self.dispatch('GET', '/widgets')
+        self.assertEqual(response.status, 503)
+        self.assertIn(('retry-after', '2'), response.headers)
+        self.assertEqual(response.json_obj['error class'], 'server overloaded')
+        self.assertEqual(self.dispatch('GET', '/widgets/w1').status, 200)
+        self.assertEqual(self.dispatch('PATCH', '/widgets/w1', {"num_of_parts": 5}).status, 200)
+        self.controller.release(held)
+        self.assertEqual(self.dispatch('GET', '/widgets').status, 200)
+        self.assertEqual(dict(self.controller.stats())[('units_in_use', 'all')], 0)
+
+    def test_ticket_granted_after_the_request_is_cancelled_is_released(self):
+        self.controller.queue_size = 1
+        self.controller.queue_timeout = 5
+        held = self.controller.admit(admission.BULK_WRITE, 3)
+
+        async def cancel_while_queued():
+            task = asyncio.ensure_future(self.asgi_app.dispatch(asgiapp._Request('GET', '/widgets', b'', {}, b'')))
+            while dict(self.controller.stats()).get(('waiting', admission.LIST), 0) == 0:
+                await asyncio.sleep(0.001)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.controller.release(held)
+            deadline = time.monotonic() + 5
+            while dict(self.controller.stats())[('units_in_use', 'all')] != 0 and time.monotonic() < deadline:
+                await asyncio.sleep(0.001)
+
+        asyncio.run(cancel_while_queued())
+        self.assertEqual(dict(self.controller.stats())[('units_in_use', 'all')], 0)
+        self.assertEqual(dict(self.controller.stats())[('in_flight', admission.LIST)], 0)
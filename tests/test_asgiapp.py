@@ -0,0 +1,237 @@
+import unittest
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import unittest.mock
+from urllib.parse import unquote
+
+_tmp_dir = tempfile.TemporaryDirectory()
+os.environ.setdefault('CONNECT_STR', os.path.join(_tmp_dir.name, 'widgets.db'))
+
+import flaskapp  # noqa: E402, both apps read CONNECT_STR at import
+import asgiapp  # noqa: E402
+
+
+def call_asgi(app, method, path, json_body=None, query_string=b'', extra_headers=None):
+    body = b'' if json_body is None else json.dumps(json_body).encode('utf-8')
+    headers = [] if json_body is None else [(b'content-type', b'application/json')]
+    headers.extend((k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in (extra_headers or {}).items())
+    # path is what the client sent, which asgi servers pass on percent-decoded
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': unquote(path),
+        'raw_path': path.encode('latin-1'),
+        'query_string': query_string,
+        'headers': headers
+    }
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    response_body = b''.join(m.get('body', b'') for m in sent if m['type'] == 'http.response.body')
+    return sent[0]['status'], json.loads(response_body) if response_body else None
+
+
+class TestASGIAppMatchesFlaskApp(unittest.TestCase):
+
+    def setUp(self):
+        self.flask_client = flaskapp.app.test_client()
+        self.asgi_app = asgiapp.WidgetsASGIApp(max_workers=2)
+
+    def tearDown(self):
+        self.asgi_app.close()
+        self.flask_client.delete('/widgets')
+
+    def assert_same_response(self, method, path, json_body=None, query_string=b''):
+        flask_response = self.flask_client.open(
+            path,
+            method=method,
+            json=json_body,
+            query_string=query_string.decode('utf-8')
+        )
+        self.flask_client.delete('/widgets')
+        if method != 'PUT' or path != '/widgets':
+            self.flask_client.put('/widgets', json=self.seed)
+        status, json_obj = call_asgi(self.asgi_app, method, path, json_body, query_string)
+        self.assertEqual(status, flask_response.status_code)
+        self.assertEqual(json_obj, flask_response.get_json())
+        return status, json_obj
+
+    def test_routes_and_error_shapes(self):
+        self.seed = [
+            {"name": "w%s" % i, "num_of_parts": i, "colour": "red"}
+            for i in range(20)
+        ] + [{"name": "a%41", "num_of_parts": 1}, {"name": "a b", "num_of_parts": 2}]
+        requests = [
+            ('GET', '/widgets', None, b''),
+            ('GET', '/widgets', None, b'limit=10&offset=5'),
+            ('GET', '/widgets', None, b'limit=-1'),
+            ('POST', '/widgets/query', [], b'limit=5&offset=-3'),
+            ('GET', '/widgets/w7', None, b''),
+            ('GET', '/widgets/missing', None, b''),
+            ('GET', '/widgets/a%2541', None, b''),
+            ('GET', '/widgets/aA', None, b''),
+            ('GET', '/widgets/a%20b', None, b''),
+            ('PATCH', '/widgets/a%2541', {"num_of_parts": 5}, b''),
+            ('DELETE', '/widgets/a%2541', None, b''),
+            ('POST', '/widgets/query', {
+                "where": [{"predicate": "lt", "variable": "num_of_parts", "constants": [3]}],
+                "order_by": [{"variable": "num_of_parts"}]
+            }, b''),
+            ('POST', '/widgets/query', [{"predicate": "lt", "variable": 5, "constants": [3]}], b''),
+            ('POST', '/widgets/add', [{"name": "new", "num_of_parts": 1}], b''),
+            ('POST', '/widgets/add', [{"name": "new"}], b''),
+            ('POST', '/widgets/delete', [{"predicate": "gt", "variable": "num_of_parts", "constants": [3]}], b''),
+            ('PUT', '/widgets/brand_new', {"name": "brand_new", "num_of_parts": 3}, b''),
+            ('PUT', '/widgets/w3', {"name": "w3", "num_of_parts": 30}, b''),
+            ('PATCH', '/widgets/w4', {"num_of_parts": 40, "colour": None, "size": {"w": 1}}, b''),
+            ('PATCH', '/widgets/w4', {"name": "renamed"}, b''),
+            ('PATCH', '/widgets/w4', {"num_of_parts": "many"}, b''),
+            ('PATCH', '/widgets/w4', [1, 2], b''),
+            ('PATCH', '/widgets/missing', {"num_of_parts": 1}, b''),
+            ('DELETE', '/widgets/w9', None, b''),
+            ('DELETE', '/widgets/missing', None, b''),
+            ('DELETE', '/widgets', None, b''),
+            ('PUT', '/widgets', [{"name": "a", "num_of_parts": 1}], b''),
+        ]
+        for method, path, json_body, query_string in requests:
+            self.flask_client.put('/widgets', json=self.seed)
+            with self.subTest(method=method, path=path, query_string=query_string):
+                self.assert_same_response(method, path, json_body, query_string)
+
+    def test_put_keeps_created_date_and_patch_updates_in_place(self):
+        self.flask_client.put('/widgets/w', json={"name": "w", "num_of_parts": 1})
+        widget_store = flaskapp.WidgetStore()
+        widget_store.patch_widget('w', {"created_date": "2000-01-01", "updated_date": "2000-01-01"})
+        widget_store.close()
+        response = self.flask_client.put('/widgets/w', json={"name": "w", "num_of_parts": 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['created_date'], '2000-01-01')
+        response = self.flask_client.patch('/widgets/w', json={"num_of_parts": 3, "created_date": "1999-01-01"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['num_of_parts'], 3)
+        self.assertEqual(response.get_json()['created_date'], '2000-01-01')
+        self.assertNotEqual(response.get_json()['updated_date'], '2000-01-01')
+
+    def test_if_match(self):
+        self.seed = [{"name": "w", "num_of_parts": 1}]
+        self.flask_client.put('/widgets', json=self.seed)
+        self.assertEqual(self.flask_client.get('/widgets/w').headers['ETag'], '"1"')
+        requests = [
+            ('PUT', '/widgets/w', {"name": "w", "num_of_parts": 2}, {'If-Match': '"1"'}),
+            ('PUT', '/widgets/w', {"name": "w", "num_of_parts": 2}, {'If-Match': '"2"'}),
+            ('PUT', '/widgets/w', {"name": "w", "num_of_parts": 2}, {'If-Match': '*'}),
+            ('PUT', '/widgets/new', {"name": "new", "num_of_parts": 2}, {'If-Match': '"1"'}),
+            ('PATCH', '/widgets/w', {"num_of_parts": 3}, {'If-Match': '"1"'}),
+            ('PATCH', '/widgets/w', {"num_of_parts": 3}, {'If-Match': 'W/"1"'}),
+            ('PATCH', '/widgets/w', {"num_of_parts": 3}, {'If-Match': '"1", "2"'}),
+            ('DELETE', '/widgets/w', None, {'If-Match': '"7"'}),
+            ('DELETE', '/widgets/w', None, {'If-Match': '"1"'}),
+        ]
+        expected_statuses = [200, 412, 200, 412, 200, 412, 412, 412, 204]
+        for (method, path, json_body, headers), expected_status in zip(requests, expected_statuses):
+            with self.subTest(method=method, path=path, headers=headers):
+                flask_response = self.flask_client.open(path, method=method, json=json_body, headers=headers)
+                self.flask_client.delete('/widgets')  # so the seeded widget starts over at version 1
+                self.flask_client.put('/widgets', json=self.seed)
+                status, json_obj = call_asgi(self.asgi_app, method, path, json_body, extra_headers=headers)
+                self.flask_client.delete('/widgets')
+                self.flask_client.put('/widgets', json=self.seed)
+                self.assertEqual(flask_response.status_code, expected_status)
+                self.assertEqual(status, expected_status)
+                self.assertEqual(json_obj, flask_response.get_json())
+        response = self.flask_client.patch('/widgets/w', json={"num_of_parts": 3}, headers={'If-Match': '"1"'})
+        self.assertEqual(response.headers['ETag'], '"2"')
+        response = self.flask_client.put(
+            '/widgets/w', json={"name": "w", "num_of_parts": 4}, headers={'If-Match': '"2"'}
+        )
+        self.assertEqual(response.headers['ETag'], '"3"')
+
+    def test_bulk_writes_report_written_and_skipped_counts(self):
+        self.flask_client.put('/widgets', json=[{"name": "a", "num_of_parts": 1}, {"name": "b", "num_of_parts": 2}])
+        resent = [{"name": "a", "num_of_parts": 1}, {"name": "b", "num_of_parts": 3}, {"name": "c", "num_of_parts": 4}]
+        response = self.flask_client.post('/widgets/add', json=resent)
+        self.assertEqual((response.headers['X-Widgets-Written'], response.headers['X-Widgets-Skipped']), ('2', '1'))
+        response = self.flask_client.put('/widgets', json=resent[:2])
+        self.assertEqual((response.headers['X-Widgets-Written'], response.headers['X-Widgets-Skipped']), ('0', '2'))
+        self.assertEqual(len(self.flask_client.get('/widgets').get_json()), 2)
+        scope = {
+            'type': 'http',
+            'method': 'POST',
+            'path': '/widgets/add',
+            'query_string': b'',
+            'headers': [(b'content-type', b'application/json')]
+        }
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': json.dumps(resent).encode('utf-8'), 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(self.asgi_app(scope, receive, send))
+        headers = dict(sent[0]['headers'])
+        self.assertEqual((headers[b'x-widgets-written'], headers[b'x-widgets-skipped']), (b'1', b'2'))
+
+    def test_list_results_are_streamed(self):
+        self.flask_client.put('/widgets', json=[{"name": "w%s" % i, "num_of_parts": i} for i in range(1200)])
+        scope = {'type': 'http', 'method': 'GET', 'path': '/widgets', 'query_string': b'', 'headers': []}
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(self.asgi_app(scope, receive, send))
+        body_messages = [m for m in sent if m['type'] == 'http.response.body']
+        self.assertGreater(len(body_messages), 3)
+        self.assertEqual(len(json.loads(b''.join(m['body'] for m in body_messages))), 1200)
+
+    def test_unexpected_exceptions_are_logged_and_busy_errors_counted(self):
+        busy_errors = asgiapp.metrics.SQLITE_BUSY_ERRORS.value()
+        with unittest.mock.patch.object(
+            asgiapp.WidgetStore, 'get_widget_by_name', side_effect=sqlite3.OperationalError('database is locked')
+        ), self.assertLogs(asgiapp.logger, 'ERROR') as logs:
+            status, json_obj = call_asgi(self.asgi_app, 'GET', '/widgets/w')
+        self.assertEqual((status, json_obj), (500, {"error class": "internal server error"}))
+        self.assertIn('database is locked', logs.output[0])
+        self.assertEqual(asgiapp.metrics.SQLITE_BUSY_ERRORS.value(), busy_errors + 1)
+
+    def test_bulk_writes_echo_the_stored_dates(self):
+        self.flask_client.put('/widgets', json=[{"name": "a", "num_of_parts": 1}, {"name": "b", "num_of_parts": 2}])
+        widget_store = flaskapp.WidgetStore()
+        with widget_store.conn:  # backdated without touching the content hashes
+            widget_store.conn.execute("UPDATE widgets SET CreatedDate = '2020-01-01', UpdatedDate = '2020-01-02'")
+        widget_store.close()
+        resent = [{"name": "a", "num_of_parts": 1}, {"name": "b", "num_of_parts": 3}, {"name": "c", "num_of_parts": 4}]
+        today = asgiapp._today()
+        expected_dates = {
+            'a': ('2020-01-01', '2020-01-02'),
+            'b': ('2020-01-01', today),
+            'c': (today, today)
+        }
+        for method, path in (('POST', '/widgets/add'), ('PUT', '/widgets')):
+            with self.subTest(method=method, path=path):
+                flask_response = self.flask_client.open(path, method=method, json=resent)
+                self.assertEqual(
+                    dict((w['name'], (w['created_date'], w['updated_date'])) for w in flask_response.get_json()),
+                    expected_dates
+                )
+                stored_widgets = self.flask_client.get('/widgets').get_json()
+                self.assertEqual(
+                    dict((w['name'], (w['created_date'], w['updated_date'])) for w in stored_widgets),
+                    expected_dates
+                )
+        status, json_obj = call_asgi(self.asgi_app, 'POST', '/widgets/add', resent)
+        self.assertEqual(dict((w['name'], (w['created_date'], w['updated_date'])) for w in json_obj), expected_dates)
@@ -0,0 +1,86 @@
+import argparse
+import unittest
+import unittest.mock
+
+from benchmarks import datagen
+from benchmarks import load
+from benchmarks.suite import BenchmarkSuite
+from benchmarks.suite import compare
+
+
+class TestDatagen(unittest.TestCase):
+
+    def test_generation_is_seeded_and_batch_independent(self):
+        whole = list(datagen.widget_json_objs(10, flex_width=3, seed=4))
+        self.assertEqual(whole, list(datagen.widget_json_objs(10, flex_width=3, seed=4)))
+        self.assertEqual(whole[6:], list(datagen.widget_json_objs(4, flex_width=3, seed=4, start=6)))
+        self.assertNotEqual(whole, list(datagen.widget_json_objs(10, flex_width=3, seed=5)))
+        self.assertEqual(len(whole[0]), 4 + 3)
+
+
+class TestLoad(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 11))
+        self.assertEqual(load.percentile(values, 0.5), 6)
+        self.assertEqual(load.percentile(values, 0.9), 10)
+        self.assertEqual(load.percentile(values, 1.0), 10)  # clamped to the last value
+        self.assertEqual(load.percentile([7], 0.99), 7)
+        self.assertIsNone(load.percentile([], 0.5))
+
+    def test_parse_mix(self):
+        self.assertEqual(load.parse_mix('read=60, write=20,bulk=0.5'), {'read': 60.0, 'write': 20.0, 'bulk': 0.5})
+        with self.assertRaises(argparse.ArgumentTypeError):
+            load.parse_mix('read=60,scan=40')
+        with self.assertRaises(ValueError):
+            load.parse_mix('read=lots')
+
+    def test_summarise(self):
+        load_generator = unittest.mock.Mock(
+            results={
+                'read': {'latencies': [0.003, 0.001, 0.002, 0.004], 'errors': 0, 'statuses': {200: 4}},
+                'bulk': {'latencies': [], 'errors': 2, 'statuses': {503: 2}},
+            },
+            rate=5.0,
+            dropped=1,
+            client_retries=3
+        )
+        summary = load.summarise(load_generator, 2.0, [0, 4096], 7)
+        self.assertEqual(summary['achieved_rate_per_s'], 2.0)
+        self.assertEqual(summary['target_rate_per_s'], 5.0)
+        self.assertEqual(summary['dropped_for_saturation'], 1)
+        self.assertEqual(summary['client_retries'], 3)
+        self.assertEqual(summary['server_sqlite_busy_errors'], 7)
+        self.assertEqual(summary['wal_bytes'], [0, 4096])
+        read = summary['ops']['read']
+        self.assertEqual((read['count'], read['errors'], read['throughput_per_s']), (4, 0, 2.0))
+        self.assertAlmostEqual(read['p50_ms'], 3.0)
+        self.assertAlmostEqual(read['p99_ms'], 4.0)
+        self.assertAlmostEqual(read['max_ms'], 4.0)
+        self.assertAlmostEqual(read['mean_ms'], 2.5)
+        bulk = summary['ops']['bulk']
+        self.assertEqual((bulk['count'], bulk['errors'], bulk['statuses']), (0, 2, {503: 2}))
+        self.assertEqual((bulk['p50_ms'], bulk['max_ms'], bulk['mean_ms']), (None, None, None))
+
+
+class TestBenchmarkSuite(unittest.TestCase):
+
+    def test_suite_runs_and_compares(self):
+        results = BenchmarkSuite(rows=30, repeat=1, min_time=0).run(log=lambda line: None)
+        errors = dict((k, v['error']) for k, v in results['results'].items() if 'error' in v)
+        self.assertEqual(errors, {})
+        self.assertIn('store.get_widgets_by_cond_spec[num_of_parts between]', results['results'])
+        slower = {'meta': results['meta'], 'results': dict(
+            (k, dict(v, median_s=v['median_s'] * 2)) for k, v in results['results'].items()
+        )}
+        rows, regressions = compare(slower, results, threshold=0.5)
+        self.assertEqual(len(rows), len(results['results']))
+        self.assertEqual(len(regressions), len(rows))
+        self.assertEqual(compare(results, slower, threshold=0.5)[1], [])
+        errored = {'meta': results['meta'], 'results': dict(results['results'], **{
+            'store.get_widgets_by_cond_spec[num_of_parts between]': {'error': 'OperationalError: no such table'}
+        })}
+        self.assertEqual(
+            [name for name, _, _, _ in compare(errored, results, threshold=0.5)[1]],
+            ['store.get_widgets_by_cond_spec[num_of_parts between]']
+        )
@@ -0,0 +1,119 @@
+import unittest
+import unittest.mock
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import jsonschema
+
+_tmp_dir = tempfile.TemporaryDirectory()
+os.environ.setdefault('CONNECT_STR', os.path.join(_tmp_dir.name, 'widgets.db'))
+
+import bulkingest  # noqa: E402
+import flaskapp  # noqa: E402, reads CONNECT_STR at import
+from widgets import WidgetStore  # noqa: E402
+
+
+def widget_json_objs(count):
+    return [
+        {"name": "w%s" % i, "num_of_parts": i, "created_date": "2021-04-25", "updated_date": "2021-04-25", "i": i}
+        for i in range(count)
+    ]
+
+
+class TestEncodeWidgetRows(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.executor = ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context('spawn'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.executor.shutdown()
+
+    def encode_in_parallel(self, json_objs):
+        return bulkingest.encode_widget_rows(json_objs, min_items=1, chunk_size=7, executor=self.executor)
+
+    def test_parallel_rows_match_inline_rows(self):
+        json_objs = widget_json_objs(50)
+        self.assertEqual(list(self.encode_in_parallel(json_objs)), bulkingest.encode_widget_rows(json_objs))
+
+    def test_first_invalid_widget_in_input_order_is_reported(self):
+        json_objs = widget_json_objs(50)
+        json_objs[40]["num_of_parts"] = "many"
+        json_objs[9]["name"] = 9
+        with self.assertRaises(jsonschema.exceptions.ValidationError) as inline:
+            bulkingest.encode_widget_rows(json_objs)
+        rows = []
+        with self.assertRaises(jsonschema.exceptions.ValidationError) as parallel:
+            rows.extend(self.encode_in_parallel(json_objs))
+        self.assertEqual(parallel.exception.message, inline.exception.message)
+        self.assertEqual([row[0] for row in rows], ["w%s" % i for i in range(9)])
+
+    def test_invalid_widget_rolls_back_the_streamed_write(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            widget_store = WidgetStore(os.path.join(tmp_dir, 'widgets.db'))
+            json_objs = widget_json_objs(50)
+            self.assertEqual(widget_store.put_widget_rows(self.encode_in_parallel(json_objs[:20])), 20)
+            json_objs[45]["num_of_parts"] = None
+            with self.assertRaises(jsonschema.exceptions.ValidationError):
+                widget_store.replace_all_widget_rows(self.encode_in_parallel(json_objs))
+            self.assertEqual(len(widget_store.get_all_widgets()), 20)
+            self.assertEqual(widget_store.replace_all_widget_rows(self.encode_in_parallel(json_objs[10:30])), 10)
+            self.assertEqual(
+                sorted(w['name'] for w in widget_store.get_all_widgets()),
+                sorted("w%s" % i for i in range(10, 30))
+            )
+            widget_store.close()
+
+    def test_default_workers_share_the_cores_between_app_processes(self):
+        with unittest.mock.patch('os.cpu_count', return_value=16):
+            with unittest.mock.patch.dict(os.environ, {'WEB_CONCURRENCY': '8'}):
+                self.assertEqual(bulkingest.default_workers(), 2)
+            with unittest.mock.patch.dict(os.environ, {'WEB_CONCURRENCY': '1'}):
+                self.assertEqual(bulkingest.default_workers(), bulkingest.DEFAULT_MAX_WORKERS)
+
+
+class TestFlaskAppBulkIngest(unittest.TestCase):
+
+    def setUp(self):
+        self.env_patcher = unittest.mock.patch.dict(os.environ, {
+            'BULK_INGEST_WORKERS': '2',
+            'BULK_INGEST_MIN_ITEMS': '10',
+            'BULK_INGEST_CHUNK_SIZE': '4'
+        })
+        self.env_patcher.start()
+        self.client = flaskapp.app.test_client()
+
+    def tearDown(self):
+        self.env_patcher.stop()
+        self.client.delete('/widgets')
+        if bulkingest._ingest_executor is not None:
+            bulkingest._ingest_executor.shutdown()
+            bulkingest._ingest_executor = None
+
+    def test_large_payloads_are_encoded_by_worker_processes(self):
+        json_objs = [{"name": "w%s" % i, "num_of_parts": i} for i in range(30)]
+        response = self.client.post('/widgets/add', json=json_objs)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Widgets-Written'], '30')
+        self.assertIsNotNone(bulkingest._ingest_executor)
+        json_objs[25]["num_of_parts"] = "many"
+        response = self.client.put('/widgets', json=json_objs[5:])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['cause'], "'many' is not of type 'integer'")
+        self.assertEqual(len(self.client.get('/widgets').get_json()), 30)
+
+    def test_broken_pool_is_replaced_and_the_payload_encoded_inline(self):
+        json_objs = [{"name": "w%s" % i, "num_of_parts": i} for i in range(30)]
+        self.assertEqual(self.client.put('/widgets', json=json_objs).status_code, 200)
+        broken_executor = bulkingest._ingest_executor
+        for process in list(broken_executor._processes.values()):
+            process.kill()
+            process.join()
+        response = self.client.put('/widgets', json=json_objs[5:])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.client.get('/widgets').get_json()), 25)
+        self.assertIsNot(bulkingest.get_ingest_executor(), broken_executor)
+        self.assertEqual(self.client.post('/widgets/add', json=json_objs[:5]).headers['X-Widgets-Written'], '5')
@@ -0,0 +1,93 @@
+import unittest
+import unittest.mock
+import os
+import sqlite3
+import tempfile
+
+_tmp_dir = tempfile.TemporaryDirectory()
+os.environ.setdefault('CONNECT_STR', os.path.join(_tmp_dir.name, 'widgets.db'))
+
+from widgets import Widget  # noqa: E402
+from widgets import StoreUnavailableError  # noqa: E402
+from connpool import ReadWriteSplit  # noqa: E402
+import flaskapp  # noqa: E402, reads CONNECT_STR at import
+
+
+class TestReadWriteSplit(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.connect_str = os.path.join(self.tmp_dir.name, 'widgets.db')
+        self.read_write_split = ReadWriteSplit(self.connect_str, reader_pool_size=2)
+        self.sample_widget = Widget(
+            name='sample',
+            num_of_parts=5,
+            created_date='2012-06-14',
+            updated_date='2021-04-25'
+        )
+
+    def tearDown(self):
+        self.read_write_split.close()
+        self.tmp_dir.cleanup()
+
+    def test_writer_runs_in_wal_mode(self):
+        with self.read_write_split.readers.reader() as reader_store:
+            self.assertEqual(reader_store.conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+    def test_readers_see_writes_and_cannot_write(self):
+        self.read_write_split.writer.put_widget(self.sample_widget)
+        with self.read_write_split.readers.reader() as reader_store:
+            self.assertEqual(reader_store.get_widget_by_name('sample'), self.sample_widget)
+            with self.assertRaises(sqlite3.OperationalError):
+                reader_store.put_widget(self.sample_widget)
+        self.assertEqual(self.read_write_split.readers.stats()['idle'], 1)
+
+    def test_exhausted_pool_gives_up_waiting(self):
+        readers = self.read_write_split.readers
+        readers.acquire_timeout = 0.01
+        held = [readers.acquire(), readers.acquire()]
+        with self.assertRaises(StoreUnavailableError):
+            readers.acquire()
+        readers.release(held.pop())
+        held.append(readers.acquire())
+        for reader_store in held:
+            readers.release(reader_store)
+
+    def test_checkpoint_truncates_wal_over_size_limit(self):
+        checkpointer = self.read_write_split.checkpointer
+        self.read_write_split.writer.put_widget(self.sample_widget)
+        self.assertGreater(checkpointer.wal_size(), 0)
+        checkpointer.size_limit_bytes = 0
+        mode, busy, _, _ = checkpointer.checkpoint_once()
+        self.assertEqual((mode, busy), ('TRUNCATE', 0))
+        self.assertEqual(checkpointer.wal_size(), 0)
+
+    def test_memory_db_is_rejected(self):
+        with self.assertRaises(ValueError):
+            ReadWriteSplit(':memory:')
+
+
+class TestFlaskAppReaderPool(unittest.TestCase):
+
+    def setUp(self):
+        self.read_write_split = ReadWriteSplit(os.environ['CONNECT_STR'], reader_pool_size=1)
+        self.read_write_split.readers.acquire_timeout = 0.01
+        self.patchers = [
+            unittest.mock.patch.dict(os.environ, {'READ_WRITE_SPLIT': '1'}),
+            unittest.mock.patch.object(flaskapp, '_read_write_split', self.read_write_split)
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+        self.client = flaskapp.app.test_client()
+
+    def tearDown(self):
+        for patcher in reversed(self.patchers):
+            patcher.stop()
+        self.read_write_split.close()
+
+    def test_exhausted_pool_is_a_503(self):
+        with self.read_write_split.readers.reader():
+            response = self.client.get('/widgets/w1')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(self.client.get('/widgets/w1').status_code, 404)
@@ -0,0 +1,96 @@
+import unittest
+import os
+import tempfile
+import threading
+import time
+import unittest.mock
+
+from widgets import Widget
+from widgets import WidgetStore
+from widgets import StoreUnavailableError
+from groupcommit import GroupCommitWriter
+
+
+class TestGroupCommitWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.connect_str = os.path.join(self.tmp_dir.name, 'widgets.db')
+        self.writer = GroupCommitWriter(self.connect_str, max_batch_delay_ms=20, max_batch_size=16)
+
+    def tearDown(self):
+        self.writer.close()
+        self.tmp_dir.cleanup()
+
+    def test_concurrent_puts_are_all_committed(self):
+        def put(i):
+            self.writer.put_widget(
+                Widget(name='w%s' % i, num_of_parts=i, created_date='2021-04-25', updated_date='2021-04-25')
+            )
+        threads = [threading.Thread(target=put, args=(i,)) for i in range(40)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        widget_store = WidgetStore(self.connect_str)
+        self.assertEqual(len(widget_store.get_all_widgets()), 40)
+        self.assertEqual(widget_store.get_widget_by_name('w17')['num_of_parts'], 17)
+        widget_store.close()
+
+    def test_failed_op_does_not_fail_its_batch(self):
+        put_future = self.writer.submit(
+            '_write_widget',
+            Widget(name='kept', num_of_parts=1, created_date='2021-04-25', updated_date='2021-04-25')
+        )
+        delete_future = self.writer.submit('_erase_widget_by_name', 'missing')
+        self.assertEqual(put_future.result(), 1)
+        with self.assertRaises(LookupError):
+            delete_future.result()
+        self.writer.delete_widget_by_name('kept')
+        with self.assertRaises(LookupError):
+            self.writer.delete_widget_by_name('kept')
+
+    def test_patch_widget(self):
+        self.writer.put_widget(
+            Widget(name='patched', num_of_parts=1, created_date='2021-04-25', updated_date='2021-04-25', colour='red')
+        )
+        self.assertEqual(
+            self.writer.patch_widget('patched', {"num_of_parts": 2, "colour": None}),
+            Widget(name='patched', num_of_parts=2, created_date='2021-04-25', updated_date='2021-04-25')
+        )
+        with self.assertRaises(LookupError):
+            self.writer.patch_widget('missing', {"num_of_parts": 2})
+
+    def test_writer_outlives_a_batch_that_throws(self):
+        commit_batch = self.writer._commit_batch
+        failures = [RuntimeError('ROLLBACK failed')]
+
+        def failing_once(batch):
+            if failures:
+                raise failures.pop()
+            commit_batch(batch)
+
+        with unittest.mock.patch.object(self.writer, '_commit_batch', failing_once):
+            with self.assertRaises(RuntimeError):
+                self.writer.delete_widget_by_name('w')
+            self.assertEqual(self.writer.put_widget(
+                Widget(name='w', num_of_parts=1, created_date='2021-04-25', updated_date='2021-04-25')
+            ), 1)
+
+    def test_writes_the_writer_does_not_get_to_in_time_are_given_up_on(self):
+        self.writer.result_timeout = 0.01
+        commit_batch = self.writer._commit_batch
+
+        def slow(batch):
+            time.sleep(0.1)
+            commit_batch(batch)
+
+        with unittest.mock.patch.object(self.writer, '_commit_batch', slow):
+            with self.assertRaises(StoreUnavailableError):
+                self.writer.put_widget(
+                    Widget(name='w', num_of_parts=1, created_date='2021-04-25', updated_date='2021-04-25')
+                )
+
+    def test_bad_config(self):
+        with self.assertRaises(ValueError):
+            GroupCommitWriter(self.connect_str, max_batch_size=0)
@@ -0,0 +1,129 @@
+import unittest
+import unittest.mock
+import os
+import tempfile
+
+import metrics
+
+_tmp_dir = tempfile.TemporaryDirectory()
+os.environ.setdefault('CONNECT_STR', os.path.join(_tmp_dir.name, 'widgets.db'))
+
+import flaskapp  # noqa: E402, reads CONNECT_STR at import
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_render_is_cumulative_prometheus_text(self):
+        histogram = metrics.Histogram('test_seconds', 'a test histogram', ('route',), buckets=(0.1, 1))
+        histogram.observe(0.05, '/widgets')
+        histogram.observe(0.5, '/widgets')
+        histogram.observe(5, '/widgets')
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds a test histogram',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{route="/widgets",le="0.1"} 1',
+            'test_seconds_bucket{route="/widgets",le="1"} 2',
+            'test_seconds_bucket{route="/widgets",le="+Inf"} 3',
+            'test_seconds_sum{route="/widgets"} 5.55',
+            'test_seconds_count{route="/widgets"} 3',
+        ])
+
+    def test_label_values_are_escaped(self):
+        counter = metrics.Counter('test_total', 'a test counter', ('shape',))
+        counter.inc(2, 'say "hi"\\\n')
+        self.assertEqual(counter.render()[-1], 'test_total{shape="say \\"hi\\"\\\\\\n"} 2')
+
+
+class TestRequestMetricsMiddleware(unittest.TestCase):
+
+    def setUp(self):
+        self.enabled_patcher = unittest.mock.patch.object(metrics, 'enabled', True)
+        self.enabled_patcher.start()
+        self.sample_patcher = unittest.mock.patch.object(metrics, 'SAMPLE_EVERY', 1)
+        self.sample_patcher.start()
+
+    def tearDown(self):
+        self.sample_patcher.stop()
+        self.enabled_patcher.stop()
+
+    def test_request_is_recorded_under_its_route(self):
+        def wsgi_app(environ, start_response):
+            metrics.set_route('/test/<thing>')
+            with metrics.phase('sqlite'):
+                pass
+            start_response('201 CREATED', [('Content-Length', '2')])
+            return [b'{}']
+
+        app = metrics.RequestMetricsMiddleware(wsgi_app)
+        app({'REQUEST_METHOD': 'PUT', 'CONTENT_LENGTH': '7'}, lambda status, headers, exc_info=None: None)
+        metrics.flush()
+        self.assertEqual(metrics.REQUEST_SECONDS.count('PUT', '/test/<thing>', '201'), 1)
+        self.assertEqual(metrics.PHASE_SECONDS.count('/test/<thing>', 'sqlite'), 1)
+        self.assertEqual(metrics.REQUEST_BYTES.count('/test/<thing>'), 1)
+        self.assertEqual(metrics.RESPONSE_BYTES.count('/test/<thing>'), 1)
+        self.assertIn('widgets_http_request_duration_seconds_count', metrics.REGISTRY.render())
+
+    def test_route_of_labels_the_request_and_its_nested_phases(self):
+        def wsgi_app(environ, start_response):
+            with metrics.phase('sqlite'):
+                with metrics.phase('validation'):
+                    pass
+            start_response('200 OK', [])
+            return [b'']
+
+        app = metrics.RequestMetricsMiddleware(wsgi_app, route_of=lambda environ: environ['test.route'])
+        app({'REQUEST_METHOD': 'GET', 'test.route': '/routed'}, lambda status, headers, exc_info=None: None)
+        self.assertEqual(metrics.REQUEST_SECONDS.count('GET', '/routed', '200'), 0)  # queued until a flush
+        metrics.REGISTRY.render()
+        self.assertEqual(metrics.REQUEST_SECONDS.count('GET', '/routed', '200'), 1)
+        self.assertEqual(metrics.PHASE_SECONDS.count('/routed', 'sqlite'), 1)
+        self.assertEqual(metrics.PHASE_SECONDS.count('/routed', 'validation'), 1)
+
+    def test_phases_outside_a_request_are_recorded_at_once(self):
+        metrics.set_route('none')
+        count = metrics.PHASE_SECONDS.count('none', 'jsonify')
+        with metrics.phase('jsonify'):
+            pass
+        self.assertEqual(metrics.PHASE_SECONDS.count('none', 'jsonify'), count + 1)
+
+    def test_flask_requests_are_labelled_with_their_url_rule(self):
+        client = flaskapp.app.test_client()
+        client.get('/widgets/metrics-test')
+        metrics.flush()
+        self.assertGreaterEqual(metrics.REQUEST_SECONDS.count('GET', '/widgets/<widget_name>', '404'), 1)
+        self.assertGreaterEqual(metrics.PHASE_SECONDS.count('/widgets/<widget_name>', 'sqlite'), 1)
+
+    def test_requests_that_are_not_sampled_only_record_their_time(self):
+        def wsgi_app(environ, start_response):
+            with metrics.phase('sqlite'):
+                pass
+            metrics.observe_rows('sampling_test', 1)
+            start_response('200 OK', [('Content-Length', '2')])
+            return [b'{}']
+
+        app = metrics.RequestMetricsMiddleware(wsgi_app, route_of=lambda environ: '/sampled')
+        with unittest.mock.patch.object(metrics, 'SAMPLE_EVERY', 4):
+            for _ in range(8):
+                app({'REQUEST_METHOD': 'PUT', 'CONTENT_LENGTH': '2'}, lambda status, headers, exc_info=None: None)
+        metrics.flush()
+        self.assertEqual(metrics.REQUEST_SECONDS.count('PUT', '/sampled', '200'), 8)
+        self.assertEqual(metrics.REQUEST_BYTES.count('/sampled'), 2)
+        self.assertEqual(metrics.RESPONSE_BYTES.count('/sampled'), 2)
+        self.assertEqual(metrics.PHASE_SECONDS.count('/sampled', 'sqlite'), 2)
+        self.assertEqual(metrics.STORE_ROWS.count('sampling_test'), 2)
+        count = metrics.PHASE_SECONDS.count(metrics.current_route(), 'sqlite')
+        with metrics.phase('sqlite'):  # and the next phase outside a request is timed again
+            pass
+        self.assertEqual(metrics.PHASE_SECONDS.count(metrics.current_route(), 'sqlite'), count + 1)
+
+    def test_malformed_content_length_is_skipped(self):
+        def wsgi_app(environ, start_response):
+            start_response('200 OK', [])
+            return [b'']
+
+        app = metrics.RequestMetricsMiddleware(wsgi_app, route_of=lambda environ: '/malformed')
+        app({'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': 'lots'}, lambda status, headers, exc_info=None: None)
+        app({'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': '12'}, lambda status, headers, exc_info=None: None)
+        metrics.flush()
+        self.assertEqual(metrics.REQUEST_SECONDS.count('POST', '/malformed', '200'), 2)
+        self.assertEqual(metrics.REQUEST_BYTES.count('/malformed'), 1)
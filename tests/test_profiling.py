@@ -0,0 +1,56 @@
+import unittest
+import os
+import tempfile
+import time
+
+from widgets import Widget
+from widgets import WidgetStore
+import profiling
+
+
+class TestProfileSession(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.widget_store = WidgetStore(':memory:')
+        self.widget_store.put_widgets([
+            Widget(name='w%s' % i, num_of_parts=i, created_date='2021-04-25', updated_date='2021-04-25')
+            for i in range(200)
+        ])
+
+    def tearDown(self):
+        self.widget_store.close()
+        self.tmp_dir.cleanup()
+
+    def test_cprofile_session_saves_pstats_and_reports_widgets_frames(self):
+        profile_session = profiling.ProfileSession('cprofile', 'GET_widgets')
+        profile_session.start()
+        self.widget_store.get_all_widgets()
+        file_name, top_frames = profile_session.finish(self.tmp_dir.name)
+        self.assertTrue(file_name.endswith('-%s-GET_widgets.pstats' % os.getpid()))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir.name, file_name)))
+        self.assertTrue(top_frames[0].startswith('get_all_widgets:'))
+
+    def test_sample_session_saves_collapsed_stacks(self):
+        profile_session = profiling.ProfileSession('sample', 'GET_widgets')
+        profile_session.profiler.interval_s = 0.001
+        profile_session.start()
+        deadline = time.monotonic() + 0.1
+        while time.monotonic() < deadline:
+            self.widget_store.get_all_widgets()
+        file_name, top_frames = profile_session.finish(self.tmp_dir.name)
+        with open(os.path.join(self.tmp_dir.name, file_name)) as collapsed_file:
+            lines = collapsed_file.read().splitlines()
+        self.assertGreater(len(lines), 0)
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in lines))
+        self.assertTrue(any('widgets.py:get_all_widgets' in line for line in lines))
+
+    def test_one_request_at_a_time(self):
+        first = profiling.ProfileSession('cprofile', 'first')
+        second = profiling.ProfileSession('cprofile', 'second')
+        first.start()
+        second.start()
+        self.assertIsNone(second.finish(self.tmp_dir.name))
+        self.assertIsNotNone(first.finish(self.tmp_dir.name))
+        with self.assertRaises(ValueError):
+            profiling.ProfileSession('perf', 'bad')
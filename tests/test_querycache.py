@@ -0,0 +1,120 @@
+import unittest
+import unittest.mock
+import os
+import tempfile
+
+_tmp_dir = tempfile.TemporaryDirectory()
+os.environ.setdefault('CONNECT_STR', os.path.join(_tmp_dir.name, 'widgets.db'))
+
+import querycache  # noqa: E402
+import flaskapp  # noqa: E402, reads CONNECT_STR at import
+from widgets import Widget  # noqa: E402
+from widgets import WidgetStore  # noqa: E402
+
+
+class TestQueryResultCache(unittest.TestCase):
+
+    def test_equivalent_specs_share_a_key(self):
+        a = {"predicate": "lt", "variable": "num_of_parts", "constants": [5.0]}
+        b = {"predicate": "like", "variable": "name", "constants": ["w%"]}
+        self.assertEqual(
+            querycache.cache_key([a, b], 10, 0),
+            querycache.cache_key({"where": [b, dict(a, constants=[5])]}, 10, 0)
+        )
+        self.assertEqual(
+            querycache.cache_key({"where": {"any": [a, b]}, "order_by": [{"variable": "name"}]}, None, 0),
+            querycache.cache_key(
+                {"where": [{"any": [b, a]}], "order_by": [{"variable": "name", "direction": "asc"}]}, None, 0
+            )
+        )
+        for different in (
+            ([a], 10, 1),
+            ([dict(b, constants=["W%"])], 10, 0),
+            ([dict(a, predicate="like", constants=[5])], 10, 0),
+            ({"where": [a, b], "limit": 3}, 10, 0)
+        ):
+            with self.subTest(spec=different):
+                self.assertNotEqual(querycache.cache_key(*different), querycache.cache_key([a, b], 10, 0))
+
+    def test_lru_is_bounded_by_bytes(self):
+        cache = querycache.QueryResultCache(max_bytes=8000)
+        cache.put('a', 1, b'x' * 500)  # nothing is cached until a lookup has seen the version
+        self.assertIsNone(cache.get('a', 1))
+        for key in ('a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i'):
+            cache.put(key, 1, b'x' * 700)
+            self.assertIsNotNone(cache.get('a', 1))  # kept in use, so never the one evicted
+        stats = dict(cache.stats())
+        self.assertLessEqual(stats[('bytes',)], 8000)
+        self.assertGreater(stats[('evictions',)], 0)
+        self.assertIsNone(cache.get('b', 1))
+        cache.put('huge', 1, b'x' * 2000)
+        self.assertIsNone(cache.get('huge', 1))
+
+    def test_new_version_drops_every_entry(self):
+        cache = querycache.QueryResultCache(max_bytes=8000)
+        cache.get('a', 1)
+        cache.put('a', 1, b'[]')
+        self.assertEqual(cache.get('a', 1), b'[]')
+        self.assertIsNone(cache.get('a', 2))
+        cache.put('a', 1, b'stale')  # read before the write that made version 2
+        self.assertIsNone(cache.get('a', 2))
+        self.assertEqual(dict(cache.stats())[('entries',)], 0)
+        self.assertIsNone(cache.get('a', None))
+        self.assertEqual(dict(cache.stats())[('hit_ratio',)], 1 / 5)
+
+
+class TestFlaskAppQueryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = querycache.QueryResultCache(max_bytes=1024 * 1024)
+        self.cache_patcher = unittest.mock.patch.object(flaskapp, '_query_cache', self.cache)
+        self.cache_patcher.start()
+        self.client = flaskapp.app.test_client()
+        self.client.put('/widgets', json=[{"name": "w%s" % i, "num_of_parts": i} for i in range(20)])
+        self.query = {
+            "where": {"predicate": "lt", "variable": "num_of_parts", "constants": [5]},
+            "order_by": [{"variable": "num_of_parts", "direction": "desc"}]
+        }
+
+    def tearDown(self):
+        self.cache_patcher.stop()
+        self.client.delete('/widgets')
+
+    def query_parts(self):
+        response = self.client.post('/widgets/query', json=self.query)
+        self.assertEqual(response.status_code, 200)
+        return [w['num_of_parts'] for w in response.get_json()]
+
+    def test_repeated_query_never_reaches_the_store(self):
+        self.assertEqual(self.query_parts(), [4, 3, 2, 1, 0])
+        with unittest.mock.patch.object(
+            WidgetStore, 'get_widgets_by_cond_spec', side_effect=AssertionError('went to sqlite')
+        ):
+            self.assertEqual(self.query_parts(), [4, 3, 2, 1, 0])
+            self.query["where"]["constants"] = [5.0]
+            self.assertEqual(self.query_parts(), [4, 3, 2, 1, 0])
+        self.assertEqual(dict(self.cache.stats())[('hits',)], 2)
+
+    def test_writes_from_any_connection_invalidate(self):
+        self.assertEqual(self.query_parts(), [4, 3, 2, 1, 0])
+        self.client.delete('/widgets/w4')
+        self.assertEqual(self.query_parts(), [3, 2, 1, 0])
+        other_store = WidgetStore(os.environ['CONNECT_STR'])
+        other_store.put_widget(
+            Widget(name='w-1', num_of_parts=-1, created_date='2021-04-25', updated_date='2021-04-25')
+        )
+        other_store.close()
+        self.assertEqual(self.query_parts(), [3, 2, 1, 0, -1])
+
+    def test_invalid_spec_is_never_served_from_the_cache(self):
+        self.query_parts()
+        self.query["group_by"] = "name"
+        self.assertEqual(self.client.post('/widgets/query', json=self.query).status_code, 400)
+
+    def test_spec_nested_too_deep_is_turned_away_before_its_cache_key(self):
+        nested = {"predicate": "eq", "variable": "name", "constants": ["w1"]}
+        for _ in range(400):
+            nested = {"any": [nested]}
+        response = self.client.post('/widgets/query', json=[nested])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('nested', response.get_json()['cause'])
@@ -0,0 +1,165 @@
+import unittest
+import unittest.mock
+import os
+import tempfile
+
+from widgets import Widget
+from shards import ShardedWidgetStore
+from shards import shard_index
+from reshard import reshard
+
+
+class TestShardedWidgetStore(unittest.TestCase):
+
+    def setUp(self):
+        self.widget_store = ShardedWidgetStore([':memory:', ':memory:', ':memory:'])
+        self.sample_widgets = [
+            Widget(
+                name='sample%s' % i,
+                num_of_parts=i,
+                created_date='2012-06-14',
+                updated_date='2021-04-25',
+                an_extra_prop=i * 11
+            )
+            for i in range(20)
+        ]
+
+    def tearDown(self):
+        self.widget_store.close()
+
+    def test_point_operations_route_to_one_shard(self):
+        self.widget_store.put_widget(self.sample_widgets[0])
+        owning_shard = self.widget_store.shards[shard_index('sample0', 3)]
+        self.assertEqual(owning_shard.get_widget_by_name('sample0'), self.sample_widgets[0])
+        for shard in self.widget_store.shards:
+            if shard is not owning_shard:
+                with self.assertRaises(LookupError):
+                    shard.get_widget_by_name('sample0')
+        self.widget_store.delete_widget_by_name('sample0')
+        with self.assertRaises(LookupError):
+            self.widget_store.get_widget_by_name('sample0')
+
+    def test_put_widgets_get_all_widgets(self):
+        self.widget_store.put_widgets(self.sample_widgets)
+        all_widgets = self.widget_store.get_all_widgets()
+        self.assertEqual(len(all_widgets), len(self.sample_widgets))
+        for widget in self.sample_widgets:
+            self.assertIn(widget, all_widgets)
+        self.widget_store.delete_all_widgets()
+        self.assertEqual(len(self.widget_store.get_all_widgets()), 0)
+
+    def test_replace_all_widgets_skips_unchanged_widgets(self):
+        self.assertEqual(self.widget_store.put_widgets(self.sample_widgets), 20)
+        self.assertEqual(self.widget_store.replace_all_widgets(self.sample_widgets[:5]), 0)
+        self.assertEqual(
+            sorted(widget['name'] for widget in self.widget_store.get_all_widgets()),
+            sorted(widget['name'] for widget in self.sample_widgets[:5])
+        )
+
+    def test_pagination_keeps_sort_order_across_shards(self):
+        self.widget_store.put_widgets(self.sample_widgets)
+        expected_names = sorted(w['name'] for w in self.sample_widgets)
+        page = self.widget_store.get_all_widgets(limit=5, offset=7)
+        self.assertEqual([w['name'] for w in page], expected_names[7:12])
+        cond_spec = [
+            {
+                "predicate": "ge",
+                "variable": "num_of_parts",
+                "constants": [10]
+            }
+        ]
+        page = self.widget_store.get_widgets_by_cond_spec(cond_spec, limit=3, offset=1)
+        expected_names = sorted(w['name'] for w in self.sample_widgets if w['num_of_parts'] >= 10)
+        self.assertEqual([w['name'] for w in page], expected_names[1:4])
+
+    def test_ordered_query_merges_across_shards(self):
+        self.widget_store.put_widgets(self.sample_widgets)
+        query_spec = {
+            "where": {
+                "any": [
+                    {"predicate": "lt", "variable": "num_of_parts", "constants": [5]},
+                    {"predicate": "gt", "variable": "num_of_parts", "constants": [14]}
+                ]
+            },
+            "order_by": [{"variable": "num_of_parts", "direction": "desc"}],
+            "limit": 6
+        }
+        expected_parts = [19, 18, 17, 16, 15, 4]
+        self.assertEqual([w['num_of_parts'] for w in self.widget_store.get_widgets_by_cond_spec(query_spec)],
+                         expected_parts)
+        self.assertEqual(
+            [w['num_of_parts'] for w in self.widget_store.get_widgets_by_cond_spec(query_spec, limit=4, offset=4)],
+            expected_parts[4:]
+        )
+        del query_spec['limit']
+        self.assertEqual(
+            [w['num_of_parts'] for w in self.widget_store.get_widgets_by_cond_spec(query_spec)],
+            [19, 18, 17, 16, 15, 4, 3, 2, 1, 0]
+        )
+
+    def test_delete_widgets_by_cond_spec(self):
+        self.widget_store.put_widgets(self.sample_widgets)
+        cond_spec = [
+            {
+                "predicate": "lt",
+                "variable": "num_of_parts",
+                "constants": [5]
+            }
+        ]
+        self.widget_store.delete_widgets_by_cond_spec(cond_spec)
+        self.assertEqual(len(self.widget_store.get_all_widgets()), 15)
+        self.assertEqual(len(self.widget_store.get_widgets_by_cond_spec(cond_spec)), 0)
+
+
+class TestReshard(unittest.TestCase):
+
+    def test_reshard_moves_every_widget(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            src = [os.path.join(tmp_dir, 'src%s.db' % i) for i in range(2)]
+            dst = [os.path.join(tmp_dir, 'dst%s.db' % i) for i in range(5)]
+            src_store = ShardedWidgetStore(src)
+            src_store.put_widgets([
+                Widget(name='w%s' % i, num_of_parts=i, created_date='2021-04-25', updated_date='2021-04-25')
+                for i in range(50)
+            ])
+            src_store.close()
+            self.assertEqual(reshard(src, dst, batch_size=7), 50)
+            dst_store = ShardedWidgetStore(dst)
+            self.assertEqual(len(dst_store.get_all_widgets()), 50)
+            self.assertEqual(dst_store.get_widget_by_name('w42')['num_of_parts'], 42)
+            dst_store.close()
+        with self.assertRaises(ValueError):
+            reshard(['a.db'], ['a.db', 'b.db'])
+
+    def test_reshard_over_existing_rows_keeps_the_trigram_index_in_step(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                unittest.mock.patch.dict(os.environ, {'NAME_TRIGRAM_INDEX': '1'}):
+            src = [os.path.join(tmp_dir, 'src%s.db' % i) for i in range(2)]
+            dst = [os.path.join(tmp_dir, 'dst%s.db' % i) for i in range(3)]
+            src_store = ShardedWidgetStore(src)
+            src_store.put_widgets([
+                Widget(name='w%s' % i, num_of_parts=i, created_date='2021-04-25', updated_date='2021-04-25')
+                for i in range(20)
+            ])
+            self.assertEqual(reshard(src, dst), 20)
+            src_store.put_widgets([
+                Widget(name='w%s' % i, num_of_parts=i * 10, created_date='2021-04-25', updated_date='2021-04-26')
+                for i in range(10)
+            ])
+            src_store.close()
+            self.assertEqual(reshard(src, dst), 20)
+            dst_store = ShardedWidgetStore(dst)
+            for shard in dst_store.shards:
+                # the index keeps one docsize row per rowid it has, stale ones included
+                self.assertEqual(
+                    shard.conn.execute('SELECT count(*) FROM widgets_name_trigram_docsize').fetchone()[0],
+                    shard.conn.execute('SELECT count(*) FROM widgets').fetchone()[0]
+                )
+            self.assertEqual(dst_store.get_widget_by_name('w3')['num_of_parts'], 30)
+            self.assertEqual(
+                sorted(w['name'] for w in dst_store.get_widgets_by_cond_spec(
+                    [{"predicate": "like", "variable": "name", "constants": ["%w1%"]}]
+                )),
+                sorted(['w1'] + ['w1%s' % i for i in range(10)])
+            )
+            dst_store.close()
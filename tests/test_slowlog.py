@@ -0,0 +1,119 @@
+import unittest
+import unittest.mock
+import json
+import os
+import tempfile
+
+_tmp_dir = tempfile.TemporaryDirectory()
+os.environ.setdefault('CONNECT_STR', os.path.join(_tmp_dir.name, 'widgets.db'))
+
+from widgets import Widget  # noqa: E402
+from widgets import WidgetStore  # noqa: E402
+import slowlog  # noqa: E402
+import flaskapp  # noqa: E402, reads CONNECT_STR at import
+
+
+class TestSlowQueryRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.recorder = slowlog.SlowQueryRecorder(
+            threshold_ms=0,
+            log_path=os.path.join(self.tmp_dir.name, 'slow.log'),
+            redact=True
+        )
+        self.recorder_patcher = unittest.mock.patch.object(slowlog, 'recorder', self.recorder)
+        self.recorder_patcher.start()
+        self.widget_store = WidgetStore(':memory:')
+        self.widget_store.put_widgets([
+            Widget(name='w%s' % i, num_of_parts=i, created_date='2021-04-25', updated_date='2021-04-25')
+            for i in range(10)
+        ])
+
+    def tearDown(self):
+        self.widget_store.close()
+        self.recorder_patcher.stop()
+        self.recorder.close()
+        self.tmp_dir.cleanup()
+
+    def test_spec_shape_ignores_constants_and_order(self):
+        self.assertEqual(
+            slowlog.spec_shape([
+                {"predicate": "lt", "variable": "num_of_parts", "constants": [3]},
+                {"predicate": "like", "variable": "name", "constants": ["w%"]}
+            ]),
+            slowlog.spec_shape([
+                {"predicate": "like", "variable": "name", "constants": ["x%"]},
+                {"predicate": "lt", "variable": "num_of_parts", "constants": [7]}
+            ])
+        )
+        self.assertEqual(slowlog.spec_shape([]), '*')
+        self.assertEqual(
+            slowlog.spec_shape({
+                "where": {
+                    "any": [
+                        {"predicate": "eq", "variable": "name", "constants": ["w1"]},
+                        {"not": {"predicate": "lt", "variable": "num_of_parts", "constants": [3]}}
+                    ]
+                },
+                "order_by": [{"variable": "num_of_parts", "direction": "desc"}],
+                "limit": 10
+            }),
+            '(NOT num_of_parts lt OR name eq) ORDER BY num_of_parts desc LIMIT'
+        )
+
+    def test_slow_statements_are_logged_with_plan(self):
+        cond_spec = [{"predicate": "eq", "variable": "name", "constants": ["w3"]}]
+        self.widget_store.get_widgets_by_cond_spec(cond_spec)
+        self.widget_store.delete_widgets_by_cond_spec(cond_spec)
+        self.assertEqual(
+            self.recorder.log_path,
+            os.path.join(self.tmp_dir.name, 'slow.%s.log' % os.getpid())  # a file per process
+        )
+        with open(self.recorder.log_path) as log_file:
+            entries = [json.loads(line) for line in log_file]
+        self.assertEqual([e['operation'] for e in entries], ['get', 'delete'])
+        self.assertEqual(entries[0]['row_count'], 1)
+        self.assertEqual(entries[0]['params'], ['str'])
+        self.assertTrue(any('INDEX' in step for step in entries[0]['query_plan']))
+
+    def test_top_shapes_ranks_by_total_time(self):
+        for i in range(3):
+            self.widget_store.get_widgets_by_cond_spec(
+                [{"predicate": "between", "variable": "num_of_parts", "constants": [i, i + 2]}]
+            )
+        self.widget_store.get_widgets_by_cond_spec([])
+        top_shapes = self.recorder.top_shapes()
+        self.assertEqual(len(top_shapes), 2)
+        between_shape = [s for s in top_shapes if s['shape'] == 'num_of_parts between'][0]
+        self.assertEqual(between_shape['count'], 3)
+        self.assertEqual(between_shape['rows'], 9)
+        self.assertGreaterEqual(top_shapes[0]['total_ms'], top_shapes[1]['total_ms'])
+
+    def test_tracked_shapes_are_capped(self):
+        recorder = slowlog.SlowQueryRecorder(max_shapes=2)
+        conn = self.widget_store.conn
+        recorder.record(conn, 'get', [{"predicate": "eq", "variable": "name", "constants": ["w1"]}], '', [], 3.0, 1)
+        recorder.record(conn, 'get', [{"predicate": "lt", "variable": "name", "constants": ["w1"]}], '', [], 1.0, 1)
+        recorder.record(conn, 'get', [{"predicate": "gt", "variable": "name", "constants": ["w1"]}], '', [], 2.0, 1)
+        self.assertEqual([s['shape'] for s in recorder.top_shapes()], ['name eq', 'name gt'])
+        recorder.close()
+
+
+class TestFlaskAppSlowQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.env_patcher = unittest.mock.patch.dict(os.environ, {'ADMIN_TOKEN': 'secret'})
+        self.env_patcher.start()
+        self.client = flaskapp.app.test_client()
+
+    def tearDown(self):
+        self.env_patcher.stop()
+
+    def test_admin_token_check(self):
+        self.assertEqual(self.client.get('/admin/slow-queries').status_code, 403)
+        for token in ('s\u00e9cret', '\u20ac'):  # non-ascii tokens are wrong, not errors
+            with self.subTest(token=token):
+                response = self.client.get('/admin/slow-queries', headers={'X-Admin-Token': token})
+                self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.client.get('/admin/slow-queries', headers={'X-Admin-Token': 'secret'}).status_code, 200)
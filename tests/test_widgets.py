@@ -2,11 +2,14 @@ import unittest
 import unittest.mock
 import json
 import os
+import sqlite3
+import tempfile
 
 import jsonschema
 
 from widgets import Widget
 from widgets import WidgetStore
+from widgets import VersionMismatchError
 
 
 class TestWidget(unittest.TestCase):
@@ -321,6 +324,87 @@ class TestWidgetStore(unittest.TestCase):
         with self.assertRaises(jsonschema.exceptions.ValidationError):
             self.widget_store.get_widgets_by_cond_spec(bad_cond_spec)
 
+    def test_get_widgets_by_query_spec(self):
+        index_count_sql = "SELECT count(*) FROM sqlite_master WHERE type = 'index' AND name LIKE 'widgets_%'"
+        self.assertEqual(self.widget_store.conn.execute(index_count_sql).fetchone()[0], 0)
+        self.widget_store.close()
+        self.widget_store = WidgetStore(sort_indexes=True)
+        self.assertEqual(self.widget_store.conn.execute(index_count_sql).fetchone()[0], 3)
+        self.widget_store.put_widgets([
+            Widget(name='w%s' % i, num_of_parts=i % 7, created_date='2021-04-%02d' % (i + 1), updated_date='2021-04-25')
+            for i in range(20)
+        ])
+        query_spec = {
+            "where": {
+                "any": [
+                    {"predicate": "lt", "variable": "num_of_parts", "constants": [2]},
+                    {
+                        "all": [
+                            {"predicate": "like", "variable": "name", "constants": ["w1%"]},
+                            {"not": {"predicate": "eq", "variable": "num_of_parts", "constants": [3]}}
+                        ]
+                    }
+                ]
+            },
+            "order_by": [{"variable": "num_of_parts", "direction": "desc"}, {"variable": "created_date"}],
+            "limit": 5
+        }
+        matches = [
+            (i % 7, '2021-04-%02d' % (i + 1), 'w%s' % i)
+            for i in range(20)
+            if i % 7 < 2 or (str(i).startswith('1') and i % 7 != 3)
+        ]
+        expected_names = [name for _, _, name in sorted(matches, key=lambda m: (-m[0], m[1]))]
+        self.assertEqual(
+            [w['name'] for w in self.widget_store.get_widgets_by_cond_spec(query_spec)],
+            expected_names[:5]
+        )
+        self.assertEqual(
+            [w['name'] for w in self.widget_store.get_widgets_by_cond_spec(query_spec, limit=10, offset=3)],
+            expected_names[3:5]
+        )
+        sql = 'SELECT * FROM widgets ORDER BY ' + self.widget_store._order_by_to_sql(
+            [{"variable": "num_of_parts", "direction": "desc"}]
+        ) + ' LIMIT 5'
+        plan = ' '.join(row[-1] for row in self.widget_store.conn.execute('EXPLAIN QUERY PLAN ' + sql))
+        self.assertIn('widgets_num_of_parts', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_get_widgets_by_query_spec_bad_spec(self):
+        leaf = {"predicate": "eq", "variable": "name", "constants": ["w1"]}
+        too_deep = leaf
+        for _ in range(WidgetStore._max_condition_depth):
+            too_deep = {"not": too_deep}
+        for bad_query_spec in (
+            {"where": {"any": []}},
+            {"where": leaf, "order_by": [{"variable": "an_extra_prop"}]},
+            {"where": leaf, "limit": -1},
+            {"where": leaf, "group_by": "name"},
+            [too_deep],
+            [{"any": [leaf] * 15}] * 15
+        ):
+            with self.subTest(query_spec=bad_query_spec):
+                with self.assertRaises(jsonschema.exceptions.ValidationError):
+                    self.widget_store.get_widgets_by_cond_spec(bad_query_spec)
+        with self.assertRaises(jsonschema.exceptions.ValidationError):
+            self.widget_store.delete_widgets_by_cond_spec({"where": leaf})
+
+    def test_leaf_with_a_group_key_is_rejected(self):
+        self.widget_store.put_widgets([
+            Widget(name=name, num_of_parts=1, created_date='2021-04-25', updated_date='2021-04-25')
+            for name in ('a', 'b', 'c')
+        ])
+        eq_a = {"predicate": "eq", "variable": "name", "constants": ["a"]}
+        eq_b = {"predicate": "eq", "variable": "name", "constants": ["b"]}
+        with self.assertRaises(jsonschema.exceptions.ValidationError):
+            self.widget_store.get_widgets_by_cond_spec([dict(eq_a, any=[eq_b])])
+        with self.assertRaises(jsonschema.exceptions.ValidationError):
+            self.widget_store.delete_widgets_by_cond_spec([dict(eq_a, **{"not": eq_a})])
+        self.assertEqual(sorted(w['name'] for w in self.widget_store.get_all_widgets()), ['a', 'b', 'c'])
+        # past validation, the predicate still decides
+        sql, params = self.widget_store._cond_spec_to_sql([dict(eq_a, any=[eq_b])])
+        self.assertEqual((sql, params), ('Name = ?', ['a']))
+
     def test_delete_widgets_by_cond_spec(self):
         widget_group = [
             self.sample_widget_1,
@@ -350,3 +434,181 @@ class TestWidgetStore(unittest.TestCase):
         ]
         with self.assertRaises(jsonschema.exceptions.ValidationError):
             self.widget_store.delete_widgets_by_cond_spec(bad_cond_spec)
+
+    def test_patch_widget(self):
+        self.widget_store.put_widget(self.sample_widget_1)
+        patched_widget = self.widget_store.patch_widget('sample1', {
+            "num_of_parts": 6,
+            "an_extra_prop": None,
+            "a_complex_extra_prop": {"more": True},
+            "a_new_extra_prop": "spam"
+        })
+        expected_widget = Widget(
+            name='sample1',
+            num_of_parts=6,
+            created_date='2012-06-14',
+            updated_date='2021-04-25',
+            a_complex_extra_prop={
+                'stuff': [
+                    4.1,
+                    'eggs',
+                    [3, 'spam']
+                ],
+                'more': True
+            },
+            a_new_extra_prop='spam'
+        )
+        self.assertEqual(patched_widget, expected_widget)
+        self.assertEqual(self.widget_store.get_widget_by_name('sample1'), expected_widget)
+
+    def test_patch_widget_bad_patch(self):
+        self.widget_store.put_widget(self.sample_widget_2)
+        with self.assertRaises(jsonschema.exceptions.ValidationError):
+            self.widget_store.patch_widget('sample2', {"num_of_parts": None})
+        with self.assertRaises(ValueError):
+            self.widget_store.patch_widget('sample2', {"name": "renamed"})
+        with self.assertRaises(LookupError):
+            self.widget_store.patch_widget('missing', {"num_of_parts": 1})
+        self.assertEqual(self.widget_store.get_widget_by_name('sample2'), self.sample_widget_2)
+
+    def test_patch_widget_bad_date(self):
+        self.widget_store.put_widget(self.sample_widget_2)
+        with self.assertRaises(ValueError):
+            self.widget_store.patch_widget('sample2', {"updated_date": "yesterday"})
+        with self.assertRaises(ValueError):
+            self.widget_store.patch_widget('sample2', {"created_date": "04/25/2021", "num_of_parts": 1})
+        self.assertEqual(self.widget_store.get_widget_by_name('sample2'), self.sample_widget_2)
+
+    def test_every_write_bumps_the_version(self):
+        self.assertEqual(self.widget_store.put_widget(self.sample_widget_2), 1)
+        self.assertEqual(self.widget_store.get_widget_by_name('sample2').version, 1)
+        self.assertEqual(self.widget_store.put_widget(self.sample_widget_2), 2)
+        self.widget_store.put_widgets([
+            self.sample_widget_1,
+            Widget(name='sample2', num_of_parts=11, created_date='2017-07-04', updated_date='2021-04-26')
+        ])
+        self.assertEqual(self.widget_store.get_widget_by_name('sample1').version, 1)
+        self.assertEqual(self.widget_store.get_widget_by_name('sample2').version, 3)
+        self.assertEqual(self.widget_store.patch_widget('sample2', {"num_of_parts": 1}).version, 4)
+
+    def test_conditional_writes(self):
+        self.widget_store.put_widget(self.sample_widget_2)
+        with self.assertRaises(VersionMismatchError):
+            self.widget_store.put_widget(self.sample_widget_2, if_version=2)
+        with self.assertRaises(VersionMismatchError):
+            self.widget_store.put_widget(self.sample_widget_1, if_version=1)
+        with self.assertRaises(LookupError):
+            self.widget_store.get_widget_by_name('sample1')
+        self.assertEqual(self.widget_store.put_widget(self.sample_widget_2, if_version=1), 2)
+        with self.assertRaises(VersionMismatchError):
+            self.widget_store.patch_widget('sample2', {"num_of_parts": 1}, if_version=1)
+        self.assertEqual(self.widget_store.patch_widget('sample2', {"num_of_parts": 1}, if_version=2).version, 3)
+        with self.assertRaises(VersionMismatchError):
+            self.widget_store.delete_widget_by_name('sample2', if_version=2)
+        self.widget_store.delete_widget_by_name('sample2', if_version=3)
+        with self.assertRaises(LookupError):
+            self.widget_store.get_widget_by_name('sample2')
+
+    def test_older_table_is_migrated(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            connect_str = os.path.join(tmp_dir, 'widgets.db')
+            conn = sqlite3.connect(connect_str)
+            conn.execute("""
+                CREATE TABLE widgets (
+                    Name TEXT PRIMARY KEY,
+                    NumOfParts INTEGER NOT NULL,
+                    CreatedDate TEXT NOT NULL,
+                    UpdatedDate TEXT NOT NULL,
+                    FlexProperties BLOB
+                );
+            """)
+            conn.execute("INSERT INTO widgets VALUES ('old', 1, '2021-04-25', '2021-04-25', NULL)")
+            conn.commit()
+            conn.close()
+            widget_store = WidgetStore(connect_str)
+            self.assertEqual(widget_store.get_widget_by_name('old').version, 1)
+            self.assertEqual(widget_store.put_widget(self.sample_widget_2), 1)
+            widget_store.close()
+            widget_store = WidgetStore(connect_str)
+            self.assertEqual(widget_store.patch_widget('old', {"num_of_parts": 2}).version, 2)
+            widget_store.close()
+
+    def test_put_widgets_skips_unchanged_widgets(self):
+        self.assertEqual(self.widget_store.put_widgets([self.sample_widget_1, self.sample_widget_2]), 2)
+        resent_widget_1 = Widget(
+            name='sample1',
+            num_of_parts=5,
+            created_date='2021-05-01',
+            updated_date='2021-05-01',
+            a_complex_extra_prop=self.sample_widget_1['a_complex_extra_prop'],
+            an_extra_prop=55555
+        )
+        changed_widget_2 = Widget(name='sample2', num_of_parts=11, created_date='2021-05-01', updated_date='2021-05-01')
+        self.assertEqual(self.widget_store.put_widgets([resent_widget_1, changed_widget_2]), 1)
+        stored_widget_1 = self.widget_store.get_widget_by_name('sample1')
+        self.assertEqual(stored_widget_1, self.sample_widget_1)
+        self.assertEqual(stored_widget_1.version, 1)
+        stored_widget_2 = self.widget_store.get_widget_by_name('sample2')
+        self.assertEqual(stored_widget_2['num_of_parts'], 11)
+        self.assertEqual(stored_widget_2['created_date'], '2017-07-04')
+        self.assertEqual(stored_widget_2['updated_date'], '2021-05-01')
+        self.assertEqual(stored_widget_2.version, 2)
+
+    def test_patched_widgets_are_rewritten_by_put_widgets(self):
+        self.widget_store.put_widgets([self.sample_widget_2])
+        self.widget_store.patch_widget('sample2', {"colour": "red"})
+        self.assertEqual(self.widget_store.put_widgets([self.sample_widget_2]), 1)
+        self.assertEqual(self.widget_store.get_widget_by_name('sample2'), self.sample_widget_2)
+
+    def test_replace_all_widgets(self):
+        self.widget_store.put_widgets([self.sample_widget_1, self.sample_widget_2])
+        sample_widget_3 = Widget(name='sample3', num_of_parts=1, created_date='2021-05-01', updated_date='2021-05-01')
+        self.assertEqual(self.widget_store.replace_all_widgets([self.sample_widget_2, sample_widget_3]), 1)
+        self.assertEqual(
+            sorted(widget['name'] for widget in self.widget_store.get_all_widgets()),
+            ['sample2', 'sample3']
+        )
+        self.assertEqual(self.widget_store.get_widget_by_name('sample2').version, 1)
+        self.assertEqual(self.widget_store.replace_all_widgets([]), 0)
+        self.assertEqual(self.widget_store.get_all_widgets(), [])
+
+    def test_like_through_name_trigram_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            connect_str = os.path.join(tmp_dir, 'widgets.db')
+            plain_store = WidgetStore(connect_str)
+            plain_store.put_widgets([
+                Widget(name=name, num_of_parts=1, created_date='2021-04-25', updated_date='2021-04-25')
+                for name in ('Sprocket-Large', 'sprocket-small', 'cog', 'gear-sprocket', 'Ünïcode-sprocket')
+            ])
+            indexed_store = WidgetStore(connect_str, name_trigram_index=True)
+            self.assertTrue(indexed_store.has_name_trigram_index)
+            indexed_store.put_widget(
+                Widget(name='new-SPROCKET', num_of_parts=1, created_date='2021-04-25', updated_date='2021-04-25')
+            )
+            indexed_store.delete_widget_by_name('sprocket-small')
+            plain_store.put_widgets([
+                Widget(name='cog', num_of_parts=2, created_date='2021-04-25', updated_date='2021-04-25')
+            ])
+            for pattern in ('%sprocket%', 'SPROCKET%', '%rocket-_arge', 'ün%', '%co%', '%zzz%', 'cog'):
+                cond_spec = [{"predicate": "like", "variable": "name", "constants": [pattern]}]
+                with self.subTest(pattern=pattern):
+                    self.assertEqual(
+                        sorted(w['name'] for w in indexed_store.get_widgets_by_cond_spec(cond_spec)),
+                        sorted(
+                            row[0] for row in plain_store.conn.execute(
+                                'SELECT Name FROM widgets WHERE Name LIKE ?', (pattern,)
+                            )
+                        )
+                    )
+            where_clause, _ = indexed_store._cond_spec_to_sql(
+                [{"predicate": "like", "variable": "name", "constants": ["%sprocket%"]}]
+            )
+            self.assertIn('widgets_name_trigram', where_clause)
+            reader_store = WidgetStore(connect_str, read_only=True)
+            self.assertTrue(reader_store.has_name_trigram_index)
+            reader_store.close()
+            indexed_store.conn.execute(
+                "INSERT INTO widgets_name_trigram (widgets_name_trigram, rank) VALUES ('integrity-check', 1)"
+            )
+            plain_store.close()
+            indexed_store.close()
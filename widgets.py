@@ -1,11 +1,68 @@
+import hashlib
 import json
 import re
 import os
+import threading
+import time
 from sqlite3 import connect
+from sqlite3 import OperationalError
+from urllib.request import pathname2url
 
 import jsonschema
 
 import jschemas
+import metrics
+import slowlog
+
+
+class VersionMismatchError(Exception):
+    pass
+
+
+# a shared store resource, like the group commit writer or a pooled reader connection,
+# didn't become available in time. the apps answer with a 503
+class StoreUnavailableError(Exception):
+    pass
+
+
+# connect_str -> a connection that only ever runs PRAGMA data_version. it never writes,
+# so its data_version changes whenever any other connection, in this process or
+# another one, commits to the db
+_write_version_watchers = {}
+_write_version_watchers_lock = threading.Lock()
+
+
+def write_version(connect_str):
+    # a value that changes whenever the db has been written to, for caching what was
+    # read from it. None for an in-memory db, whose writes no other connection can see
+    if connect_str == ':memory:':
+        return None
+    with _write_version_watchers_lock:
+        watcher = _write_version_watchers.get(connect_str)
+        if watcher is None:
+            watcher = _write_version_watchers[connect_str] = connect(connect_str, check_same_thread=False)
+        return watcher.execute('PRAGMA data_version').fetchone()[0]
+
+
+def _schema_validator(schema):
+    # jsonschema.validate checks the schema itself on every call, which costs far more
+    # than checking a widget against it. this checks it once and keeps the validator,
+    # raising the same error jsonschema.validate would
+    validator_cls = jsonschema.validators.validator_for(schema)
+    validator_cls.check_schema(schema)
+    validator = validator_cls(schema)
+
+    def validate(instance):
+        error = jsonschema.exceptions.best_match(validator.iter_errors(instance))
+        if error is not None:
+            raise error
+    return validate
+
+
+_validate_widget_schema = _schema_validator(jschemas.widget_schema)
+_validate_widget_patch_schema = _schema_validator(jschemas.widget_patch_schema)
+_validate_cond_spec_schema = _schema_validator(jschemas.cond_spec_schema)
+_validate_query_spec_schema = _schema_validator(jschemas.query_spec_schema)
 
 
 class Widget:
@@ -17,12 +74,15 @@ class Widget:
         "updated_date"
     }
 
+    _date_format = re.compile(r'\d{4}-\d{2}-\d{2}')
+
     def __init__(self, name, num_of_parts, created_date, updated_date, **kwargs):
         self._validate_name(name)
         self._validate_num_of_parts(num_of_parts)
         self._validate_created_date(created_date)
         self._validate_updated_date(updated_date)
         self._validate_kwargs(kwargs)
+        self.version = None  # the stored row's version, set when read from a store
         self._widget_data = {
             "name": name,
             "num_of_parts": num_of_parts,
@@ -100,13 +160,13 @@ class Widget:
     def _validate_created_date(self, created_date):
         if type(created_date) is not str:
             raise TypeError('created_date must be str, not %s' % type(created_date))
-        if re.match(r'\d{4}-\d{2}-\d{2}', created_date) is None:
+        if self._date_format.match(created_date) is None:
             raise ValueError('created_date (%s) does not match YYYY-MM-DD format', created_date)
 
     def _validate_updated_date(self, updated_date):
         if type(updated_date) is not str:
             raise TypeError('updated_date must be str, not %s' % type(updated_date))
-        if re.match(r'\d{4}-\d{2}-\d{2}', updated_date) is None:
+        if self._date_format.match(updated_date) is None:
             raise ValueError('updated_date (%s) does not match YYYY-MM-DD format', updated_date)
 
     def _validate_kwargs(self, kwarg_dict):
@@ -117,201 +177,417 @@ class Widget:
 
     @classmethod
     def _validate_json_obj(cls, json_obj):
-        jsonschema.validate(instance=json_obj, schema=jschemas.widget_schema)
+        with metrics.phase('validation'):
+            _validate_widget_schema(json_obj)
+
+    @classmethod
+    def _validate_patch_json_obj(cls, patch):
+        with metrics.phase('validation'):
+            _validate_widget_patch_schema(patch)
 
 
 class WidgetStore:
 
-    _cond_spec_schema = jschemas.cond_spec_schema
-
-    def __init__(self):
-        self.connect_str = os.getenv('CONNECT_STR')
-        self.conn = connect(self.connect_str)
-        self.conn.execute("""
-            CREATE TABLE IF NOT EXISTS widgets (
-                Name TEXT PRIMARY KEY,
-                NumOfParts INTEGER NOT NULL,
-                CreatedDate TEXT NOT NULL,
-                UpdatedDate TEXT NOT NULL,
-                FlexProperties BLOB
-            );
-        """)
+    # bounds on a spec's groups, which json schema can't express
+    _max_condition_depth = 8
+    _max_condition_count = 100
+
+    def __init__(self, connect_str=None, check_same_thread=True, read_only=False, name_trigram_index=None,
+                 sort_indexes=None):
+        self.connect_str = connect_str if connect_str is not None else os.getenv('CONNECT_STR')
+        if name_trigram_index is None:
+            name_trigram_index = os.getenv('NAME_TRIGRAM_INDEX', '0') == '1'
+        if sort_indexes is None:
+            sort_indexes = os.getenv('SORT_INDEXES', '0') == '1'
+        self.read_only = read_only
+        if read_only:
+            self.conn = connect(
+                'file:%s?mode=ro' % pathname2url(self.connect_str),
+                uri=True,
+                timeout=self._busy_timeout(),
+                check_same_thread=check_same_thread
+            )
+        else:
+            self.conn = connect(self.connect_str, timeout=self._busy_timeout(), check_same_thread=check_same_thread)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS widgets (
+                    Name TEXT PRIMARY KEY,
+                    NumOfParts INTEGER NOT NULL,
+                    CreatedDate TEXT NOT NULL,
+                    UpdatedDate TEXT NOT NULL,
+                    FlexProperties BLOB,
+                    Version INTEGER NOT NULL DEFAULT 1,
+                    ContentHash BLOB
+                );
+            """)
+            self._migrate()
+            if sort_indexes:
+                self._create_sort_indexes()
+            if name_trigram_index:
+                self._create_name_trigram_index()
+        # an index created by any connection is used by every connection
+        self.has_name_trigram_index = self.conn.execute("""
+            SELECT count(*)
+            FROM sqlite_master
+            WHERE name = 'widgets_name_trigram'
+        """).fetchone()[0] > 0
 
     def close(self):
         self.conn.close()
 
+    # columns added since the table's first release, in the order they were added,
+    # which is also their order in CREATE TABLE
+    _added_columns = [
+        ('Version', 'INTEGER NOT NULL DEFAULT 1'),
+        ('ContentHash', 'BLOB')
+    ]
+
+    def _migrate(self):
+        # brings a table created by an older release up to date. another process may
+        # be doing the same, so a column that appears in the meantime is fine
+        columns = set(row[1] for row in self.conn.execute('PRAGMA table_info(widgets)'))
+        for column, definition in self._added_columns:
+            if column in columns:
+                continue
+            try:
+                with self.conn:
+                    self.conn.execute('ALTER TABLE widgets ADD COLUMN %s %s' % (column, definition))
+            except OperationalError as ex:
+                if 'duplicate column' not in str(ex):
+                    raise ex
+
+    def _create_sort_indexes(self):
+        # one index per sortable core column, with name after it as the tie breaker,
+        # so a query sorted on that column walks the index in order (either way) and
+        # stops after its limit, and range conditions on the column use it too
+        with self.conn:
+            self.conn.executescript("""
+                CREATE INDEX IF NOT EXISTS widgets_num_of_parts ON widgets (NumOfParts, Name);
+                CREATE INDEX IF NOT EXISTS widgets_created_date ON widgets (CreatedDate, Name);
+                CREATE INDEX IF NOT EXISTS widgets_updated_date ON widgets (UpdatedDate, Name);
+            """)
+
+    def _create_name_trigram_index(self):
+        # an fts5 trigram index over the names, kept in step with widgets by triggers.
+        # it points at widgets rows by rowid, which only VACUUM renumbers, so rebuild
+        # it after a VACUUM with INSERT INTO widgets_name_trigram(widgets_name_trigram)
+        # VALUES ('rebuild')
+        with self.conn:
+            created = self.conn.execute("""
+                SELECT count(*)
+                FROM sqlite_master
+                WHERE name = 'widgets_name_trigram'
+            """).fetchone()[0] == 0
+            self.conn.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS widgets_name_trigram
+                USING fts5(Name, content='widgets', content_rowid='rowid', tokenize='trigram');
+                CREATE TRIGGER IF NOT EXISTS widgets_name_trigram_insert AFTER INSERT ON widgets BEGIN
+                    INSERT INTO widgets_name_trigram (rowid, Name) VALUES (new.rowid, new.Name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS widgets_name_trigram_delete AFTER DELETE ON widgets BEGIN
+                    INSERT INTO widgets_name_trigram (widgets_name_trigram, rowid, Name)
+                    VALUES ('delete', old.rowid, old.Name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS widgets_name_trigram_update AFTER UPDATE OF Name ON widgets BEGIN
+                    INSERT INTO widgets_name_trigram (widgets_name_trigram, rowid, Name)
+                    VALUES ('delete', old.rowid, old.Name);
+                    INSERT INTO widgets_name_trigram (rowid, Name) VALUES (new.rowid, new.Name);
+                END;
+            """)
+            if created:
+                self.conn.execute("INSERT INTO widgets_name_trigram (widgets_name_trigram) VALUES ('rebuild')")
+
+    @staticmethod
+    def _busy_timeout():
+        # seconds a statement waits on another connection's lock before failing with
+        # 'database is locked'
+        return float(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000')) / 1000
+
     def get_widget_by_name(self, name):
         try:
-            curs = self.conn.execute("""
-                SELECT *
-                FROM widgets
-                WHERE Name = ?
-            """, (name,))
-            result = curs.fetchone()
+            with metrics.phase('sqlite'):
+                curs = self.conn.execute("""
+                    SELECT *
+                    FROM widgets
+                    WHERE Name = ?
+                """, (name,))
+                result = curs.fetchone()
         except Exception as ex:
             curs.close()
             raise ex
         else:
             if result is None:
                 raise LookupError('widget with given name is not in store')
-            return self._row_to_widget(result)
+            with metrics.phase('row_to_widget'):
+                return self._row_to_widget(result)
 
-    def get_all_widgets(self):
+    def get_all_widgets(self, limit=None, offset=0):
         try:
-            curs = self.conn.execute("""
-                SELECT *
-                FROM widgets
-            """)
-            return list(map(self._row_to_widget, curs))
+            with metrics.phase('sqlite'):
+                if limit is None:
+                    curs = self.conn.execute("""
+                        SELECT *
+                        FROM widgets
+                    """)
+                else:
+                    curs = self.conn.execute("""
+                        SELECT *
+                        FROM widgets
+                        ORDER BY Name
+                        LIMIT ? OFFSET ?
+                    """, (limit, offset))
+                rows = curs.fetchall()  # ends the statement's read snapshot before decoding starts
+            metrics.observe_rows('get_all_widgets', len(rows))
+            with metrics.phase('row_to_widget'):
+                return list(map(self._row_to_widget, rows))
         except Exception as ex:
             curs.close()
             raise ex
 
-    def put_widget(self, widget):
-        row = self._widget_to_row(widget)
-        with self.conn:
-            self.conn.execute("""
-                UPDATE widgets
-                SET Name = ?, NumOfParts = ?, CreatedDate = ?, UpdatedDate = ?, FlexProperties = ?
-                WHERE Name = ?
-            """, row + (row[0],))
-            self.conn.execute("""
-                INSERT OR IGNORE INTO widgets
-                VALUES (?, ?, ?, ?, ?);
-            """, row)
-
-    def get_widgets_by_cond_spec(self, cond_spec):
-        self._validate_cond_spec(cond_spec)
-        predicate2sqlop = {
-            'isnull': 'IS NULL',
-            'not isnull': 'IS NOT NULL',
-            'eq': '= ?',
-            'ne': '!= ?',
-            'le': '<= ?',
-            'ge': '>= ?',
-            'lt': '< ?',
-            'gt': '> ?',
-            'like': 'LIKE ?',
-            'not like': 'NOT LIKE ?',
-            'between': 'BETEWEEN ? AND ?',
-            'not between': 'NOT BETWEEN ? AND ?'
-        }
-        variables2dbcolumns = {
-            'name': 'Name',
-            'num_of_parts': 'NumOfParts',
-            'created_date': 'CreatedDate',
-            'updated_date': 'UpdatedDate'
-        }
-        parameterized_sql_conditions = []
-        actual_values_for_parameters = []
-        for cond in cond_spec:
-            if cond["variable"] not in variables2dbcolumns:
-                raise ValueError('%s is not an allowed variable' % cond['variable'])
-            parameterized_sql_conditions.append(
-                variables2dbcolumns[cond['variable']] + ' ' + predicate2sqlop[cond['predicate']]
-            )
-            actual_values_for_parameters.extend(cond['constants'])
-        parameterized_sql_where_clause = ' AND '.join(parameterized_sql_conditions)
+    # put_widget, patch_widget and delete_widget_by_name take an optional if_version.
+    # the write then only happens if the stored row is at that version, and raises
+    # VersionMismatchError otherwise, including when there is no stored row
+
+    def put_widget(self, widget, if_version=None):
+        # returns the widget's new version
+        with metrics.phase('sqlite'), self.conn:
+            return self._write_widget(widget, if_version)
+
+    def patch_widget(self, name, patch, if_version=None):
+        # applies a json merge patch in one UPDATE, without reading the widget first,
+        # and returns the patched widget
+        Widget._validate_patch_json_obj(patch)
+        with metrics.phase('sqlite'), self.conn:
+            row = self._patch_widget(name, patch, if_version)
+        with metrics.phase('row_to_widget'):
+            return self._row_to_widget(row)
+
+    def get_widgets_by_cond_spec(self, cond_spec, limit=None, offset=0):
+        # cond_spec can also be a query spec, with where, order_by and limit
+        self._validate_query_spec(cond_spec)
+        where, order_by, spec_limit = self._split_query_spec(cond_spec)
+        limit = self._page_limit(spec_limit, limit, offset)
+        parameterized_sql_where_clause, actual_values_for_parameters = self._cond_spec_to_sql(where)
+        sql = """
+            SELECT *
+            FROM widgets
+        """
+        if parameterized_sql_where_clause:
+            sql += " WHERE " + parameterized_sql_where_clause  # nosec, strict whitelist used
+        if order_by or limit is not None:
+            sql += " ORDER BY " + self._order_by_to_sql(order_by)  # nosec, strict whitelist used
+        if limit is not None:
+            sql += " LIMIT ? OFFSET ?"
+            actual_values_for_parameters.extend((limit, offset))
         try:
-            if len(parameterized_sql_conditions) == 0:
-                curs = self.conn.execute("""
-                    SELECT *
-                    FROM widgets
-                """)
-            else:
-                curs = self.conn.execute(
-                    """
-                    SELECT *
-                    FROM widgets
-                    WHERE  """ + parameterized_sql_where_clause,  # nosec, strict whitelist used
-                    actual_values_for_parameters
-                )
-            return list(map(self._row_to_widget, curs))
+            with metrics.phase('sqlite'):
+                start = time.perf_counter()
+                curs = self.conn.execute(sql, actual_values_for_parameters)
+                rows = curs.fetchall()
+                elapsed = time.perf_counter() - start
+            metrics.observe_rows('get_widgets_by_cond_spec', len(rows))
+            slowlog.record(self.conn, 'get', cond_spec, sql, actual_values_for_parameters, elapsed, len(rows))
+            with metrics.phase('row_to_widget'):
+                return list(map(self._row_to_widget, rows))
         except Exception as ex:
             curs.close()
             raise ex
 
     def delete_widgets_by_cond_spec(self, cond_spec):
         self._validate_cond_spec(cond_spec)
-        predicate2sqlop = {
-            'isnull': 'IS NULL',
-            'not isnull': 'IS NOT NULL',
-            'eq': '= ?',
-            'ne': '!= ?',
-            'le': '<= ?',
-            'ge': '>= ?',
-            'lt': '< ?',
-            'gt': '> ?',
-            'like': 'LIKE ?',
-            'not like': 'NOT LIKE ?',
-            'between': 'BETEWEEN ? AND ?',
-            'not between': 'NOT BETWEEN ? AND ?'
-        }
-        variables2dbcolumns = {
-            'name': 'Name',
-            'num_of_parts': 'NumOfParts',
-            'created_date': 'CreatedDate',
-            'updated_date': 'UpdatedDate'
-        }
-        parameterized_sql_conditions = []
-        actual_values_for_parameters = []
-        for cond in cond_spec:
-            if cond["variable"] not in variables2dbcolumns:
-                raise ValueError('%s is not an allowed variable' % cond['variable'])
-            parameterized_sql_conditions.append(
-                variables2dbcolumns[cond['variable']] + ' ' + predicate2sqlop[cond['predicate']]
-            )
-            actual_values_for_parameters.extend(cond['constants'])
-        parameterized_sql_where_clause = ' AND '.join(parameterized_sql_conditions)
+        parameterized_sql_where_clause, actual_values_for_parameters = self._cond_spec_to_sql(cond_spec)
+        sql = """
+            DELETE FROM widgets
+        """
+        if parameterized_sql_where_clause:
+            sql += " WHERE " + parameterized_sql_where_clause  # nosec, strict whitelist used
         try:
-            if len(parameterized_sql_conditions) == 0:
-                curs = self.conn.execute("""
-                    DELETE FROM widgets
-                """)
-                self.conn.commit()
-            else:
-                curs = self.conn.execute(
-                    """
-                    DELETE FROM widgets
-                    WHERE """ + parameterized_sql_where_clause,  # nosec, strict whitelist used
-                    actual_values_for_parameters
-                )
+            with metrics.phase('sqlite'):
+                start = time.perf_counter()
+                curs = self.conn.execute(sql, actual_values_for_parameters)
                 self.conn.commit()
+                elapsed = time.perf_counter() - start
+            metrics.observe_rows('delete_widgets_by_cond_spec', curs.rowcount)
+            slowlog.record(self.conn, 'delete', cond_spec, sql, actual_values_for_parameters, elapsed, curs.rowcount)
         except Exception as ex:
             curs.close()
             raise ex
 
     def put_widgets(self, widgets):
-        with self.conn:
-            for widget in widgets:
-                row = self._widget_to_row(widget)
-                self.conn.execute("""
-                    UPDATE widgets
-                    SET Name = ?, NumOfParts = ?, CreatedDate = ?, UpdatedDate = ?, FlexProperties = ?
-                    WHERE Name = ?;
-                """, row + (row[0],))
-                self.conn.execute("""
-                    INSERT OR IGNORE INTO widgets
-                    VALUES (?, ?, ?, ?, ?);
-                """, row)
-
-    def delete_widget_by_name(self, name):
-        curs = self.conn.execute("""
-            DELETE FROM widgets
-            WHERE Name = ?;
-        """, (name,))
-        self.conn.commit()
-        if curs.rowcount < 1:
-            raise LookupError('widget with given name is not in store')
+        # returns how many widgets were written. a widget whose content hash matches
+        # the stored row's is skipped, keeping its dates and version
+        return self.put_widget_rows(map(self._encode_widget, widgets))
+
+    def replace_all_widgets(self, widgets):
+        # like delete_all_widgets then put_widgets, except that widgets that are kept
+        # unchanged aren't rewritten. returns how many widgets were written
+        return self.replace_all_widget_rows(map(self._encode_widget, widgets))
+
+    def put_widget_rows(self, rows, stored_dates=None):
+        # put_widgets for widgets already encoded by _encode_widget. rows can be an
+        # iterator, which is written as it's consumed, all in one transaction. if it
+        # raises, nothing is written. stored_dates, if given, is a dict that gets each
+        # widget's name -> (created_date, updated_date) as stored, which for a skipped
+        # or changed widget aren't the dates it was sent with
+        with metrics.phase('sqlite'), self.conn:
+            written, names = self._upsert_rows(rows)
+            if stored_dates is not None:
+                stored_dates.update(self._stored_dates(names))
+        metrics.observe_rows('put_widgets', written)
+        metrics.observe_rows('put_widgets_skipped', len(names) - written)
+        return written
+
+    def replace_all_widget_rows(self, rows, stored_dates=None):
+        # replace_all_widgets for encoded widgets, like put_widget_rows. the widgets
+        # missing from rows are deleted once they've all been written
+        with metrics.phase('sqlite'), self.conn:
+            written, names = self._upsert_rows(rows)
+            self.conn.execute("""
+                DELETE FROM widgets
+                WHERE Name NOT IN (SELECT value FROM json_each(?));
+            """, (json.dumps(names),))
+            if stored_dates is not None:
+                stored_dates.update(self._stored_dates(names))
+        metrics.observe_rows('put_widgets', written)
+        metrics.observe_rows('put_widgets_skipped', len(names) - written)
+        return written
+
+    def delete_widget_by_name(self, name, if_version=None):
+        with metrics.phase('sqlite'), self.conn:
+            self._erase_widget_by_name(name, if_version)
 
     def delete_all_widgets(self):
-        with self.conn:
+        with metrics.phase('sqlite'), self.conn:
             self.conn.execute("""
                 DELETE FROM widgets;
             """)
 
+    def estimate_row_count(self):
+        # the largest rowid is an upper bound on the row count (deleted rows leave gaps),
+        # and unlike COUNT(*) it's one b-tree seek rather than a scan
+        with metrics.phase('sqlite'):
+            return self.conn.execute('SELECT max(rowid) FROM widgets').fetchone()[0] or 0
+
+    # _write_widget, _patch_widget and _erase_widget_by_name leave committing to the
+    # caller, so that several of them can share one transaction. every write bumps the
+    # row's version, and a version check is folded into the statement's WHERE clause
+
+    def _write_widget(self, widget, if_version=None):
+        row = self._encode_widget(widget)
+        where_clause, where_values = self._name_and_version_condition(row[0], if_version)
+        curs = self.conn.execute("""
+            UPDATE widgets
+            SET NumOfParts = ?, CreatedDate = ?, UpdatedDate = ?, FlexProperties = ?, ContentHash = ?,
+                Version = Version + 1
+            WHERE %s
+            RETURNING Version;
+        """ % where_clause, row[1:] + where_values)  # nosec, no user input in the clause
+        updated = curs.fetchone()
+        curs.close()
+        if updated is not None:
+            return updated[0]
+        if if_version is not None:
+            self._raise_not_written(if_version)
+        self.conn.execute("""
+            INSERT INTO widgets (Name, NumOfParts, CreatedDate, UpdatedDate, FlexProperties, ContentHash)
+            VALUES (?, ?, ?, ?, ?, ?);
+        """, row)
+        return 1
+
+    def _upsert_rows(self, rows):
+        # a stored widget is only updated when its content hash differs, and keeps its
+        # created date when it is. returns how many rows were inserted or updated, and
+        # the names of all of them
+        names = []
+
+        def named_rows():
+            for row in rows:
+                names.append(row[0])
+                yield row
+        curs = self.conn.executemany("""
+            INSERT INTO widgets (Name, NumOfParts, CreatedDate, UpdatedDate, FlexProperties, ContentHash)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (Name) DO UPDATE
+            SET NumOfParts = excluded.NumOfParts,
+                UpdatedDate = excluded.UpdatedDate,
+                FlexProperties = excluded.FlexProperties,
+                ContentHash = excluded.ContentHash,
+                Version = Version + 1
+            WHERE ContentHash IS NOT excluded.ContentHash;
+        """, named_rows())
+        return max(curs.rowcount, 0), names
+
+    def _stored_dates(self, names):
+        # read in the write's own transaction, so they're the dates it left behind
+        curs = self.conn.execute("""
+            SELECT Name, CreatedDate, UpdatedDate
+            FROM widgets
+            WHERE Name IN (SELECT value FROM json_each(?));
+        """, (json.dumps(names),))
+        return dict((row[0], (row[1], row[2])) for row in curs)
+
+    def _patch_widget(self, name, patch, if_version=None):
+        # only the core columns named in the patch are set. flex properties are merged
+        # into the stored ones by sqlite's json_patch, which removes the ones set to null
+        if patch.get('name', name) != name:
+            raise ValueError('a patch can not rename a widget')
+        # the schema's date format isn't enforced, and a row with a bad date can't be
+        # read back, so dates get the same check a Widget gives them
+        for variable in ('created_date', 'updated_date'):
+            if variable in patch and Widget._date_format.match(patch[variable]) is None:
+                raise ValueError('%s (%s) does not match YYYY-MM-DD format' % (variable, patch[variable]))
+        # the merged content is only known inside sqlite, so the content hash is
+        # cleared, and the next bulk write of the widget rewrites it
+        assignments = ['Version = Version + 1', 'ContentHash = NULL']
+        values = []
+        for variable, column in self._variables2dbcolumns.items():
+            if variable != 'name' and variable in patch:
+                assignments.append('%s = ?' % column)
+                values.append(patch[variable])
+        flex_patch = {e: patch[e] for e in patch if e not in Widget._required_properties}
+        if flex_patch:
+            assignments.append(
+                "FlexProperties = CAST(json_patch(CAST(COALESCE(FlexProperties, '{}') AS TEXT), ?) AS BLOB)"
+            )
+            values.append(json.dumps(flex_patch))
+        where_clause, where_values = self._name_and_version_condition(name, if_version)
+        curs = self.conn.execute("""
+            UPDATE widgets
+            SET %s
+            WHERE %s
+            RETURNING *;
+        """ % (', '.join(assignments), where_clause), tuple(values) + where_values)  # nosec, columns are whitelisted
+        row = curs.fetchone()
+        curs.close()
+        if row is None:
+            self._raise_not_written(if_version)
+        return row
+
+    def _erase_widget_by_name(self, name, if_version=None):
+        where_clause, where_values = self._name_and_version_condition(name, if_version)
+        curs = self.conn.execute("""
+            DELETE FROM widgets
+            WHERE %s;
+        """ % where_clause, where_values)  # nosec, no user input in the clause
+        if curs.rowcount < 1:
+            self._raise_not_written(if_version)
+
+    @staticmethod
+    def _name_and_version_condition(name, if_version):
+        if if_version is None:
+            return 'Name = ?', (name,)
+        return 'Name = ? AND Version = ?', (name, if_version)
+
+    @staticmethod
+    def _raise_not_written(if_version):
+        # a conditional write can't tell a missing widget from a changed one without
+        # another query, and both fail the condition
+        if if_version is not None:
+            raise VersionMismatchError('widget with given name is not at version %s' % if_version)
+        raise LookupError('widget with given name is not in store')
+
     def _row_to_widget(self, row):
-        return Widget(
+        widget = Widget(
             name=row[0],
             num_of_parts=row[1],
             created_date=row[2],
@@ -322,8 +598,26 @@ class WidgetStore:
                 else '{}'
             )
         )
-
-    def _widget_to_row(self, widget):
+        widget.version = row[5]
+        return widget
+
+    @staticmethod
+    def _content_hash(widget):
+        # covers everything but the dates, which the api stamps on every write
+        content = dict((e, widget[e]) for e in widget if e not in ('created_date', 'updated_date'))
+        return hashlib.blake2b(
+            json.dumps(content, sort_keys=True, separators=(',', ':')).encode('utf-8'),
+            digest_size=16
+        ).digest()
+
+    @staticmethod
+    def _encode_widget(widget):
+        # the row a bulk write upserts. a plain function of the widget, so that worker
+        # processes can do it (see bulkingest)
+        return WidgetStore._widget_to_row(widget) + (WidgetStore._content_hash(widget),)
+
+    @staticmethod
+    def _widget_to_row(widget):
         return (
             widget['name'],
             widget['num_of_parts'],
@@ -339,5 +633,135 @@ class WidgetStore:
             )
         )
 
-    def _validate_cond_spec(self, cond_spec):
-        jsonschema.validate(instance=cond_spec, schema=self._cond_spec_schema)
+    _predicate2sqlop = {
+        'isnull': 'IS NULL',
+        'not isnull': 'IS NOT NULL',
+        'eq': '= ?',
+        'ne': '!= ?',
+        'le': '<= ?',
+        'ge': '>= ?',
+        'lt': '< ?',
+        'gt': '> ?',
+        'like': 'LIKE ?',
+        'not like': 'NOT LIKE ?',
+        'between': 'BETWEEN ? AND ?',
+        'not between': 'NOT BETWEEN ? AND ?'
+    }
+
+    _variables2dbcolumns = {
+        'name': 'Name',
+        'num_of_parts': 'NumOfParts',
+        'created_date': 'CreatedDate',
+        'updated_date': 'UpdatedDate'
+    }
+
+    def _cond_spec_to_sql(self, cond_spec):
+        actual_values_for_parameters = []
+        parameterized_sql_conditions = [
+            self._condition_to_sql(cond, actual_values_for_parameters)
+            for cond in cond_spec
+        ]
+        return ' AND '.join(parameterized_sql_conditions), actual_values_for_parameters
+
+    def _condition_to_sql(self, cond, actual_values_for_parameters):
+        # groups are parenthesized, so they nest exactly as written. a leaf is told apart
+        # by its predicate first, so a group key on it can never stand in for the leaf
+        if 'predicate' in cond:
+            return self._leaf_condition_to_sql(cond, actual_values_for_parameters)
+        if 'all' in cond or 'any' in cond:
+            operator = ' AND ' if 'all' in cond else ' OR '
+            return '(' + operator.join(
+                self._condition_to_sql(operand, actual_values_for_parameters)
+                for operand in cond.get('all', cond.get('any'))
+            ) + ')'
+        return 'NOT (' + self._condition_to_sql(cond['not'], actual_values_for_parameters) + ')'
+
+    def _leaf_condition_to_sql(self, cond, actual_values_for_parameters):
+        if cond["variable"] not in self._variables2dbcolumns:
+            raise ValueError('%s is not an allowed variable' % cond['variable'])
+        if cond['variable'] == 'name' and cond['predicate'] == 'like' and self._uses_name_trigram_index(cond):
+            # the index narrows the rows down to candidates, and the plain LIKE
+            # still decides the match, so case handling is exactly LIKE's
+            actual_values_for_parameters.extend(cond['constants'] * 2)
+            return '(rowid IN (SELECT rowid FROM widgets_name_trigram WHERE Name LIKE ?) AND Name LIKE ?)'
+        actual_values_for_parameters.extend(cond['constants'])
+        return self._variables2dbcolumns[cond['variable']] + ' ' + self._predicate2sqlop[cond['predicate']]
+
+    def _order_by_to_sql(self, order_by):
+        return ', '.join(
+            self._variables2dbcolumns[variable] + (' DESC' if descending else ' ASC')
+            for variable, descending in self._order_terms(order_by)
+        )
+
+    @staticmethod
+    def _order_terms(order_by):
+        # (variable, descending) pairs, ending with name. names are unique, so name
+        # breaks every tie and nothing after it matters. it breaks ties in the first
+        # term's direction, so the sort indexes can be walked backwards for desc
+        terms = []
+        for term in order_by:
+            terms.append((term['variable'], term.get('direction', 'asc') == 'desc'))
+            if term['variable'] == 'name':
+                return terms
+        return terms + [('name', terms[0][1] if terms else False)]
+
+    @staticmethod
+    def _split_query_spec(query_spec):
+        # -> (cond_spec, order_by, limit). a plain cond_spec has no order or limit
+        if not isinstance(query_spec, dict):
+            return query_spec, [], None
+        where = query_spec.get('where', [])
+        return (where if isinstance(where, list) else [where]), query_spec.get('order_by', []), query_spec.get('limit')
+
+    @staticmethod
+    def _page_limit(spec_limit, limit, offset):
+        # the page of the spec's top spec_limit rows that the limit and offset ask for
+        if spec_limit is None:
+            return limit
+        spec_limit = max(spec_limit - offset, 0)
+        return spec_limit if limit is None else min(limit, spec_limit)
+
+    def _uses_name_trigram_index(self, cond):
+        # the index can only narrow a pattern down with a run of at least three
+        # characters between wildcards, anything shorter is left to a plain scan
+        pattern = cond['constants'][0]
+        return self.has_name_trigram_index and isinstance(pattern, str) and \
+            max(len(run) for run in re.split('[%_]', pattern)) >= 3
+
+    @classmethod
+    def _validate_cond_spec(cls, cond_spec):
+        with metrics.phase('validation'):
+            cls._check_condition_nesting(cond_spec)
+            _validate_cond_spec_schema(cond_spec)
+
+    @classmethod
+    def _validate_query_spec(cls, query_spec):
+        with metrics.phase('validation'):
+            cls._check_condition_nesting(cls._split_query_spec(query_spec)[0])
+            _validate_query_spec_schema(query_spec)
+
+    @classmethod
+    def _check_condition_nesting(cls, cond_spec):
+        # runs before the schema check, so a deeply nested spec is turned away before
+        # the validator recurses into it. anything that isn't a group is left to the schema
+        pending = [(cond, 1) for cond in cond_spec] if isinstance(cond_spec, list) else []
+        count = 0
+        while pending:
+            cond, depth = pending.pop()
+            count += 1
+            if count > cls._max_condition_count:
+                raise jsonschema.exceptions.ValidationError(
+                    'at most %s conditions and groups are allowed' % cls._max_condition_count
+                )
+            if depth > cls._max_condition_depth:
+                raise jsonschema.exceptions.ValidationError(
+                    'groups can be nested at most %s deep' % cls._max_condition_depth
+                )
+            if not isinstance(cond, dict):
+                continue
+            for operator in ('all', 'any', 'not'):
+                operands = cond.get(operator)
+                if isinstance(operands, dict):
+                    operands = [operands]
+                if isinstance(operands, list):
+                    pending.extend((operand, depth + 1) for operand in operands)